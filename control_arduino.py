@@ -11,21 +11,34 @@ Created on Wed Jan 16 10:24:26 2019
 from __future__ import print_function, division
 from ipywidgets import widgets as wi
 from IPython.display import display
-import threading
-import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
-from gekko import GEKKO
 import bqplot as bq
-from tclab import TCLab
+from control_perf import PhaseProfiler, TraceRecorder, LoopMetrics
+from control_perf import register_metrics, start_metrics_server
+from control_engine import LoopRunner
+from control_clock import REAL
+from control_io import Connection, FILTERS, make_filter
+from control_plant import Shadow
+from control_backend import BoardBackend
+from control_loops import ControlLoops
 
 
-class GUI(object):
+class GUI(ControlLoops):
     """
     Class that defines the _GUI applications
     """
-    def __init__(self):
+    def __init__(self, runner=None, port='', clock=None):
         """
         Initialize the _GUI elements
+
+        runner = control_engine.LoopRunner executing the loops (defaults to
+                 a dedicated event loop thread shared by all GUIs)
+        port = serial port of the TCLab (empty string finds the Arduino)
+        clock = control_clock clock of the loops and of the acquisition
+                schedule (default wall clock)
         """
         #######################################################################
         #                                               PLOTTING CONFIGURATION
@@ -130,8 +143,20 @@ class GUI(object):
         self._T2_SP = 30
         self._Q10 = 0
         self._Q20 = 0
-        self._flag = False
-        self._sleep = 0.5
+        self._run = None
+        self._runner = runner or LoopRunner.default()
+        self._clock = clock or REAL
+        self._snapshot = None
+        self._render_period = 0.1
+        self._io = ThreadPoolExecutor(max_workers=1,
+                                      thread_name_prefix='tclab-io')
+        self._lab = Connection(port, on_status=self._lab_status)
+        self._backend = None
+        self._controller = None
+        self._replay = None
+        self._shadow = Shadow()
+        self._oversample = 1
+        self._filter = 'Moving average'
         self._Tc0 = np.array([293.15, 293.15])
 
         self._q1_dt_on_off = 0.1
@@ -145,6 +170,10 @@ class GUI(object):
         self._pid2_reset = 50.
         self._pid2_rate = 1.
 
+        self._pid_schedule = None
+        self._pid_schedule_by = 'PV'
+        self._schedule = None
+
         self._SOLVER = '1 - APOPT'
         self._CVTYPE = '1 - Deadband'
 
@@ -158,6 +187,14 @@ class GUI(object):
         self._Q2_DMAX = 30.
         self._Q2_DCOST = 1.
 
+        self._profiler = PhaseProfiler(['read', 'control', 'write',
+                                        'bookkeeping', 'widgets', 'sleep',
+                                        'serial', 'solve'])
+        self._perf_ticks = 0
+        self._metrics = LoopMetrics()
+        self._metrics.clock = self._clock
+        self._metrics.link = self._lab
+
         #######################################################################
         #                                              OUTPUT WIDGETS CRIATION
         #######################################################################
@@ -252,7 +289,8 @@ class GUI(object):
         self._mode = wi.ToggleButtons(options=['Manual',
                                                'On-Off',
                                                'PID',
-                                               'MPC'],
+                                               'MPC',
+                                               'Autotune'],
                                       style={'button_width': '100px'})
         self._mode.observe(self._mode_switch, names='value')
 
@@ -273,9 +311,12 @@ class GUI(object):
         self._b_play.on_click(self._play_click)
 
         # Join Buttons
+        self._status = wi.HTML(value='', layout=wi.Layout(width='165px'))
+        self._lab_status(self._lab.status)
+        self._model = wi.HTML(value='', layout=wi.Layout(width='165px'))
+
         buttons = wi.HBox((self._b_play, h_space, self._b_stop,
-                           wi.Label(value="", layout=wi.Layout(width='165px')),
-                           self._mode))
+                           self._status, self._model, self._mode))
 
         #######################################################################
         #                                                               LAYOUT
@@ -329,12 +370,19 @@ class GUI(object):
             wi.FloatSlider(value=4.0, min=1.0, max=10.0, step=0.5,
                            description='', style=style)))
 
-        self._conf12 = wi.HBox((
+        self._conf14 = wi.HBox((
             wi.HTML(value='<p style="text-align: right;">'
-                          '<b>Sleep time (s):</b></p>',
+                          '<b>Oversampling:</b></p>',
                     layout=lay),
-            wi.FloatSlider(value=0.5, min=0.25, max=1.5, step=0.05,
-                           description='', style=style)))
+            wi.IntSlider(value=1, min=1, max=20, step=1,
+                         description='', style=style)))
+
+        self._conf15 = wi.HBox((
+            wi.HTML(value='<p style="text-align: right;">'
+                          '<b>Filter:</b></p>',
+                    layout=lay),
+            wi.Dropdown(options=FILTERS, value='Moving average',
+                        layout=wi.Layout(width='170px'))))
 
         but11 = wi.Button(description='Apply', icon='check',
                           layout=wi.Layout(width='100px', height='32px'))
@@ -470,6 +518,19 @@ class GUI(object):
                                          width='335px',
                                          margin='10px 0 0 10px'))
 
+        self._conf39 = wi.HBox((
+            wi.Checkbox(value=False, description='Gain scheduling by',
+                        indent=False, layout=wi.Layout(width='150px')),
+            wi.Dropdown(options=['PV', 'Setpoint'], value='PV',
+                        layout=wi.Layout(width='100px')),
+            wi.Button(description='Generate table', icon='table',
+                      layout=wi.Layout(width='140px', height='32px',
+                                       margin='0 0 0 20px')),
+            wi.HTML(value=self._schedule_html(),
+                    layout=wi.Layout(margin='0 0 0 10px'))),
+            layout=wi.Layout(margin='10px 0 0 0'))
+        self._conf39.children[2].on_click(self._generate_schedule)
+
         but31 = wi.Button(description='Apply', icon='check',
                           layout=wi.Layout(width='100px', height='32px'))
         but31.on_click(self._conf_pid)
@@ -612,28 +673,63 @@ class GUI(object):
         conf413 = wi.HBox((but41, but42),
                           layout=wi.Layout(margin='10px 0 0 0'))
 
+        #######################################################################
+        #                                                  PERFORMANCE OPTIONS
+        #######################################################################
+        self._conf51 = wi.Checkbox(value=self._profiler.enabled,
+                                   description='Phase profiling enabled',
+                                   style=style)
+        self._conf51.observe(self._conf_perf, names='value')
+
+        self._conf52 = wi.HTML(value=self._profiler.html(),
+                               layout=wi.Layout(height='230px'))
+
+        but51 = wi.Button(description='Refresh', icon='refresh',
+                          layout=wi.Layout(width='100px', height='32px'))
+        but51.on_click(self._refresh_perf)
+        but52 = wi.Button(description='Reset', icon='trash',
+                          layout=wi.Layout(width='100px', height='32px'))
+        but52.on_click(self._reset_perf)
+        conf53 = wi.HBox((but51, but52),
+                         layout=wi.Layout(margin='10px 0 0 0'))
+
+        #######################################################################
+        #                                                       SERIAL OPTIONS
+        #######################################################################
+        self._conf61 = wi.HTML(value=self._lab.stats.html(),
+                               layout=wi.Layout(height='290px'))
+
+        but61 = wi.Button(description='Refresh', icon='refresh',
+                          layout=wi.Layout(width='100px', height='32px'))
+        but61.on_click(self._refresh_serial)
+        conf62 = wi.HBox((but61,), layout=wi.Layout(margin='10px 0 0 0'))
+
         #######################################################################
         #                                                  CONFIGURATOR LAYOUT
         #######################################################################
-        tab = wi.Tab([wi.VBox((self._conf11, self._conf12,
-                               wi.Label(layout=wi.Layout(height='206px')),
+        tab = wi.Tab([wi.VBox((self._conf11, self._conf14, self._conf15,
+                               wi.Label(layout=wi.Layout(height='170px')),
                                conf13)),
                       wi.VBox((wi.HBox((box21, box22)),
                                wi.Label(layout=wi.Layout(height='191px')),
                                conf24)),
-                      wi.VBox((wi.HBox((box31, box32)),
-                               wi.Label(layout=wi.Layout(height='127px')),
+                      wi.VBox((wi.HBox((box31, box32)), self._conf39,
+                               wi.Label(layout=wi.Layout(height='85px')),
                                conf38)),
                       wi.VBox((self._conf40,
                                wi.HBox((box41, box43)),
                                wi.HBox((box42, box44)),
                                wi.Label(layout=wi.Layout(height='11px')),
-                               conf413))],
+                               conf413)),
+                      wi.VBox((self._conf51, self._conf52, conf53)),
+                      wi.VBox((self._conf61, conf62))],
                      layout=wi.Layout(width='800px', height='380px'))
         tab.set_title(0, 'General Options')
         tab.set_title(1, 'On-Off Options')
         tab.set_title(2, 'PID Options')
         tab.set_title(3, 'MPC Options')
+        tab.set_title(4, 'Performance')
+        tab.set_title(5, 'Serial')
 
         #######################################################################
         #                                                 DISPLAY CONFIGURATOR
@@ -646,19 +742,99 @@ class GUI(object):
     def config(self):
         display(self._conf)
 
+    def connect(self):
+        """
+        Open the TCLab in the background (otherwise it opens on Start)
+        """
+        return self._io.submit(self._lab.open)
+
+    def close(self):
+        """
+        Release the TCLab serial port (it is reopened on the next Start)
+        """
+        if self._run is not None:
+            self._run.stop()
+        return self._io.submit(self._lab.close)
+
+    def profile(self, enabled=None):
+        """
+        Return the loop phase timings, optionally switching profiling on/off
+        """
+        if enabled is not None:
+            self._conf51.value = bool(enabled)
+        return self._profiler.summary()
+
+    def serve_metrics(self, port=9100, name=None):
+        """
+        Serve loop, solver and I/O metrics in Prometheus format on localhost
+        """
+        if name is not None:
+            self._metrics.name = name
+        register_metrics(self._metrics)
+        server = start_metrics_server(port)
+        return 'http://{}:{}/metrics'.format(*server.server_address)
+
+    def shadow(self):
+        """
+        Return the residual (measured - model) of the plant model run in
+        lockstep with the board: last, rolling mean and RMS (C), alarm
+        """
+        return self._shadow.summary()
+
+    def serial_stats(self):
+        """
+        Return the serial link counters, rolling latency percentiles (ms),
+        latency histogram and recent link events
+        """
+        stats = self._lab.stats.summary()
+        stats.update(status=self._lab.status,
+                     reconnects=self._lab.reconnects,
+                     histogram=self._lab.stats.histogram(),
+                     events=list(self._lab.stats.events))
+        return stats
+
+    def trace_start(self, capacity=200000):
+        """
+        Start recording loop phase events into a preallocated trace buffer
+        """
+        self._profiler.tracer = TraceRecorder(capacity)
+        self._conf51.value = True
+
+    def trace_stop(self, path='tclab_trace.json'):
+        """
+        Stop tracing and dump the events as Chrome Trace Event JSON
+        """
+        tracer = self._profiler.tracer
+        self._profiler.tracer = None
+        if tracer is None:
+            return None
+        return tracer.dump(path)
+
     def _conf_general(self, b):
         self._delta_t = self._conf11.children[1].value
         self._maxtime = int(500/self._delta_t)
 
-        self._sleep = self._conf12.children[1].value
+        self._oversample = self._conf14.children[1].value
+        self._filter = self._conf15.children[1].value
+        self._apply_acquisition()
 
     def _reset_general(self, b):
         self._conf11.children[1].value = 4.0
         self._delta_t = self._conf11.children[1].value
         self._maxtime = int(500/self._delta_t)
 
-        self._conf12.children[1].value = 0.5
-        self._sleep = self._conf12.children[1].value
+        self._conf14.children[1].value = 1
+        self._oversample = self._conf14.children[1].value
+        self._conf15.children[1].value = 'Moving average'
+        self._filter = self._conf15.children[1].value
+        self._apply_acquisition()
+
+    def _apply_acquisition(self):
+        # Oversampling and filter changes take effect on a running loop
+        acq = getattr(self._backend, 'acquisition', None)
+        if acq is not None:
+            acq.oversample = self._oversample
+            acq.filter = make_filter(self._filter, self._oversample)
 
     def _conf_on_off(self, b):
         self._q1_dt_on_off = self._conf21.children[1].value
@@ -681,6 +857,10 @@ class GUI(object):
         self._pid2_reset = self._conf36.children[1].value
         self._pid2_rate = self._conf37.children[1].value
 
+        self._pid_schedule_by = self._conf39.children[1].value
+        self._pid_schedule = (self._schedule
+                              if self._conf39.children[0].value else None)
+
     def _reset_pid(self, b):
         self._conf31.children[1].value = 10.0  # gain
         self._conf32.children[1].value = 50.0  # reset
@@ -694,7 +874,10 @@ class GUI(object):
         self._conf37.children[1].value = 1.0   # rate
         self._pid2_gain = self._conf35.children[1].value
         self._pid2_reset = self._conf36.children[1].value
-        self._pid2_rate = self._conf37.children[1].valu
+        self._pid2_rate = self._conf37.children[1].value
+
+        self._conf39.children[0].value = False
+        self._pid_schedule = None
 
     def _conf_mpc(self, b):
         self._SOLVER = self._conf40.children[1].value
@@ -737,6 +920,44 @@ class GUI(object):
         self._Q2_DMAX = self._conf411.children[1].value
         self._Q2_DCOST = self._conf412.children[1].value
 
+    def _conf_perf(self, value):
+        self._profiler.enabled = value['new']
+
+    def _refresh_perf(self, b):
+        self._conf52.value = self._profiler.html()
+
+    def _reset_perf(self, b):
+        self._profiler.reset()
+        self._conf52.value = self._profiler.html()
+
+    def _refresh_serial(self, b):
+        self._conf61.value = self._lab.stats.html()
+
+    def _update_perf(self):
+        # Refresh the performance and serial panels every few ticks
+        self._perf_ticks += 1
+        if self._perf_ticks % 10 == 0:
+            if self._profiler.enabled:
+                self._conf52.value = self._profiler.html()
+            self._conf61.value = self._lab.stats.html()
+
+    def _update_model(self):
+        # Rolling residual of the shadow model in the button bar
+        s = self._shadow.summary()
+        if s['samples'] == 0:
+            self._model.value = ''
+            return
+        color = 'red' if s['alarm'] else 'black'
+        self._model.value = ('<p style="text-align: center; color: {};">'
+                             'model &Delta;: {:+.1f} / {:+.1f} C</p>').format(
+                                 color, *s['mean'])
+
+    def _lab_status(self, status):
+        # Called from the I/O and monitor threads
+        if hasattr(self, '_status'):
+            self._status.value = ('<p style="text-align: center;">'
+                                  'TCLab: {}</p>'.format(status))
+
     def _Q1_click(self, b):
         self._Q10 = self._wQ1.value
 
@@ -750,31 +971,18 @@ class GUI(object):
         self._T2_SP = self._wT2.value
 
     def _stop_click(self, b):
-        self._flag = False
+        if self._run is not None:
+            self._run.stop()
         self._mode.disabled = False
 
     def _play_click(self, b):
-        if not self._flag:
-            if self._mode.value == "Manual":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_man)
-                thread.start()
-            elif self._mode.value == "On-Off":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_on_off)
-                thread.start()
-            elif self._mode.value == "PID":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_pid)
-                thread.start()
-            elif self._mode.value == "MPC":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_mpc)
-                thread.start()
+        if self._run is None or self._run.stopped:
+            work = functools.partial(self._work, self._mode.value)
+            self._mode.disabled = True
+            self._snapshot = None
+            # The new run waits for the previous one to finish cancelling
+            self._run = self._runner.start(work, self._render,
+                                           previous=self._run)
 
     def _mode_switch(self, value):
         # Reinitialize parameters
@@ -838,653 +1046,69 @@ class GUI(object):
             self._bT2.disabled = False
 
     ###########################################################################
-    #                                                           PID CONTROLLER
+    #                                                                RENDERING
     ###########################################################################
-
-    # inputs -----------------------------------
-    # sp = setpoint
-    # pv = current temperature
-    # pv_last = prior temperature
-    # ierr = integral error
-    # dt = time increment between measurements
-
-    # outputs ----------------------------------
-    # op = output of the PID controller
-    # I = integral contribution
-
-    def _PID(self, sp, pv, pv_last, ierr, dt, Kc=10.0, tauI=50.0, tauD=1.0):
-        # Default Parameters
-        # Kc   = 10.0 # K/%Heater
-        # tauI = 50.0 # sec
-        # tauD = 1.0  # sec
-
-        # Parameters in terms of PID coefficients
-        KP = Kc
-        if tauI == 0:
-            KI = 1e5
-        else:
-            KI = Kc/tauI
-        KD = Kc*tauD
-
-        # ubias for controller (initial heater)
-        op0 = 0
-
-        # upper and lower bounds on heater level
-        ophi = 100
-        oplo = 0
-
-        # calculate the error
-        error = sp-pv
-
-        # calculate the integral error
-        ierr = ierr + KI * error * dt
-
-        # calculate the measurement derivative
-        dpv = (pv - pv_last) / dt
-
-        # calculate the PID output
-        P = KP * error
-        I = ierr
-        D = -KD * dpv
-        op = op0 + P + I + D
-
-        # implement anti-reset windup
-        if op < oplo or op > ophi:
-            I = I - KI * error * dt
-            # clip output
-            op = max(oplo, min(ophi, op))
-
-        # return the controller output and PID terms
-        return [op, I]
-
-    ###########################################################################
-    #                                                                      MPC
-    ###########################################################################
-    def _MPC(self):
-
-        m = GEKKO(remote=False)
-
-        # 60 second time horizon, 4 sec cycle time, non-uniform
-        m.time = [0, 4, 8, 12, 15, 20, 25, 30, 35, 40, 50, 60, 70, 80, 90]
-
-        # Parameters
-        m.U = m.FV(value=10)
-        m.tau = m.FV(value=5)
-        m.alpha1 = m.FV(value=0.01)    # W / % heater
-        m.alpha2 = m.FV(value=0.0075)  # W / % heater
-
-        # Manipulated variables
-        m.Q1 = m.MV(value=0)
-        m.Q1.STATUS = 1   # use to control temperature
-        m.Q1.FSTATUS = 0  # no feedback measurement
-        m.Q1.LOWER = 0.0
-        m.Q1.UPPER = 100.0
-        m.Q1.DMAX = 20.0
-        m.Q1.COST = 0.0
-        m.Q1.DCOST = 2.0
-
-        m.Q2 = m.MV(value=0)
-        m.Q2.STATUS = 1   # use to control temperature
-        m.Q2.FSTATUS = 0  # no feedback measurement
-        m.Q2.LOWER = 0.0
-        m.Q2.UPPER = 100.0
-        m.Q2.DMAX = 20.0
-        m.Q2.COST = 0.0
-        m.Q2.DCOST = 2.0
-
-        # Controlled variable
-        m.TC1 = m.CV(value=22)
-        m.TC1.STATUS = 1     # minimize error with setpoint range
-        m.TC1.FSTATUS = 1    # receive measurement
-        m.TC1.TR_INIT = 1    # reference trajectory
-        m.TC1.TAU = 10       # time constant for response
-
-        # Controlled variable
-        m.TC2 = m.CV(value=22)
-        m.TC2.STATUS = 1     # minimize error with setpoint range
-        m.TC2.FSTATUS = 1    # receive measurement
-        m.TC2.TR_INIT = 1    # reference trajectory
-        m.TC2.TAU = 10       # time constant for response
-
-        # State variables
-        m.TH1 = m.SV(value=22)
-        m.TH2 = m.SV(value=22)
-
-        m.Ta = m.Param(value=23.0+273.15)     # K
-        m.mass = m.Param(value=4.0/1000.0)    # kg
-        m.Cp = m.Param(value=0.5*1000.0)      # J/kg-K
-        m.A = m.Param(value=10.0/100.0**2)    # Area not between heaters in m^2
-        m.As = m.Param(value=2.0/100.0**2)    # Area between heaters in m^2
-        m.eps = m.Param(value=0.9)            # Emissivity
-        m.sigma = m.Const(5.67e-8)            # Stefan-Boltzmann
-
-        # Heater temperatures
-        m.T1i = m.Intermediate(m.TH1+273.15)
-        m.T2i = m.Intermediate(m.TH2+273.15)
-
-        # Heat transfer between two heaters
-        m.Q_C12 = m.Intermediate(m.U*m.As*(m.T2i-m.T1i))  # Conv
-        m.Q_R12 = m.Intermediate(m.eps*m.sigma*m.As*(m.T2i**4-m.T1i**4))  # Rad
-
-        # Semi-fundamental correlations (energy balances)
-        m.Equation(m.TH1.dt() == (1.0/(m.mass*m.Cp)) *
-                                 (m.U*m.A*(m.Ta-m.T1i) +
-                                  m.eps * m.sigma * m.A *
-                                  (m.Ta**4 - m.T1i**4) + m.Q_C12 +
-                                  m.Q_R12 + m.alpha1*m.Q1))
-
-        m.Equation(m.TH2.dt() == (1.0/(m.mass*m.Cp)) *
-                                 (m.U*m.A*(m.Ta-m.T2i) +
-                                  m.eps * m.sigma * m.A *
-                                  (m.Ta**4 - m.T2i**4) - m.Q_C12 -
-                                  m.Q_R12 + m.alpha2*m.Q2))
-
-        # Empirical correlations (lag equations to emulate conduction)
-        m.Equation(m.tau * m.TC1.dt() == -m.TC1 + m.TH1)
-        m.Equation(m.tau * m.TC2.dt() == -m.TC2 + m.TH2)
-
-        # Global Options
-        m.options.IMODE = 6    # MPC
-        m.options.CV_TYPE = 1  # Objective type
-        m.options.NODES = 3    # Collocation nodes
-        m.options.SOLVER = 3   # 1=APOPT, 3=IPOPT
-
-        return m
-
-    ###########################################################################
-    #                                           THREADING FUNCTION - OPEN LOOP
-    ###########################################################################
-    def _work_man(self):
-        try:
-            a = TCLab()
-        except:
-            a.close()
-            a = TCLab()
-
-        # Parater to start each cycle
-        self._Tc0 = np.array([
-            a.T1 + 273.15,
-            a.T2 + 273.15
-        ])
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-
-        # Main Loop
-        start_time = time.time()
-        prev_time = start_time
-
-        while self._flag:
-
-            # Sleep time
-            sleep_max = self._delta_t
-            sleep = sleep_max - (time.time() - prev_time)
-            if sleep >= 0.01:
-                time.sleep(sleep-0.01)
-            else:
-                time.sleep(0.01)
-
-            # Read temperatures in Celsius
-            self._Tc0 = np.array([
-                a.T1 + 273.15,
-                a.T2 + 273.15
-            ])
-
-            # Write new heater values (0-100)
-            a.Q1(self._Q10)
-            a.Q2(self._Q20)
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-
-            # Record time and change in time
-            tm = time.time()
-            prev_time = tm
-            tm = tm - start_time
-
-            t = np.append(t, np.array([tm]), axis=0)
-            T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
+    async def _render(self):
+        # Push the latest loop snapshot to the widgets, decoupled from the
+        # control loop so slow widget comms never delay a tick
+        drawn = None
+        while True:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot is not drawn:
+                with self._profiler.span('widgets'):
+                    self._draw(snapshot)
+                    self._update_perf()
+                    self._update_model()
+                drawn = snapshot
+            await asyncio.sleep(self._render_period)
+
+    def _draw(self, snapshot):
+        t, T, Q1, Q2, SP_T1, SP_T2 = snapshot
+
+        self._T1_meas.x = t/60
+        self._T1_meas.y = T[:, 0] - 273.15
+        self._PT1.value = np.round(T[-1, 0]-273.15, 1)
+
+        self._T2_meas.x = t/60
+        self._T2_meas.y = T[:, 1] - 273.15
+        self._PT2.value = np.round(T[-1, 1]-273.15, 1)
+
+        self._u1.x = t/60
+        self._u1.y = Q1
+
+        self._u2.x = t/60
+        self._u2.y = Q2
+
+        if SP_T1 is None:
+            # Manual mode, setpoint sliders follow the measurements
             self._wT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
             self._wT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-
-            time.sleep(self._sleep)
-
-        a.Q1(0)
-        a.Q2(0)
-        a.close()
-
-    ###########################################################################
-    #                                              THREADING FUNCTION - ON-OFF
-    ###########################################################################
-    def _work_on_off(self):
-        try:
-            a = TCLab()
-        except:
-            a.close()
-            a = TCLab()
-
-        # Parater to start each cycle
-        self._Tc0 = np.array([
-            a.T1 + 273.15,
-            a.T2 + 273.15
-        ])
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        # Main Loop
-        start_time = time.time()
-        prev_time = start_time
-
-        while self._flag:
-
-            # Sleep time
-            sleep_max = self._delta_t
-            sleep = sleep_max - (time.time() - prev_time)
-            if sleep >= 0.01:
-                time.sleep(sleep-0.01)
-            else:
-                time.sleep(0.01)
-
-            # Read temperatures in Celsius
-            self._Tc0 = np.array([
-                a.T1 + 273.15,
-                a.T2 + 273.15
-            ])
-
-            # apply ON/OFF controller
-            # heater 1
-            if (self._Tc0[0]-273.15) < (self._T1_SP - self._q1_dt_on_off):
-                self._Q10 = 100.0
-            elif (self._Tc0[0]-273.15) > (self._T1_SP + self._q1_dt_on_off):
-                self._Q10 = 0.0
-            # heater 2
-            if (self._Tc0[1]-273.15) < (self._T2_SP - self._q2_dt_on_off):
-                self._Q20 = 100.0
-            elif (self._Tc0[1]-273.15) > (self._T2_SP + self._q2_dt_on_off):
-                self._Q20 = 0.0
-
-            # Write new heater values (0-100)
-            a.Q1(self._Q10)
-            a.Q2(self._Q20)
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            # Record time and change in time
-            tm = time.time()
-            prev_time = tm
-            tm = tm - start_time
-
-            t = np.append(t, np.array([tm]), axis=0)
-            T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T1_set_point.x = t/60
-            self._T1_set_point.y = SP_T1
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._T2_set_point.x = t/60
-            self._T2_set_point.y = SP_T2
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-            self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-            self._wQ2.value = np.round(Q2[-1], 1)
-
-            time.sleep(self._sleep)
-
-        a.Q1(0)
-        a.Q2(0)
-        a.close()
-
-    ###########################################################################
-    #                                                 THREADING FUNCTION - PID
-    ###########################################################################
-    def _work_pid(self):
-        try:
-            a = TCLab()
-        except:
-            a.close()
-            a = TCLab()
-
-        # Parater to start each cycle
-        self._Tc0 = np.array([
-            a.T1 + 273.15,
-            a.T2 + 273.15
-        ])
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        # Integral error
-        ierr1 = 0.0
-        ierr2 = 0.0
-
-        # Main Loop
-        start_time = time.time()
-        prev_time = start_time
-
-        while self._flag:
-
-            # Sleep time
-            sleep_max = self._delta_t
-            sleep = sleep_max - (time.time() - prev_time)
-            if sleep >= 0.01:
-                time.sleep(sleep-0.01)
-            else:
-                time.sleep(0.01)
-
-            # Read temperatures in Celsius
-            self._Tc0 = np.array([
-                a.T1 + 273.15,
-                a.T2 + 273.15
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            # Record time and change in time
-            tm = time.time()
-            prev_time = tm
-            tm = tm - start_time
-
-            t = np.append(t, np.array([tm]), axis=0)
-            T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            # Calculate PID output
-            [self._Q10, ierr1] = self._PID(
-                self._T1_SP, T[-1, 0]-273.15, T[-2, 0]-273.15, ierr1,
-                self._delta_t, self._pid1_gain, self._pid1_reset,
-                self._pid1_rate)
-            [self._Q20, ierr2] = self._PID(
-                self._T2_SP, T[-1, 1]-273.15, T[-2, 1]-273.15, ierr2,
-                self._delta_t, self._pid2_gain, self._pid2_reset,
-                self._pid2_rate)
-
-            # Write new heater values (0-100)
-            a.Q1(self._Q10)
-            a.Q2(self._Q20)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
+        else:
             self._T1_set_point.x = t/60
             self._T1_set_point.y = SP_T1
 
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
             self._T2_set_point.x = t/60
             self._T2_set_point.y = SP_T2
 
-            self._u1.x = t/60
-            self._u1.y = Q1
             self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
             self._wQ2.value = np.round(Q2[-1], 1)
 
-            time.sleep(self._sleep)
-
-        a.Q1(0)
-        a.Q2(0)
-        a.close()
-
     ###########################################################################
-    #                                                 THREADING FUNCTION - MPC
+    #                                                            TCLAB BACKEND
     ###########################################################################
-    def _work_mpc(self):
-        try:
-            a = TCLab()
-        except:
-            a.close()
-            a = TCLab()
-
-        # Parater to start each cycle
-        self._Tc0 = np.array([
-            a.T1 + 273.15,
-            a.T2 + 273.15
-        ])
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        # Create MPC object
-        m = self._MPC()
-
-        # Main Loop
-        start_time = time.time()
-        prev_time = start_time
-
-        while self._flag:
-
-            # Sleep time
-            sleep_max = self._delta_t
-            sleep = sleep_max - (time.time() - prev_time)
-            if sleep >= 0.01:
-                time.sleep(sleep-0.01)
-            else:
-                time.sleep(0.01)
-
-            # Read temperatures in Celsius
-            self._Tc0 = np.array([
-                a.T1 + 273.15,
-                a.T2 + 273.15
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            # Record time and change in time
-            tm = time.time()
-            prev_time = tm
-            tm = tm - start_time
-
-            t = np.append(t, np.array([tm]), axis=0)
-            T = np.append(T, self._Tc0.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            # Change SOLVER
-            if self._SOLVER == '1 - APOPT':
-                m.options.SOLVER = 1
-            elif self._SOLVER == '2 - BPOPT':
-                m.options.SOLVER = 2
-            else:
-                m.options.SOLVER = 3
-
-            # Change CVTYPE
-            if self._CVTYPE == '1 - Deadband':
-                m.options.CV_TYPE = 1
-            else:
-                m.options.CV_TYPE = 2
-
-            # Add measurements to the MPC
-            m.TC1.MEAS = self._Tc0[0] - 273.15
-            m.TC2.MEAS = self._Tc0[1] - 273.15
-
-            # Update Parameters
-            m.TC1.TAU = self._T1_tau
-            m.TC2.TAU = self._T2_tau
-
-            m.Q1.DMAX = self._Q1_DMAX
-            m.Q1.DCOST = self._Q1_DCOST
-            m.Q2.DMAX = self._Q2_DMAX
-            m.Q2.DCOST = self._Q2_DCOST
-
-            # Update prediction horizon
-            DT = self._delta_t
-            m.time = [
-                0,
-                DT,
-                DT*2,
-                DT*3,
-                DT*4,
-                DT*5,
-                DT*6,
-                DT*7,
-                DT*8,
-                DT*10,
-                DT*12,
-                DT*15,
-                DT*18,
-                DT*20,
-                DT*25]
-
-            if m.options.CV_TYPE == 1:
-                # Input setpoint with deadband +/- DT
-                DT1 = self._T1_dt
-                m.TC1.SPHI = self._T1_SP + DT1
-                m.TC1.SPLO = self._T1_SP - DT1
-
-                DT2 = self._T2_dt
-                m.TC2.SPHI = self._T2_SP + DT2
-                m.TC2.SPLO = self._T2_SP - DT2
-            else:
-                m.TC1.SP = self._T1_SP
-                m.TC2.SP = self._T2_SP
-
-            try:
-                # Solve MPC
-                m.solve(disp=False)
-                # Check if successful solution
-                if (m.options.APPSTATUS == 1):
-                    # retrieve new value
-                    self._Q10 = m.Q1.NEWVAL
-                    self._Q20 = m.Q2.NEWVAL
-            except:
-                # Keep previous value
-                pass
-
-            # Write new heater values (0-100)
-            a.Q1(self._Q10)
-            a.Q2(self._Q20)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T1_set_point.x = t/60
-            self._T1_set_point.y = SP_T1
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._T2_set_point.x = t/60
-            self._T2_set_point.y = SP_T2
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-            self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-            self._wQ2.value = np.round(Q2[-1], 1)
-
-            time.sleep(self._sleep)
-
-        a.Q1(0)
-        a.Q2(0)
-        a.close()
+    def _new_backend(self):
+        # Runs use the shared TCLab connection (opened on first use); the
+        # heaters are switched off when a run ends
+        return BoardBackend(self._lab, self._io_call, shadow=self._shadow,
+                            on_read=self._acq_read, clock=self._clock,
+                            oversample=self._oversample,
+                            filter=make_filter(self._filter, self._oversample))
+
+    def _acq_read(self, t0, t1):
+        # Called from the acquisition thread, the only serial reader
+        self._metrics.serial(t1 - t0)
+        self._profiler.record('serial', t0, t1)
+
+    async def _io_call(self, fn, *args):
+        # Serial transactions run one at a time on the dedicated I/O thread
+        return await self._runner.call(fn, *args, executor=self._io)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Plant backends driven by the control loops of control_loops.py
+
+Every backend offers the same coroutines:
+
+    open(dt) -> (T1, T2)       prepare the plant, return the first sample
+    read(dt) -> (t, T1, T2)    wait for the next sample (raises EOFError
+                               when a recording is over)
+    write(Q1, Q2)              apply heater outputs until the next sample
+    close()                    heaters off, release resources
+
+plus `clock`, the time (s) of the last sample since open, and `realtime`,
+True when samples arrive every dt of wall time. Temperatures are in
+Celsius and heater outputs in % (0-100).
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import numpy as np
+from control_io import Acquisition
+from control_plant import Plant
+
+
+class SimBackend(object):
+    """
+    Simulated TCLab: the control_plant model stepped by dt on every read
+    """
+    realtime = False
+
+    def __init__(self, Th0, Tc0, noise=1.0, seed=None):
+        """
+        Th0, Tc0 = initial heater and sensor temperatures (K)
+        noise = width of the uniform measurement noise (C)
+        seed = seed of the measurement noise (global numpy RNG if None)
+        """
+        self.plant = Plant()
+        self.plant.Th = np.array(Th0, dtype=float)
+        self.plant.Tc = np.array(Tc0, dtype=float)
+        self.noise = noise
+        self.clock = 0.
+        self.Q1 = 0.
+        self.Q2 = 0.
+        self._random = (np.random if seed is None
+                        else np.random.RandomState(seed))
+
+    async def open(self, dt):
+        self.clock = 0.
+        T = self.plant.Tc - 273.15
+        return T[0], T[1]
+
+    async def read(self, dt):
+        T = self.plant.step(dt, self.Q1, self.Q2)
+        self.clock += dt
+        return (self.clock,
+                T[0] + self.noise*(self._random.rand() - 0.5),
+                T[1] + self.noise*(self._random.rand() - 0.5))
+
+    async def write(self, Q1, Q2):
+        self.Q1 = Q1
+        self.Q2 = Q2
+
+    async def close(self):
+        pass
+
+
+class BoardBackend(object):
+    """
+    TCLab board: samples come from an acquisition thread and heater
+    writes go through the connection on the serial I/O thread
+    """
+    realtime = True
+
+    def __init__(self, connection, call, shadow=None, **acquisition):
+        """
+        connection = control_io.Connection of the board
+        call = coroutine function call(fn, *args) running a blocking call
+               on the serial I/O thread
+        shadow = control_plant.Shadow fed with every sample and write
+        acquisition = keyword arguments of control_io.Acquisition
+        """
+        self.connection = connection
+        self.shadow = shadow
+        self.acquisition = None
+        self.clock = 0.
+        self._call = call
+        self._options = acquisition
+        self._stamp0 = None
+        self._sample = None
+
+    async def open(self, dt):
+        await self._call(self.connection.open)
+        if self.shadow is not None:
+            self.shadow.reset()
+        self.acquisition = Acquisition(self.connection, dt,
+                                       **self._options).start()
+        self._sample = await self.acquisition.next()
+        self._stamp0 = self._sample[0]
+        self.clock = 0.
+        return self._sample[1:]
+
+    async def read(self, dt):
+        self.acquisition.period = dt
+        self._sample = await self.acquisition.next()
+        self.clock = (self._sample[0] - self._stamp0)*1e-9
+        return (self.clock,) + self._sample[1:]
+
+    async def write(self, Q1, Q2):
+        # The acknowledgements are read with the next sample
+        await self._call(self.connection.write, Q1, Q2, False)
+        if self.shadow is not None:
+            self.shadow.update(self._sample[0], self._sample[1],
+                               self._sample[2], Q1, Q2)
+
+    async def close(self):
+        if self.acquisition is not None:
+            self.acquisition.stop()
+        if self.connection.status == 'connected':
+            await self._call(self.connection.write, 0, 0)
+
+
+class ReplayBackend(object):
+    """
+    Recorded temperatures played back one row per read; the heater
+    outputs computed against them are kept in `written`
+    """
+    realtime = False
+
+    def __init__(self, rows):
+        """
+        rows = array whose first columns are t (s), T1, T2 (C), such as
+               GUI.history() or control_fleet.Fleet.history()
+        """
+        self.rows = np.asarray(rows, dtype=float)
+        self.written = []
+        self.clock = 0.
+        self._i = 0
+
+    @classmethod
+    def from_csv(cls, path):
+        """
+        Load rows saved with numpy.savetxt(path, rows, delimiter=',')
+        """
+        return cls(np.loadtxt(path, delimiter=',', ndmin=2))
+
+    async def open(self, dt):
+        if not len(self.rows):
+            raise EOFError('Empty recording')
+        self._i = 0
+        self.written = []
+        self.clock = 0.
+        return self.rows[0, 1], self.rows[0, 2]
+
+    async def read(self, dt):
+        self._i += 1
+        if self._i >= len(self.rows):
+            raise EOFError('End of the recording')
+        row = self.rows[self._i]
+        self.clock = row[0] - self.rows[0, 0]
+        return self.clock, row[1], row[2]
+
+    async def write(self, Q1, Q2):
+        self.written.append((self.clock, Q1, Q2))
+
+    async def close(self):
+        pass
@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Clocks of the control loops and schedulers
+
+Loops never call time.monotonic() or sleep directly: they use a clock with
+
+    time(), time_ns()     monotonic time (s, ns)
+    await sleep(seconds)  for coroutines on the event loop
+    wait(event, timeout)  for threads: event.wait(timeout) in clock time
+
+RealClock is the wall clock. SimulatedClock jumps ahead to the next
+deadline instead of waiting, so a 30 minute closed-loop run takes as long
+as its computations while every sleep and deadline keeps its place in
+simulated time. SteppedClock only moves when advance() is called, for
+tests that check the state at given instants.
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+
+
+class RealClock(object):
+    """
+    Wall clock (time.monotonic)
+    """
+    def time(self):
+        return time.monotonic()
+
+    def time_ns(self):
+        return time.monotonic_ns()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+
+# Default clock of the loops
+REAL = RealClock()
+
+
+class VirtualClock(object):
+    """
+    Base of the clocks whose time only moves by _advance(): sleeping
+    coroutines and waiting threads are woken once their deadline is reached
+    """
+    def __init__(self, start=0.):
+        self.now = float(start)
+        self._sleepers = []     # heap of (deadline, seq, loop, future)
+        self._seq = itertools.count()
+        self._lock = threading.Condition()
+
+    def time(self):
+        return self.now
+
+    def time_ns(self):
+        return int(round(self.now*1e9))
+
+    def _advance(self, t):
+        # Move the time forward to t and wake the sleepers due
+        with self._lock:
+            self.now = max(self.now, t)
+            while self._sleepers and self._sleepers[0][0] <= self.now:
+                deadline, seq, loop, future = heapq.heappop(self._sleepers)
+                loop.call_soon_threadsafe(_wake, future)
+            self._lock.notify_all()
+
+    def _sleeper(self, seconds):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        with self._lock:
+            heapq.heappush(self._sleepers, (self.now + seconds,
+                                            next(self._seq), loop, future))
+        return future
+
+    async def sleep(self, seconds):
+        if seconds <= 0.:
+            await asyncio.sleep(0)
+            return
+        await self._sleeper(seconds)
+
+
+def _wake(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class SimulatedClock(VirtualClock):
+    """
+    Virtual time that jumps to the earliest deadline as soon as the event
+    loop has run what was ready, so sleeping costs no wall time; waiting
+    threads advance it by their timeout
+    """
+    async def sleep(self, seconds):
+        if seconds <= 0.:
+            await asyncio.sleep(0)
+            return
+        future = self._sleeper(seconds)
+        asyncio.get_event_loop().call_soon(self._jump)
+        await future
+
+    def _jump(self):
+        with self._lock:
+            while self._sleepers and self._sleepers[0][3].done():
+                # Cancelled sleep
+                heapq.heappop(self._sleepers)
+            if not self._sleepers:
+                return
+            deadline = self._sleepers[0][0]
+        self._advance(deadline)
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self._advance(self.now + timeout)
+            time.sleep(0)
+        return event.is_set()
+
+
+class SteppedClock(VirtualClock):
+    """
+    Virtual time moved only by advance(), e.g. from a test; sleepers and
+    waiting threads resume when it passes their deadline
+    """
+    def advance(self, seconds):
+        """
+        Move the time forward by `seconds` and wake what is due
+        """
+        self._advance(self.now + seconds)
+
+    def wait(self, event, timeout):
+        with self._lock:
+            deadline = self.now + timeout
+            while self.now < deadline and not event.is_set():
+                # The event has no hook into the condition: poll it
+                self._lock.wait(0.01)
+        return event.is_set()
@@ -0,0 +1,652 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Controllers driven by the control loop of control_loops.py
+
+Every mode is an object whose step(measurement, setpoint, state) returns
+the heater moves (Q1, Q2) in %. measurement = (T1, T2) and setpoint =
+(SP_T1, SP_T2) are in Celsius; state is the dict of the run, where the
+loop keeps 't' (time of the sample, s), 'dt' (sampling period, s), 'Q'
+(heater values applied since the last sample) and 'last' (previous
+measurement), and where controllers keep their own state between ticks.
+
+step_batch() does the same for n independent plants at once, with arrays
+(n, 2) of measurements, setpoints, state['Q'] and state['last'].
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import numpy as np
+from gekko import GEKKO
+
+
+class Controller(object):
+    """
+    Base class of the controllers
+
+    `tuning` maps controller attributes to the GUI attributes tune() reads
+    them from (a tuple of names gives one value per heater), so slider
+    changes apply on the next tick. Controllers with `blocking` steps are
+    run off the event loop and report whether they `solved`. Controllers
+    that drive a `single` plant are not run in studies or comparisons.
+    """
+    tuning = {}
+    setpoints = True
+    blocking = False
+    solved = True
+    single = False
+
+    def tune(self, source):
+        """
+        Read the tuning attributes from `source` (a GUI)
+        """
+        for name, keys in self.tuning.items():
+            if isinstance(keys, tuple):
+                setattr(self, name, tuple(getattr(source, k) for k in keys))
+            else:
+                setattr(self, name, getattr(source, keys))
+        return self
+
+    def step(self, measurement, setpoint, state):
+        raise NotImplementedError
+
+    def step_batch(self, measurement, setpoint, state):
+        """
+        Heater moves (n, 2) of n plants; by default each plant is stepped
+        on its own with a state dict kept in state['plants']
+        """
+        n = len(measurement)
+        setpoint = np.broadcast_to(setpoint, (n, 2))
+        plants = state.setdefault('plants', [{} for i in range(n)])
+        Q = np.zeros((n, 2))
+        for i, plant in enumerate(plants):
+            plant.update(t=state['t'], dt=state['dt'],
+                         Q=tuple(state['Q'][i]),
+                         last=tuple(state['last'][i]))
+            Q[i] = self.step(tuple(measurement[i]), tuple(setpoint[i]),
+                             plant)
+        return Q
+
+
+###############################################################################
+#                                                                    OPEN LOOP
+###############################################################################
+class Manual(Controller):
+    """
+    Open loop: heater values set by the user
+    """
+    tuning = {'Q': ('_Q10', '_Q20')}
+    setpoints = False
+
+    def __init__(self, Q=(0., 0.)):
+        self.Q = Q
+
+    def step(self, measurement, setpoint, state):
+        return self.Q
+
+    def step_batch(self, measurement, setpoint, state):
+        return np.tile(np.asarray(self.Q, dtype=float), (len(measurement), 1))
+
+
+###############################################################################
+#                                                                       ON-OFF
+###############################################################################
+class OnOff(Controller):
+    """
+    Full heater below the setpoint minus the deadband, off above the
+    setpoint plus the deadband, unchanged in between
+    """
+    tuning = {'deadband': ('_q1_dt_on_off', '_q2_dt_on_off')}
+
+    def __init__(self, deadband=(0.1, 0.1)):
+        self.deadband = deadband
+
+    def step(self, measurement, setpoint, state):
+        Q = list(state['Q'])
+        for i in (0, 1):
+            if measurement[i] < (setpoint[i] - self.deadband[i]):
+                Q[i] = 100.0
+            elif measurement[i] > (setpoint[i] + self.deadband[i]):
+                Q[i] = 0.0
+        return tuple(Q)
+
+    def step_batch(self, measurement, setpoint, state):
+        Q = np.array(state['Q'], dtype=float)
+        deadband = np.asarray(self.deadband)
+        Q[measurement < setpoint - deadband] = 100.0
+        Q[measurement > setpoint + deadband] = 0.0
+        return Q
+
+
+###############################################################################
+#                                                               PID CONTROLLER
+###############################################################################
+
+class PIDBank(object):
+    """
+    `n` PID loops computed together: gains, integral errors and prior
+    measurements are arrays, and one step() updates every loop with
+    vectorized clipping and anti-reset windup
+
+    Per loop, with KI = Kc/tauI (1e5 if tauI is 0) and KD = Kc*tauD:
+
+        ierr = ierr + KI*(sp - pv)*dt
+        op = op0 + Kc*(sp - pv) + ierr - KD*(pv - pv_last)/dt
+
+    and where op leaves [oplo, ophi] it is clipped and the integration of
+    this step is undone.
+    """
+    def __init__(self, n, Kc=10., tauI=50., tauD=1., op0=0., oplo=0.,
+                 ophi=100.):
+        """
+        n = number of loops
+        Kc, tauI, tauD = gain (%/K), reset time (s) and rate time (s),
+                         scalars or arrays of n values
+        op0 = output bias (initial heater, %)
+        oplo, ophi = bounds of the output (%)
+        """
+        self.n = n
+        self.Kc = np.zeros(n)
+        self.tauI = np.zeros(n)
+        self.tauD = np.zeros(n)
+        self.op0 = op0
+        self.oplo = oplo
+        self.ophi = ophi
+        self.ierr = np.zeros(n)
+        self.pv_last = np.zeros(n)
+        self._primed = False
+        self._KI = np.zeros(n)
+        self._KD = np.zeros(n)
+        self._error = np.zeros(n)
+        self._dI = np.zeros(n)
+        self._op = np.zeros(n)
+        self._low = np.zeros(n, dtype=bool)
+        self._high = np.zeros(n, dtype=bool)
+        self.gains(Kc, tauI, tauD)
+
+    def gains(self, Kc=None, tauI=None, tauD=None):
+        """
+        Change the tuning of every loop (None keeps the current values)
+        """
+        if Kc is not None:
+            self.Kc[:] = Kc
+        if tauI is not None:
+            self.tauI[:] = tauI
+        if tauD is not None:
+            self.tauD[:] = tauD
+        reset = self.tauI == 0
+        self._KI[:] = 1e5
+        np.divide(self.Kc, self.tauI, out=self._KI, where=~reset)
+        np.multiply(self.Kc, self.tauD, out=self._KD)
+
+    def reset(self, pv=None, ierr=0.):
+        """
+        Clear the integral errors and set the prior measurements (None
+        takes the measurements of the first step: no derivative kick)
+        """
+        self.ierr[:] = ierr
+        if pv is None:
+            self._primed = False
+        else:
+            self.pv_last[:] = pv
+            self._primed = True
+
+    def step(self, sp, pv, dt):
+        """
+        Return the outputs of every loop for setpoints `sp` and
+        measurements `pv` (scalars or arrays of n values) after `dt` s
+        """
+        if not self._primed:
+            self.pv_last[:] = pv
+            self._primed = True
+        error = np.subtract(sp, pv, out=self._error)
+
+        # integral error
+        dI = np.multiply(self._KI, error, out=self._dI)
+        dI *= dt
+        self.ierr += dI
+
+        # P + I + D, the derivative acting on the measurement
+        op = np.subtract(self.pv_last, pv, out=self._op)
+        op *= self._KD
+        op /= dt
+        error *= self.Kc
+        op += error
+        op += self.ierr
+        op += self.op0
+        self.pv_last[:] = pv
+
+        # anti-reset windup and clipping
+        low = np.less(op, self.oplo, out=self._low)
+        high = np.greater(op, self.ophi, out=self._high)
+        low |= high
+        np.subtract(self.ierr, dI, out=self.ierr, where=low)
+        np.maximum(op, self.oplo, out=op)
+        np.minimum(op, self.ophi, out=op)
+        return op.copy()
+
+
+class Schedule(object):
+    """
+    Gain schedule: PID tuning of each heater at evenly spaced operating
+    points, linearly interpolated (clamped at both ends) in O(1)
+    """
+    def __init__(self, points, gains):
+        """
+        points = operating temperatures (C), evenly spaced and increasing
+        gains = array (len(points), 2, 3) of (Kc, tauI, tauD) per heater
+        """
+        self.points = np.asarray(points, dtype=float)
+        self.gains = np.asarray(gains, dtype=float)
+        if len(self.points) < 2:
+            raise ValueError('A schedule needs at least two points')
+        self._x0 = self.points[0]
+        self._dx = (self.points[-1] - self.points[0])/max(len(points) - 1, 1)
+        self._last = max(len(points) - 2, 0)
+
+    def __call__(self, x):
+        """
+        Return the (Kc, tauI, tauD) of each heater (array (2, 3)) at the
+        operating temperatures x = (x1, x2), or (n, 2, 3) at x (n, 2)
+        """
+        f = (np.asarray(x, dtype=float) - self._x0)/(self._dx or 1.)
+        f = np.clip(f, 0., self._last + 1.)
+        i = np.minimum(f.astype(int), self._last)
+        w = (f - i)[..., None]
+        heater = np.arange(2)
+        return (1. - w)*self.gains[i, heater] + w*self.gains[i + 1, heater]
+
+    def save(self, path):
+        np.savez(path, points=self.points, gains=self.gains)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['points'], data['gains'])
+
+
+class PID(Controller):
+    """
+    One PID per heater, stepped together by a PIDBank kept in
+    state['pid'] (retuned only when the tuning changes)
+
+    With a `schedule`, the gains are looked up on every tick at the
+    measurement (schedule_by 'PV') or the setpoint ('Setpoint') instead.
+    """
+    tuning = {'Kc': ('_pid1_gain', '_pid2_gain'),
+              'tauI': ('_pid1_reset', '_pid2_reset'),
+              'tauD': ('_pid1_rate', '_pid2_rate'),
+              'schedule': '_pid_schedule',
+              'schedule_by': '_pid_schedule_by'}
+
+    def __init__(self, Kc=(10., 10.), tauI=(50., 50.), tauD=(1., 1.),
+                 schedule=None, schedule_by='PV'):
+        self.Kc = Kc
+        self.tauI = tauI
+        self.tauD = tauD
+        self.schedule = schedule
+        self.schedule_by = schedule_by
+
+    def step(self, measurement, setpoint, state):
+        Q = self.step_batch(np.array([measurement]), np.array([setpoint]),
+                            state)
+        return Q[0, 0], Q[0, 1]
+
+    def step_batch(self, measurement, setpoint, state):
+        n = len(measurement)
+        setpoint = np.broadcast_to(setpoint, (n, 2))
+        bank = state.get('pid')
+        if bank is None:
+            bank = state['pid'] = PIDBank(2*n)
+            bank.reset(np.ravel(state['last']))
+        if self.schedule is not None:
+            gains = self.schedule(measurement if self.schedule_by == 'PV'
+                                  else setpoint)
+            bank.gains(gains[..., 0].ravel(), gains[..., 1].ravel(),
+                       gains[..., 2].ravel())
+            state['pid_tuning'] = None
+        else:
+            tuning = (self.Kc, self.tauI, self.tauD)
+            if state.get('pid_tuning') != tuning:
+                bank.gains(*(np.tile(value, n) for value in tuning))
+                state['pid_tuning'] = tuning
+        Q = bank.step(setpoint.ravel(), np.ravel(measurement), state['dt'])
+        return Q.reshape(n, 2)
+
+
+###############################################################################
+#                                                          RELAY AUTOTUNING
+###############################################################################
+
+# PID settings from the ultimate gain and period of a relay test
+RULES = {
+    'ziegler-nichols': lambda Ku, Pu: (0.6*Ku, Pu/2., Pu/8.),
+    'tyreus-luyben': lambda Ku, Pu: (Ku/2.2, 2.2*Pu, Pu/6.3),
+}
+
+
+class Relay(OnOff):
+    """
+    Relay feedback test: the On-Off controller of each heater, whose limit
+    cycle is measured as it runs
+
+    Upward crossings of the setpoint (interpolated between samples) delimit
+    the cycles; each gives a period and an amplitude (half the peak to
+    peak measurement), kept in state['relay']. A crossing only counts
+    after the measurement went below the setpoint minus the deadband, so
+    sensor noise around the setpoint does not split cycles.
+    """
+    def __init__(self, deadband=(0.1, 0.1), cycles=3):
+        """
+        cycles = number of cycles measured per heater, after a first one
+                 discarded as transient
+        """
+        OnOff.__init__(self, deadband)
+        self.cycles = cycles
+
+    # The cycles are measured plant by plant
+    step_batch = Controller.step_batch
+
+    def step(self, measurement, setpoint, state):
+        Q = OnOff.step(self, measurement, setpoint, state)
+        relay = state.setdefault('relay', [
+            {'e': None, 'armed': False, 'up': None, 'hi': -np.inf,
+             'lo': np.inf, 'periods': [], 'amplitudes': []} for i in (0, 1)])
+        t = state['t']
+        for i, r in enumerate(relay):
+            e = measurement[i] - setpoint[i]
+            r['hi'] = max(r['hi'], measurement[i])
+            r['lo'] = min(r['lo'], measurement[i])
+            if e < -self.deadband[i]:
+                r['armed'] = True
+            if r['armed'] and r['e'] is not None and r['e'] <= 0. < e:
+                crossing = r['t'] + (t - r['t'])*(-r['e'])/(e - r['e'])
+                if r['up'] is not None:
+                    r['periods'].append(crossing - r['up'])
+                    r['amplitudes'].append((r['hi'] - r['lo'])/2.)
+                r['up'] = crossing
+                r['armed'] = False
+                r['hi'] = -np.inf
+                r['lo'] = np.inf
+            r['e'] = e
+            r['t'] = t
+        return Q
+
+    def estimate(self, state):
+        """
+        Return ((Ku1, Pu1), (Ku2, Pu2)) once every heater has completed
+        its cycles, None before
+        """
+        relay = state.get('relay')
+        if relay is None or any(len(r['periods']) < self.cycles + 1
+                                for r in relay):
+            return None
+        result = []
+        for i, r in enumerate(relay):
+            # Describing function of a relay of amplitude d (half the 0-100 %
+            # swing) with hysteresis
+            d = 50.
+            a = np.mean(r['amplitudes'][1:])
+            eps = min(self.deadband[i], 0.99*a)
+            Ku = 4.*d/(np.pi*np.sqrt(a**2 - eps**2))
+            result.append((float(Ku), float(np.mean(r['periods'][1:]))))
+        return tuple(result)
+
+
+class Autotune(Controller):
+    """
+    Relay test of both heaters followed, in the same run, by PID control
+    with the gains derived from it
+
+    The PID runs with the gains computed, which are also loaded into the
+    GUI with set_pid() on the next tick for display (PID mode then starts
+    from them). The sliders clip what they show to their ranges:
+    `result` holds Ku, Pu, the gains of each heater, the gains `loaded`
+    into the GUI and whether they were `clipped`.
+    """
+    tuning = {'deadband': ('_q1_dt_on_off', '_q2_dt_on_off')}
+    # The gains it finds are loaded into the GUI
+    single = True
+
+    def __init__(self, deadband=(0.1, 0.1), cycles=3,
+                 rule='ziegler-nichols'):
+        """
+        deadband = relay hysteresis of each heater (C)
+        cycles = limit cycles measured per heater
+        rule = key of RULES converting Ku and Pu to (Kc, tauI, tauD)
+        """
+        self.deadband = deadband
+        self.relay = Relay(deadband, cycles)
+        self.rule = rule
+        self.pid = None
+        self.result = None
+        self._loaded = False
+
+    def tune(self, source):
+        if self.result is None:
+            Controller.tune(self, source)
+            self.relay.deadband = self.deadband
+        elif not self._loaded:
+            # Display only: the PID keeps the gains computed, which may be
+            # outside the slider ranges
+            loaded = source.set_pid(*self.result['gains'])
+            self.result['loaded'] = loaded
+            self.result['clipped'] = not np.allclose(loaded,
+                                                     self.result['gains'])
+            self._loaded = True
+        return self
+
+    def step(self, measurement, setpoint, state):
+        if self.pid is not None:
+            return self.pid.step(measurement, setpoint, state)
+        Q = self.relay.step(measurement, setpoint, state)
+        estimate = self.relay.estimate(state)
+        if estimate is not None:
+            gains = tuple(RULES[self.rule](Ku, Pu) for Ku, Pu in estimate)
+            self.result = {'Ku': tuple(Ku for Ku, Pu in estimate),
+                           'Pu': tuple(Pu for Ku, Pu in estimate),
+                           'gains': gains, 't': state['t']}
+            self.pid = PID(*zip(*gains))
+        return Q
+
+
+###############################################################################
+#                                                                          MPC
+###############################################################################
+def mpc_model():
+    # GEKKO model of the TCLab for the MPC controller
+    m = GEKKO(remote=False)
+
+    # 60 second time horizon, 4 sec cycle time, non-uniform
+    m.time = [0, 4, 8, 12, 15, 20, 25, 30, 35, 40, 50, 60, 70, 80, 90]
+
+    # Parameters
+    m.U = m.FV(value=10)
+    m.tau = m.FV(value=5)
+    m.alpha1 = m.FV(value=0.01)    # W / % heater
+    m.alpha2 = m.FV(value=0.0075)  # W / % heater
+
+    # Manipulated variables
+    m.Q1 = m.MV(value=0)
+    m.Q1.STATUS = 1   # use to control temperature
+    m.Q1.FSTATUS = 0  # no feedback measurement
+    m.Q1.LOWER = 0.0
+    m.Q1.UPPER = 100.0
+    m.Q1.DMAX = 20.0
+    m.Q1.COST = 0.0
+    m.Q1.DCOST = 2.0
+
+    m.Q2 = m.MV(value=0)
+    m.Q2.STATUS = 1   # use to control temperature
+    m.Q2.FSTATUS = 0  # no feedback measurement
+    m.Q2.LOWER = 0.0
+    m.Q2.UPPER = 100.0
+    m.Q2.DMAX = 20.0
+    m.Q2.COST = 0.0
+    m.Q2.DCOST = 2.0
+
+    # Controlled variable
+    m.TC1 = m.CV(value=22)
+    m.TC1.STATUS = 1     # minimize error with setpoint range
+    m.TC1.FSTATUS = 1    # receive measurement
+    m.TC1.TR_INIT = 1    # reference trajectory
+    m.TC1.TAU = 10       # time constant for response
+
+    # Controlled variable
+    m.TC2 = m.CV(value=22)
+    m.TC2.STATUS = 1     # minimize error with setpoint range
+    m.TC2.FSTATUS = 1    # receive measurement
+    m.TC2.TR_INIT = 1    # reference trajectory
+    m.TC2.TAU = 10       # time constant for response
+
+    # State variables
+    m.TH1 = m.SV(value=22)
+    m.TH2 = m.SV(value=22)
+
+    m.Ta = m.Param(value=23.0+273.15)     # K
+    m.mass = m.Param(value=4.0/1000.0)    # kg
+    m.Cp = m.Param(value=0.5*1000.0)      # J/kg-K
+    m.A = m.Param(value=10.0/100.0**2)    # Area not between heaters in m^2
+    m.As = m.Param(value=2.0/100.0**2)    # Area between heaters in m^2
+    m.eps = m.Param(value=0.9)            # Emissivity
+    m.sigma = m.Const(5.67e-8)            # Stefan-Boltzmann
+
+    # Heater temperatures
+    m.T1i = m.Intermediate(m.TH1+273.15)
+    m.T2i = m.Intermediate(m.TH2+273.15)
+
+    # Heat transfer between two heaters
+    m.Q_C12 = m.Intermediate(m.U*m.As*(m.T2i-m.T1i))  # Conv
+    m.Q_R12 = m.Intermediate(m.eps*m.sigma*m.As*(m.T2i**4-m.T1i**4))  # Rad
+
+    # Semi-fundamental correlations (energy balances)
+    m.Equation(m.TH1.dt() == (1.0/(m.mass*m.Cp)) *
+                             (m.U*m.A*(m.Ta-m.T1i) +
+                              m.eps * m.sigma * m.A *
+                              (m.Ta**4 - m.T1i**4) + m.Q_C12 +
+                              m.Q_R12 + m.alpha1*m.Q1))
+
+    m.Equation(m.TH2.dt() == (1.0/(m.mass*m.Cp)) *
+                             (m.U*m.A*(m.Ta-m.T2i) +
+                              m.eps * m.sigma * m.A *
+                              (m.Ta**4 - m.T2i**4) - m.Q_C12 -
+                              m.Q_R12 + m.alpha2*m.Q2))
+
+    # Empirical correlations (lag equations to emulate conduction)
+    m.Equation(m.tau * m.TC1.dt() == -m.TC1 + m.TH1)
+    m.Equation(m.tau * m.TC2.dt() == -m.TC2 + m.TH2)
+
+    # Global Options
+    m.options.IMODE = 6    # MPC
+    m.options.CV_TYPE = 1  # Objective type
+    m.options.NODES = 3    # Collocation nodes
+    m.options.SOLVER = 3   # 1=APOPT, 3=IPOPT
+
+    return m
+
+
+class MPC(Controller):
+    """
+    GEKKO model predictive controller of both heaters, built on the first
+    step and kept in state['model']; a failed solve keeps the previous
+    heater values
+    """
+    tuning = {'solver': '_SOLVER', 'cv_type': '_CVTYPE',
+              'tau': ('_T1_tau', '_T2_tau'), 'deadband': ('_T1_dt', '_T2_dt'),
+              'dmax': ('_Q1_DMAX', '_Q2_DMAX'),
+              'dcost': ('_Q1_DCOST', '_Q2_DCOST')}
+    blocking = True
+
+    def __init__(self, solver='1 - APOPT', cv_type='1 - Deadband',
+                 tau=(10., 10.), deadband=(0.1, 0.1), dmax=(30., 30.),
+                 dcost=(1., 1.)):
+        self.solver = solver
+        self.cv_type = cv_type
+        self.tau = tau
+        self.deadband = deadband
+        self.dmax = dmax
+        self.dcost = dcost
+
+    def step(self, measurement, setpoint, state):
+        if 'model' not in state:
+            state['model'] = mpc_model()
+        m = state['model']
+
+        # Change SOLVER
+        if self.solver == '1 - APOPT':
+            m.options.SOLVER = 1
+        elif self.solver == '2 - BPOPT':
+            m.options.SOLVER = 2
+        else:
+            m.options.SOLVER = 3
+
+        # Change CVTYPE
+        if self.cv_type == '1 - Deadband':
+            m.options.CV_TYPE = 1
+        else:
+            m.options.CV_TYPE = 2
+
+        # Add measurements to the MPC
+        m.TC1.MEAS = measurement[0]
+        m.TC2.MEAS = measurement[1]
+
+        # Update Parameters
+        m.TC1.TAU = self.tau[0]
+        m.TC2.TAU = self.tau[1]
+
+        m.Q1.DMAX = self.dmax[0]
+        m.Q1.DCOST = self.dcost[0]
+        m.Q2.DMAX = self.dmax[1]
+        m.Q2.DCOST = self.dcost[1]
+
+        # Update prediction horizon
+        DT = state['dt']
+        m.time = [
+            0,
+            DT,
+            DT*2,
+            DT*3,
+            DT*4,
+            DT*5,
+            DT*6,
+            DT*7,
+            DT*8,
+            DT*10,
+            DT*12,
+            DT*15,
+            DT*18,
+            DT*20,
+            DT*25]
+
+        if m.options.CV_TYPE == 1:
+            # Input setpoint with deadband +/- DT
+            DT1 = self.deadband[0]
+            m.TC1.SPHI = setpoint[0] + DT1
+            m.TC1.SPLO = setpoint[0] - DT1
+
+            DT2 = self.deadband[1]
+            m.TC2.SPHI = setpoint[1] + DT2
+            m.TC2.SPLO = setpoint[1] - DT2
+        else:
+            m.TC1.SP = setpoint[0]
+            m.TC2.SP = setpoint[1]
+
+        self.solved = False
+        try:
+            # Solve MPC
+            m.solve(disp=False)
+            # Check if successful solution
+            if (m.options.APPSTATUS == 1):
+                self.solved = True
+                # retrieve new value
+                return m.Q1.NEWVAL, m.Q2.NEWVAL
+        except Exception:
+            # Keep previous value
+            pass
+        return state['Q']
+
+
+# Controller of each mode of the GUIs
+CONTROLLERS = {'Manual': Manual, 'On-Off': OnOff, 'PID': PID, 'MPC': MPC,
+               'Autotune': Autotune}
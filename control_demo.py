@@ -11,22 +11,103 @@ Created on Wed Jan 23 19:02:13 2019
 from __future__ import print_function, division
 from ipywidgets import widgets as wi
 from IPython.display import display
-import threading
+import asyncio
+import functools
 import time
 import numpy as np
-from gekko import GEKKO
-from scipy.integrate import odeint
 import bqplot as bq
+from control_perf import PhaseProfiler, TraceRecorder, LoopMetrics
+from control_perf import register_metrics, start_metrics_server
+from control_engine import LoopRunner
+from control_clock import REAL
+from control_process import ProcessEngine
+from control_backend import SimBackend
+from control_loops import ControlLoops
+from control_controllers import CONTROLLERS
+from control_study import kpis, check_modes
 
+# Real-time factors of the General Options tab (None: as fast as possible)
+FACTORS = {'0.5x': 0.5, '1x': 1., '10x': 10., 'max': None}
 
-class GUI(object):
+
+class GUI(ControlLoops):
     """
     Class that defines the _GUI applications
     """
-    def __init__(self):
+    def __init__(self, runner=None, headless=False, clock=None):
         """
         Initialize the _GUI elements
+
+        runner = control_engine.LoopRunner executing the loops (defaults to
+                 a dedicated event loop thread shared by all GUIs)
+        headless = only set up the simulation engine, without widgets
+        clock = control_clock clock pacing the loops (default wall clock)
         """
+        #######################################################################
+        #                                                           PARAMETERS
+        #######################################################################
+        self._delta_t = 4.0
+        self._maxtime = int(500/self._delta_t)
+        self._Th0 = np.array([293.15, 293.15])
+        self._Tc0 = np.array([293.15, 293.15])
+        self._T1_SP = 30
+        self._T2_SP = 30
+        self._Q10 = 0
+        self._Q20 = 0
+        self._factor = 10.
+        self._run = None
+        self._runner = runner or LoopRunner.default()
+        self._clock = clock or REAL
+        self._snapshot = None
+        self._backend = None
+        self._controller = None
+        self._replay = None
+        self._comparison = None
+        self._compare_snapshot = None
+        self._render_period = 0.1
+        self._subprocess = False
+
+        # The simulated sensors are noisy (+/-0.5 C), so a tighter deadband
+        # makes the On-Off heaters chatter
+        self._q1_dt_on_off = 0.5
+        self._q2_dt_on_off = 0.5
+
+        self._pid1_gain = 10.
+        self._pid1_reset = 50.
+        self._pid1_rate = 1.
+
+        self._pid2_gain = 10.
+        self._pid2_reset = 50.
+        self._pid2_rate = 1.
+
+        self._pid_schedule = None
+        self._pid_schedule_by = 'PV'
+        self._schedule = None
+
+        self._SOLVER = '1 - APOPT'
+        self._CVTYPE = '1 - Deadband'
+
+        self._T1_dt = 0.1
+        self._T1_tau = 10.
+        self._T2_dt = 0.1
+        self._T2_tau = 10.
+
+        self._Q1_DMAX = 30.
+        self._Q1_DCOST = 1.
+        self._Q2_DMAX = 30.
+        self._Q2_DCOST = 1.
+
+        self._profiler = PhaseProfiler(['read', 'control', 'write',
+                                        'bookkeeping', 'widgets', 'sleep',
+                                        'solve'])
+        self._perf_ticks = 0
+        self._metrics = LoopMetrics()
+        self._metrics.clock = self._clock
+
+        if headless:
+            # Engine only (e.g. in a subprocess), no widgets
+            return
+
         #######################################################################
         #                                               PLOTTING CONFIGURATION
         #######################################################################
@@ -121,44 +202,6 @@ class GUI(object):
         self._SP_T1 = np.array([])
         self._SP_T2 = np.array([])
 
-        #######################################################################
-        #                                                           PARAMETERS
-        #######################################################################
-        self._delta_t = 4.0
-        self._maxtime = int(500/self._delta_t)
-        self._Th0 = np.array([293.15, 293.15])
-        self._Tc0 = np.array([293.15, 293.15])
-        self._T1_SP = 30
-        self._T2_SP = 30
-        self._Q10 = 0
-        self._Q20 = 0
-        self._flag = False
-        self._sleep = 0.5
-
-        self._q1_dt_on_off = 0.1
-        self._q2_dt_on_off = 0.1
-
-        self._pid1_gain = 10.
-        self._pid1_reset = 50.
-        self._pid1_rate = 1.
-
-        self._pid2_gain = 10.
-        self._pid2_reset = 50.
-        self._pid2_rate = 1.
-
-        self._SOLVER = '1 - APOPT'
-        self._CVTYPE = '1 - Deadband'
-
-        self._T1_dt = 0.1
-        self._T1_tau = 10.
-        self._T2_dt = 0.1
-        self._T2_tau = 10.
-
-        self._Q1_DMAX = 30.
-        self._Q1_DCOST = 1.
-        self._Q2_DMAX = 30.
-        self._Q2_DCOST = 1.
-
         #######################################################################
         #                                              OUTPUT WIDGETS CRIATION
         #######################################################################
@@ -253,10 +296,15 @@ class GUI(object):
         self._mode = wi.ToggleButtons(options=['Manual',
                                                'On-Off',
                                                'PID',
-                                               'MPC'],
+                                               'MPC',
+                                               'Autotune'],
                                       style={'button_width': '100px'})
         self._mode.observe(self._mode_switch, names='value')
 
+        # Requested and achieved real-time factor
+        self._speed = wi.HTML(value=self._speed_html(),
+                              layout=wi.Layout(width='165px'))
+
         #######################################################################
         #                                                          STOP THREAD
         #######################################################################
@@ -275,7 +323,7 @@ class GUI(object):
 
         # Join Buttons
         buttons = wi.HBox((self._b_play, h_space, self._b_stop,
-                           wi.Label(value="", layout=wi.Layout(width='165px')),
+                           self._speed,
                            self._mode))
 
         #######################################################################
@@ -332,10 +380,10 @@ class GUI(object):
 
         self._conf12 = wi.HBox((
             wi.HTML(value='<p style="text-align: right;">'
-                          '<b>Sleep time (s):</b></p>',
+                          '<b>Real-time factor:</b></p>',
                     layout=lay),
-            wi.FloatSlider(value=0.5, min=0.25, max=1.5, step=0.05,
-                           description='', style=style)))
+            wi.ToggleButtons(options=list(FACTORS), value='10x',
+                             style={'button_width': '60px'})))
 
         but11 = wi.Button(description='Apply', icon='check',
                           layout=wi.Layout(width='100px', height='32px'))
@@ -345,6 +393,13 @@ class GUI(object):
                           layout=wi.Layout(width='100px', height='32px'))
         but12.on_click(self._reset_general)
 
+        self._conf14 = wi.HBox((
+            wi.HTML(value='<p style="text-align: right;">'
+                          '<b>Engine:</b></p>',
+                    layout=lay),
+            wi.Checkbox(value=False, description='Run in a subprocess',
+                        style=style)))
+
         conf13 = wi.HBox((but11, but12), layout=wi.Layout(margin='10px 0 0 0'))
 
         #######################################################################
@@ -360,7 +415,7 @@ class GUI(object):
             wi.HTML(value='<p style="text-align: right;">'
                           '<b>Deadband (K):</b></p>',
                     layout=lay5),
-            wi.FloatSlider(value=0.1, min=0.0, max=2.0, step=0.1,
+            wi.FloatSlider(value=0.5, min=0.0, max=2.0, step=0.1,
                            description='', style=style,
                            layout=wi.Layout(width='200px'))),
             layout=wi.Layout(margin='5px 0 0 0')
@@ -379,7 +434,7 @@ class GUI(object):
             wi.HTML(value='<p style="text-align: right;">'
                           '<b>Deadband (K):</b></p>',
                     layout=lay5),
-            wi.FloatSlider(value=0.1, min=0.0, max=2.0, step=0.1,
+            wi.FloatSlider(value=0.5, min=0.0, max=2.0, step=0.1,
                            description='', style=style,
                            layout=wi.Layout(width='200px'))),
             layout=wi.Layout(margin='5px 0 0 0')
@@ -471,6 +526,19 @@ class GUI(object):
                                          width='335px',
                                          margin='10px 0 0 10px'))
 
+        self._conf39 = wi.HBox((
+            wi.Checkbox(value=False, description='Gain scheduling by',
+                        indent=False, layout=wi.Layout(width='150px')),
+            wi.Dropdown(options=['PV', 'Setpoint'], value='PV',
+                        layout=wi.Layout(width='100px')),
+            wi.Button(description='Generate table', icon='table',
+                      layout=wi.Layout(width='140px', height='32px',
+                                       margin='0 0 0 20px')),
+            wi.HTML(value=self._schedule_html(),
+                    layout=wi.Layout(margin='0 0 0 10px'))),
+            layout=wi.Layout(margin='10px 0 0 0'))
+        self._conf39.children[2].on_click(self._generate_schedule)
+
         but31 = wi.Button(description='Apply', icon='check',
                           layout=wi.Layout(width='100px', height='32px'))
         but31.on_click(self._conf_pid)
@@ -613,28 +681,50 @@ class GUI(object):
         conf413 = wi.HBox((but41, but42),
                           layout=wi.Layout(margin='10px 0 0 0'))
 
+        #######################################################################
+        #                                                  PERFORMANCE OPTIONS
+        #######################################################################
+        self._conf51 = wi.Checkbox(value=self._profiler.enabled,
+                                   description='Phase profiling enabled',
+                                   style=style)
+        self._conf51.observe(self._conf_perf, names='value')
+
+        self._conf52 = wi.HTML(value=self._profiler.html(),
+                               layout=wi.Layout(height='230px'))
+
+        but51 = wi.Button(description='Refresh', icon='refresh',
+                          layout=wi.Layout(width='100px', height='32px'))
+        but51.on_click(self._refresh_perf)
+        but52 = wi.Button(description='Reset', icon='trash',
+                          layout=wi.Layout(width='100px', height='32px'))
+        but52.on_click(self._reset_perf)
+        conf53 = wi.HBox((but51, but52),
+                         layout=wi.Layout(margin='10px 0 0 0'))
+
         #######################################################################
         #                                                  CONFIGURATOR LAYOUT
         #######################################################################
-        tab = wi.Tab([wi.VBox((self._conf11, self._conf12,
-                               wi.Label(layout=wi.Layout(height='206px')),
+        tab = wi.Tab([wi.VBox((self._conf11, self._conf12, self._conf14,
+                               wi.Label(layout=wi.Layout(height='170px')),
                                conf13)),
                       wi.VBox((wi.HBox((box21, box22)),
                                wi.Label(layout=wi.Layout(height='191px')),
                                conf24)),
-                      wi.VBox((wi.HBox((box31, box32)),
-                               wi.Label(layout=wi.Layout(height='127px')),
+                      wi.VBox((wi.HBox((box31, box32)), self._conf39,
+                               wi.Label(layout=wi.Layout(height='85px')),
                                conf38)),
                       wi.VBox((self._conf40,
                                wi.HBox((box41, box43)),
                                wi.HBox((box42, box44)),
                                wi.Label(layout=wi.Layout(height='11px')),
-                               conf413))],
+                               conf413)),
+                      wi.VBox((self._conf51, self._conf52, conf53))],
                      layout=wi.Layout(width='800px', height='380px'))
         tab.set_title(0, 'General Options')
         tab.set_title(1, 'On-Off Options')
         tab.set_title(2, 'PID Options')
         tab.set_title(3, 'MPC Options')
+        tab.set_title(4, 'Performance')
 
         #######################################################################
         #                                                 DISPLAY CONFIGURATOR
@@ -647,19 +737,119 @@ class GUI(object):
     def config(self):
         display(self._conf)
 
+    def compare(self, modes=('Manual', 'On-Off', 'PID', 'MPC'), seed=0):
+        """
+        Run `modes` side by side on clones of the simulated plant that
+        share one seeded disturbance and noise realization, with the
+        setpoints, heater values and tuning of the app (Stop ends the
+        run); returns the dashboard overlaying their traces
+        """
+        check_modes(modes)
+        if self._run is not None and not self._run.stopped:
+            self._run.stop()
+        for widget in (self._wQ1, self._tQ1, self._bQ1, self._wT1,
+                       self._tT1, self._bT1, self._wQ2, self._tQ2,
+                       self._bQ2, self._wT2, self._tT2, self._bT2):
+            widget.disabled = False
+        self._mode.disabled = True
+        self._compare_snapshot = None
+        self._speed.value = self._speed_html()
+        dashboard = self._compare_dashboard(modes)
+        self._run = self._runner.start(
+            functools.partial(self._work_compare, modes, seed),
+            functools.partial(self._render_compare, modes),
+            previous=self._run)
+        return dashboard
+
+    def _compare_dashboard(self, modes):
+        # One figure per variable with a line per mode
+        palette = ['#7f7f7f', '#2ca02c', '#1f77b4', '#d62728', '#9467bd',
+                   '#ff7f0e']
+        colors = [palette[i % len(palette)] for i in range(len(modes))]
+        t_sc = bq.LinearScale()
+        T_sc = bq.LinearScale(min=20., max=60.)
+        Q_sc = bq.LinearScale(min=0., max=100.)
+        figures = []
+        self._compare_lines = []
+        self._compare_sp = []
+        for label, scale in (('T1 [C]', T_sc), ('T2 [C]', T_sc),
+                             ('Q1 [%]', Q_sc), ('Q2 [%]', Q_sc)):
+            scales = {'x': t_sc, 'y': scale}
+            lines = bq.Lines(x=[], y=[], scales=scales, colors=colors,
+                             stroke_width=2, labels=list(modes),
+                             display_legend=label == 'T1 [C]')
+            marks = [lines]
+            if scale is T_sc:
+                sp = bq.Lines(x=[], y=[], scales=scales, colors=['black'],
+                              line_style='dashed',
+                              interpolation='step-before')
+                self._compare_sp.append(sp)
+                marks.append(sp)
+            self._compare_lines.append(lines)
+            axes = [bq.Axis(label='time [min]', scale=t_sc),
+                    bq.Axis(label=label, scale=scale,
+                            orientation='vertical')]
+            figures.append(bq.Figure(
+                axes=axes, marks=marks, legend_location='top-left',
+                layout=wi.Layout(width='400px', height='240px'),
+                fig_margin=dict(top=10, bottom=40, left=60, right=10)))
+        self._compare_table = wi.HTML()
+        return wi.VBox((wi.HBox(figures[:2]), wi.HBox(figures[2:]),
+                        self._compare_table))
+
+    def profile(self, enabled=None):
+        """
+        Return the loop phase timings, optionally switching profiling on/off
+        """
+        if enabled is not None:
+            self._conf51.value = bool(enabled)
+        return self._profiler.summary()
+
+    def serve_metrics(self, port=9100, name=None):
+        """
+        Serve loop, solver and I/O metrics in Prometheus format on localhost
+        """
+        if name is not None:
+            self._metrics.name = name
+        register_metrics(self._metrics)
+        server = start_metrics_server(port)
+        return 'http://{}:{}/metrics'.format(*server.server_address)
+
+    def trace_start(self, capacity=200000):
+        """
+        Start recording loop phase events into a preallocated trace buffer
+        """
+        self._profiler.tracer = TraceRecorder(capacity)
+        self._conf51.value = True
+
+    def trace_stop(self, path='tclab_trace.json'):
+        """
+        Stop tracing and dump the events as Chrome Trace Event JSON
+        """
+        tracer = self._profiler.tracer
+        self._profiler.tracer = None
+        if tracer is None:
+            return None
+        return tracer.dump(path)
+
     def _conf_general(self, b):
         self._delta_t = self._conf11.children[1].value
         self._maxtime = int(500/self._delta_t)
 
-        self._sleep = self._conf12.children[1].value
+        self._factor = FACTORS[self._conf12.children[1].value]
+
+        self._subprocess = self._conf14.children[1].value
 
     def _reset_general(self, b):
         self._conf11.children[1].value = 4.0
         self._delta_t = self._conf11.children[1].value
         self._maxtime = int(500/self._delta_t)
 
-        self._conf12.children[1].value = 0.5
-        self._sleep = self._conf12.children[1].value
+        self._conf12.children[1].value = '10x'
+        self._factor = FACTORS[self._conf12.children[1].value]
+
+        self._conf14.children[1].value = False
+        self._subprocess = self._conf14.children[1].value
 
     def _conf_on_off(self, b):
         self._q1_dt_on_off = self._conf21.children[1].value
@@ -667,10 +857,10 @@ class GUI(object):
         self._q2_dt_on_off = self._conf23.children[1].value
 
     def _reset_on_off(self, b):
-        self._conf21.children[1].value = 0.1
+        self._conf21.children[1].value = 0.5
         self._q1_dt_on_off = self._conf21.children[1].value
 
-        self._conf23.children[1].value = 0.1
+        self._conf23.children[1].value = 0.5
         self._q2_dt_on_off = self._conf23.children[1].value
 
     def _conf_pid(self, b):
@@ -682,6 +872,10 @@ class GUI(object):
         self._pid2_reset = self._conf36.children[1].value
         self._pid2_rate = self._conf37.children[1].value
 
+        self._pid_schedule_by = self._conf39.children[1].value
+        self._pid_schedule = (self._schedule
+                              if self._conf39.children[0].value else None)
+
     def _reset_pid(self, b):
         self._conf31.children[1].value = 10.0  # gain
         self._conf32.children[1].value = 50.0  # reset
@@ -695,7 +889,10 @@ class GUI(object):
         self._conf37.children[1].value = 1.0   # rate
         self._pid2_gain = self._conf35.children[1].value
         self._pid2_reset = self._conf36.children[1].value
-        self._pid2_rate = self._conf37.children[1].valu
+        self._pid2_rate = self._conf37.children[1].value
+
+        self._conf39.children[0].value = False
+        self._pid_schedule = None
 
     def _conf_mpc(self, b):
         self._SOLVER = self._conf40.children[1].value
@@ -738,6 +935,22 @@ class GUI(object):
         self._Q2_DMAX = self._conf411.children[1].value
         self._Q2_DCOST = self._conf412.children[1].value
 
+    def _conf_perf(self, value):
+        self._profiler.enabled = value['new']
+
+    def _refresh_perf(self, b):
+        self._conf52.value = self._profiler.html()
+
+    def _reset_perf(self, b):
+        self._profiler.reset()
+        self._conf52.value = self._profiler.html()
+
+    def _update_perf(self):
+        # Refresh the performance panel every few ticks
+        self._perf_ticks += 1
+        if self._profiler.enabled and self._perf_ticks % 10 == 0:
+            self._conf52.value = self._profiler.html()
+
     def _Q1_click(self, b):
         self._Q10 = self._wQ1.value
 
@@ -751,31 +964,22 @@ class GUI(object):
         self._T2_SP = self._wT2.value
 
     def _stop_click(self, b):
-        self._flag = False
+        if self._run is not None:
+            self._run.stop()
         self._mode.disabled = False
 
     def _play_click(self, b):
-        if not self._flag:
-            if self._mode.value == "Manual":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_man)
-                thread.start()
-            elif self._mode.value == "On-Off":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_on_off)
-                thread.start()
-            elif self._mode.value == "PID":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_pid)
-                thread.start()
-            elif self._mode.value == "MPC":
-                self._flag = True
-                self._mode.disabled = True
-                thread = threading.Thread(target=self._work_mpc)
-                thread.start()
+        if self._run is None or self._run.stopped:
+            if self._subprocess:
+                work = functools.partial(self._work_process, self._mode.value)
+            else:
+                work = functools.partial(self._work, self._mode.value)
+            self._mode.disabled = True
+            self._snapshot = None
+            self._speed.value = self._speed_html()
+            # The new run waits for the previous one to finish cancelling
+            self._run = self._runner.start(work, self._render,
+                                           previous=self._run)
 
     def _mode_switch(self, value):
         # Reinitialize parameters
@@ -841,600 +1045,169 @@ class GUI(object):
             self._bT2.disabled = False
 
     ###########################################################################
-    #                                                       _MODEL TO SIMULATE
-    ###########################################################################
-    def _heater(self, x, t, Q1, Q2):
-        # Parameters
-        U = 4.87519009 + (np.random.rand()-0.5)  # variable convection
-        alpha1 = 0.00640897365
-        alpha2 = 0.00310952441
-
-        Ta = 23 + 273.15     # K
-        m = 4.0/1000.0       # kg
-        Cp = 0.5 * 1000.0    # J/kg-K
-        A = 10.0 / 100.0**2  # Area in m^2
-        As = 2.0 / 100.0**2  # Area in m^2
-        eps = 0.9            # Emissivity
-        sigma = 5.67e-8      # Stefan-Boltzman
-
-        # Temperature States
-        Th1 = x[0]
-        Th2 = x[1]
-
-        # Heat Transfer Exchange Between 1 and 2
-        conv12 = U*As*(Th2-Th1)
-        rad12 = eps*sigma*As * (Th2**4 - Th1**4)
-
-        # Nonlinear Energy Balances
-        dTh1dt = (1.0/(m*Cp)) * \
-                 (U*A*(Ta-Th1) +
-                  eps * sigma * A * (Ta**4 - Th1**4) +
-                  conv12 + rad12 + alpha1*Q1)
-        dTh2dt = (1.0/(m*Cp)) * \
-                 (U*A*(Ta-Th2) +
-                  eps * sigma * A * (Ta**4 - Th2**4) -
-                  conv12 - rad12 + alpha2*Q2)
-
-        return [dTh1dt, dTh2dt]
-
-    def _sensor(self, x, t, Th1, Th2):
-        # Parameter
-        tau = 17.7176964
-
-        # Temperature States
-        Tc1 = x[0]
-        Tc2 = x[1]
-
-        # lag equations to emulate conduction
-        dTc1dt = (-Tc1 + Th1)/tau
-        dTc2dt = (-Tc2 + Th2)/tau
-
-        return [dTc1dt, dTc2dt]
-
-    ###########################################################################
-    #                                                           PID CONTROLLER
-    ###########################################################################
-
-    # inputs -----------------------------------
-    # sp = setpoint
-    # pv = current temperature
-    # pv_last = prior temperature
-    # ierr = integral error
-    # dt = time increment between measurements
-
-    # outputs ----------------------------------
-    # op = output of the PID controller
-    # I = integral contribution
-
-    def _PID(self, sp, pv, pv_last, ierr, dt, Kc=10.0, tauI=50.0, tauD=1.0):
-        # Default Parameters
-        # Kc   = 10.0 # K/%Heater
-        # tauI = 50.0 # sec
-        # tauD = 1.0  # sec
-
-        # Parameters in terms of PID coefficients
-        KP = Kc
-        if tauI == 0:
-            KI = 1e5
-        else:
-            KI = Kc/tauI
-        KD = Kc*tauD
-
-        # ubias for controller (initial heater)
-        op0 = 0
-
-        # upper and lower bounds on heater level
-        ophi = 100
-        oplo = 0
-
-        # calculate the error
-        error = sp-pv
-
-        # calculate the integral error
-        ierr = ierr + KI * error * dt
-
-        # calculate the measurement derivative
-        dpv = (pv - pv_last) / dt
-
-        # calculate the PID output
-        P = KP * error
-        I = ierr
-        D = -KD * dpv
-        op = op0 + P + I + D
-
-        # implement anti-reset windup
-        if op < oplo or op > ophi:
-            I = I - KI * error * dt
-            # clip output
-            op = max(oplo, min(ophi, op))
-
-        # return the controller output and PID terms
-        return [op, I]
-
-    ###########################################################################
-    #                                                                      MPC
+    #                                                                RENDERING
     ###########################################################################
-    def _MPC(self):
-
-        m = GEKKO(remote=False)
-
-        # 60 second time horizon, 4 sec cycle time, non-uniform
-        m.time = [0, 4, 8, 12, 15, 20, 25, 30, 35, 40, 50, 60, 70, 80, 90]
-
-        # Parameters
-        m.U = m.FV(value=10)
-        m.tau = m.FV(value=5)
-        m.alpha1 = m.FV(value=0.01)    # W / % heater
-        m.alpha2 = m.FV(value=0.0075)  # W / % heater
-
-        # Manipulated variables
-        m.Q1 = m.MV(value=0)
-        m.Q1.STATUS = 1   # use to control temperature
-        m.Q1.FSTATUS = 0  # no feedback measurement
-        m.Q1.LOWER = 0.0
-        m.Q1.UPPER = 100.0
-        m.Q1.DMAX = 20.0
-        m.Q1.COST = 0.0
-        m.Q1.DCOST = 2.0
-
-        m.Q2 = m.MV(value=0)
-        m.Q2.STATUS = 1   # use to control temperature
-        m.Q2.FSTATUS = 0  # no feedback measurement
-        m.Q2.LOWER = 0.0
-        m.Q2.UPPER = 100.0
-        m.Q2.DMAX = 20.0
-        m.Q2.COST = 0.0
-        m.Q2.DCOST = 2.0
-
-        # Controlled variable
-        m.TC1 = m.CV(value=22)
-        m.TC1.STATUS = 1     # minimize error with setpoint range
-        m.TC1.FSTATUS = 1    # receive measurement
-        m.TC1.TR_INIT = 1    # reference trajectory
-        m.TC1.TAU = 10       # time constant for response
-
-        # Controlled variable
-        m.TC2 = m.CV(value=22)
-        m.TC2.STATUS = 1     # minimize error with setpoint range
-        m.TC2.FSTATUS = 1    # receive measurement
-        m.TC2.TR_INIT = 1    # reference trajectory
-        m.TC2.TAU = 10       # time constant for response
-
-        # State variables
-        m.TH1 = m.SV(value=22)
-        m.TH2 = m.SV(value=22)
-
-        m.Ta = m.Param(value=23.0+273.15)     # K
-        m.mass = m.Param(value=4.0/1000.0)    # kg
-        m.Cp = m.Param(value=0.5*1000.0)      # J/kg-K
-        m.A = m.Param(value=10.0/100.0**2)    # Area not between heaters in m^2
-        m.As = m.Param(value=2.0/100.0**2)    # Area between heaters in m^2
-        m.eps = m.Param(value=0.9)            # Emissivity
-        m.sigma = m.Const(5.67e-8)            # Stefan-Boltzmann
-
-        # Heater temperatures
-        m.T1i = m.Intermediate(m.TH1+273.15)
-        m.T2i = m.Intermediate(m.TH2+273.15)
-
-        # Heat transfer between two heaters
-        m.Q_C12 = m.Intermediate(m.U*m.As*(m.T2i-m.T1i))  # Conv
-        m.Q_R12 = m.Intermediate(m.eps*m.sigma*m.As*(m.T2i**4-m.T1i**4))  # Rad
-
-        # Semi-fundamental correlations (energy balances)
-        m.Equation(m.TH1.dt() == (1.0/(m.mass*m.Cp)) *
-                                 (m.U*m.A*(m.Ta-m.T1i) +
-                                  m.eps * m.sigma * m.A *
-                                  (m.Ta**4 - m.T1i**4) + m.Q_C12 +
-                                  m.Q_R12 + m.alpha1*m.Q1))
-
-        m.Equation(m.TH2.dt() == (1.0/(m.mass*m.Cp)) *
-                                 (m.U*m.A*(m.Ta-m.T2i) +
-                                  m.eps * m.sigma * m.A *
-                                  (m.Ta**4 - m.T2i**4) - m.Q_C12 -
-                                  m.Q_R12 + m.alpha2*m.Q2))
-
-        # Empirical correlations (lag equations to emulate conduction)
-        m.Equation(m.tau * m.TC1.dt() == -m.TC1 + m.TH1)
-        m.Equation(m.tau * m.TC2.dt() == -m.TC2 + m.TH2)
-
-        # Global Options
-        m.options.IMODE = 6    # MPC
-        m.options.CV_TYPE = 1  # Objective type
-        m.options.NODES = 3    # Collocation nodes
-        m.options.SOLVER = 3   # 1=APOPT, 3=IPOPT
-
-        return m
-
-    ###########################################################################
-    #                                           THREADING FUNCTION - OPEN LOOP
-    ###########################################################################
-    def _work_man(self):
-        # Paraters to start each cycle
-        Th0 = self._Th0
-        Tc0 = self._Tc0
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-
-        while self._flag:
-
-            ts = [t[-1], t[-1]+self._delta_t]
-            y = odeint(self._heater, Th0, ts, args=(self._Q10, self._Q20))
-            Th0 = y[-1]
-            z = odeint(self._sensor, Tc0, ts, args=(Th0[0], Th0[1]))
-            Tc0 = z[-1]
-
-            # Measurement noise
-            Tc_noise = np.array([
-                Tc0[0] + (np.random.rand()-0.5),
-                Tc0[1] + (np.random.rand()-0.5)
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-
-            t = np.append(t, np.array([ts[-1]]), axis=0)
-            T = np.append(T, Tc_noise.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([self._Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([self._Q20]), axis=0)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
+    async def _render(self):
+        # Push the latest loop snapshot to the widgets, decoupled from the
+        # control loop so slow widget comms never delay a tick. The period
+        # stretches with the drawing time, so that plotting takes at most
+        # a fifth of the event loop at high real-time factors.
+        drawn = None
+        speed = None
+        period = self._render_period
+        while True:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot is not drawn:
+                start = time.perf_counter()
+                with self._profiler.span('widgets'):
+                    self._draw(snapshot)
+                    self._update_perf()
+                    speed = self._update_speed(speed, snapshot[0][-1])
+                drawn = snapshot
+                period = max(self._render_period,
+                             4.*(time.perf_counter() - start))
+            await asyncio.sleep(period)
+
+    async def _render_compare(self, modes):
+        drawn = None
+        speed = None
+        period = self._render_period
+        while True:
+            snapshot = self._compare_snapshot
+            if snapshot is not None and snapshot is not drawn:
+                start = time.perf_counter()
+                self._draw_compare(modes, snapshot)
+                speed = self._update_speed(speed, snapshot[0][-1])
+                drawn = snapshot
+                period = max(self._render_period,
+                             4.*(time.perf_counter() - start))
+            await asyncio.sleep(period)
+
+    def _speed_html(self, achieved=None):
+        factor = self._factor
+        text = 'max' if factor is None else '{:g}x'.format(factor)
+        if achieved is not None:
+            text += ' &rarr; {:.3g}x'.format(achieved)
+        return ('<p style="margin-top: 5px; text-align: center;">'
+                'Speed: {}</p>'.format(text))
+
+    def _update_speed(self, last, t):
+        # Achieved real-time factor (simulated over wall seconds), measured
+        # over at least a second; `last` is the (wall, simulated) time of
+        # the previous measure
+        now = time.monotonic()
+        if last is None or t < last[1]:
+            return (now, t)
+        if now - last[0] < 1.:
+            return last
+        self._speed.value = self._speed_html((t - last[1])/(now - last[0]))
+        return (now, t)
+
+    def _draw_compare(self, modes, snapshot):
+        t, T, Q, SP = snapshot
+        if len(t) < 2:
+            return
+        for lines, y in zip(self._compare_lines,
+                            (T[:, :, 0], T[:, :, 1], Q[:, :, 0], Q[:, :, 1])):
+            lines.x = t/60
+            lines.y = y.T
+        for sp, y in zip(self._compare_sp, SP.T):
+            sp.x = t/60
+            sp.y = y
+
+        # Indicators over the window shown
+        values = kpis(t, T, Q, SP, self._comparison.plant)
+        head = ''.join('<th style="padding: 0 10px;">{}</th>'.format(c)
+                       for c in ('mode', 'IAE 1 (K s)', 'IAE 2 (K s)',
+                                 'energy (J)'))
+        rows = ''.join(
+            '<tr>{}</tr>'.format(''.join(
+                '<td style="padding: 0 10px;">{}</td>'.format(c) for c in (
+                    mode, '{:.0f}'.format(values['IAE'][i, 0]),
+                    '{:.0f}'.format(values['IAE'][i, 1]),
+                    '{:.0f}'.format(values['energy'][i].sum()))))
+            for i, mode in enumerate(modes))
+        self._compare_table.value = '<table><tr>{}</tr>{}</table>'.format(
+            head, rows)
+
+    def _draw(self, snapshot):
+        t, T, Q1, Q2, SP_T1, SP_T2 = snapshot
+
+        self._T1_meas.x = t/60
+        self._T1_meas.y = T[:, 0] - 273.15
+        self._PT1.value = np.round(T[-1, 0]-273.15, 1)
+
+        self._T2_meas.x = t/60
+        self._T2_meas.y = T[:, 1] - 273.15
+        self._PT2.value = np.round(T[-1, 1]-273.15, 1)
+
+        self._u1.x = t/60
+        self._u1.y = Q1
+
+        self._u2.x = t/60
+        self._u2.y = Q2
+
+        if SP_T1 is None:
+            # Manual mode, setpoint sliders follow the measurements
             self._wT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
             self._wT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-
-            time.sleep(self._sleep)
-
-    ###########################################################################
-    #                                              THREADING FUNCTION - ON-OFF
-    ###########################################################################
-    def _work_on_off(self):
-        # Paraters to start each cycle
-        Th0 = self._Th0
-        Tc0 = self._Tc0
-        Q10 = self._Q10
-        Q20 = self._Q20
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        while self._flag:
-
-            # apply ON/OFF controller
-            # heater 1
-            if (Tc0[0]-273.15) < (self._T1_SP - self._q1_dt_on_off):
-                Q10 = 100.0
-            elif (Tc0[0]-273.15) > (self._T1_SP + self._q1_dt_on_off):
-                Q10 = 0.0
-            # heater 2
-            if (Tc0[1]-273.15) < (self._T2_SP - self._q2_dt_on_off):
-                Q20 = 100.0
-            elif (Tc0[1]-273.15) > (self._T2_SP + self._q2_dt_on_off):
-                Q20 = 0.0
-
-            ts = [t[-1], t[-1]+self._delta_t]
-            y = odeint(self._heater, Th0, ts, args=(Q10, Q20))
-            Th0 = y[-1]
-            z = odeint(self._sensor, Tc0, ts, args=(Th0[0], Th0[1]))
-            Tc0 = z[-1]
-
-            # Measurement noise
-            Tc_noise = np.array([
-                Tc0[0] + (np.random.rand()-0.5),
-                Tc0[1] + (np.random.rand()-0.5)
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            t = np.append(t, np.array([ts[-1]]), axis=0)
-            T = np.append(T, Tc_noise.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
+        else:
             self._T1_set_point.x = t/60
             self._T1_set_point.y = SP_T1
 
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
             self._T2_set_point.x = t/60
             self._T2_set_point.y = SP_T2
 
-            self._u1.x = t/60
-            self._u1.y = Q1
             self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
             self._wQ2.value = np.round(Q2[-1], 1)
 
-            time.sleep(self._sleep)
-
     ###########################################################################
-    #                                                 THREADING FUNCTION - PID
+    #                                                       _MODEL TO SIMULATE
     ###########################################################################
-    def _work_pid(self):
-        # Paraters to start each cycle
-        Th0 = self._Th0
-        Tc0 = self._Tc0
-        Q10 = self._Q10
-        Q20 = self._Q20
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        # Integral error
-        ierr1 = 0.0
-        ierr2 = 0.0
-
-        while self._flag:
-
-            ts = [t[-1], t[-1]+self._delta_t]
-            y = odeint(self._heater, Th0, ts, args=(Q10, Q20))
-            Th0 = y[-1]
-            z = odeint(self._sensor, Tc0, ts, args=(Th0[0], Th0[1]))
-            Tc0 = z[-1]
-
-            # Measurement noise
-            Tc_noise = np.array([
-                Tc0[0] + (np.random.rand()-0.5),
-                Tc0[1] + (np.random.rand()-0.5)
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            t = np.append(t, np.array([ts[-1]]), axis=0)
-            T = np.append(T, Tc_noise.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            # Calculate PID output
-            [Q10, ierr1] = self._PID(self._T1_SP, T[-1, 0]-273.15,
-                                     T[-2, 0]-273.15, ierr1, self._delta_t,
-                                     self._pid1_gain, self._pid1_reset,
-                                     self._pid1_rate)
-            [Q20, ierr2] = self._PID(self._T2_SP, T[-1, 1]-273.15,
-                                     T[-2, 1]-273.15, ierr2, self._delta_t,
-                                     self._pid2_gain, self._pid2_reset,
-                                     self._pid2_rate)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T1_set_point.x = t/60
-            self._T1_set_point.y = SP_T1
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._T2_set_point.x = t/60
-            self._T2_set_point.y = SP_T2
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-            self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-            self._wQ2.value = np.round(Q2[-1], 1)
-
-            time.sleep(self._sleep)
+    def _new_backend(self):
+        # The heater/sensor model of control_plant.py, with noisy sensors
+        return SimBackend(self._Th0, self._Tc0)
 
     ###########################################################################
-    #                                                 THREADING FUNCTION - MPC
+    #                                              LOOP COROUTINE - SUBPROCESS
     ###########################################################################
-    def _work_mpc(self):
-        Th0 = self._Th0
-        Tc0 = self._Tc0
-        Q10 = self._Q10
-        Q20 = self._Q20
-
-        # arrays to store data
-        t = np.array([])
-        Q1 = np.array([])
-        Q2 = np.array([])
-        T = np.array([[]]).reshape((0, 2))
-        SP_T1 = np.array([])
-        SP_T2 = np.array([])
-
-        t = np.append(t, np.array([0]), axis=0)
-        T = np.append(T, Tc0.reshape((1, 2)), axis=0)
-        Q1 = np.append(Q1, np.array([Q10]), axis=0)
-        Q2 = np.append(Q2, np.array([Q20]), axis=0)
-        SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-        SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-        # Create MPC object
-        m = self._MPC()
-
-        while self._flag:
-            # Change SOLVER
-            if self._SOLVER == '1 - APOPT':
-                m.options.SOLVER = 1
-            elif self._SOLVER == '2 - BPOPT':
-                m.options.SOLVER = 2
-            else:
-                m.options.SOLVER = 3
-
-            # Change CVTYPE
-            if self._CVTYPE == '1 - Deadband':
-                m.options.CV_TYPE = 1
-            else:
-                m.options.CV_TYPE = 2
-
-            # Add measurements to the MPC
-            m.TC1.MEAS = T[-1, 0] - 273.15
-            m.TC2.MEAS = T[-1, 1] - 273.15
-
-            # Update Parameters
-            m.TC1.TAU = self._T1_tau
-            m.TC2.TAU = self._T2_tau
-
-            m.Q1.DMAX = self._Q1_DMAX
-            m.Q1.DCOST = self._Q1_DCOST
-            m.Q2.DMAX = self._Q2_DMAX
-            m.Q2.DCOST = self._Q2_DCOST
-
-            # Update prediction horizon
-            DT = self._delta_t
-            m.time = [
-                0,
-                DT,
-                DT*2,
-                DT*3,
-                DT*4,
-                DT*5,
-                DT*6,
-                DT*7,
-                DT*8,
-                DT*10,
-                DT*12,
-                DT*15,
-                DT*18,
-                DT*20,
-                DT*25]
-
-            if m.options.CV_TYPE == 1:
-                # Input setpoint with deadband +/- DT
-                DT1 = self._T1_dt
-                m.TC1.SPHI = self._T1_SP + DT1
-                m.TC1.SPLO = self._T1_SP - DT1
-
-                DT2 = self._T2_dt
-                m.TC2.SPHI = self._T2_SP + DT2
-                m.TC2.SPLO = self._T2_SP - DT2
-            else:
-                m.TC1.SP = self._T1_SP
-                m.TC2.SP = self._T2_SP
-
-            try:
-                # Solve MPC
-                m.solve(disp=False)
-                # Check if successful solution
-                if (m.options.APPSTATUS == 1):
-                    # retrieve new value
-                    Q10 = m.Q1.NEWVAL
-                    Q20 = m.Q2.NEWVAL
-            except:
-                # Keep previous value
-                pass
-
-            ts = [t[-1], t[-1]+self._delta_t]
-            y = odeint(self._heater, Th0, ts, args=(Q10, Q20))
-            Th0 = y[-1]
-            z = odeint(self._sensor, Tc0, ts, args=(Th0[0], Th0[1]))
-            Tc0 = z[-1]
-
-            # Measurement noise
-            Tc_noise = np.array([
-                Tc0[0] + (np.random.rand()-0.5),
-                Tc0[1] + (np.random.rand()-0.5)
-            ])
-
-            if len(t) >= self._maxtime:
-                t = np.delete(t, 0, 0)
-                T = np.delete(T, 0, 0)
-                Q1 = np.delete(Q1, 0, 0)
-                Q2 = np.delete(Q2, 0, 0)
-                SP_T1 = np.delete(SP_T1, 0, 0)
-                SP_T2 = np.delete(SP_T2, 0, 0)
-
-            t = np.append(t, np.array([ts[-1]]), axis=0)
-            T = np.append(T, Tc_noise.reshape((1, 2)), axis=0)
-            Q1 = np.append(Q1, np.array([Q10]), axis=0)
-            Q2 = np.append(Q2, np.array([Q20]), axis=0)
-            SP_T1 = np.append(SP_T1, np.array([self._T1_SP]), axis=0)
-            SP_T2 = np.append(SP_T2, np.array([self._T2_SP]), axis=0)
-
-            self._T1_meas.x = t/60
-            self._T1_meas.y = T[:, 0] - 273.15
-            self._PT1.value = np.round(T[-1, 0]-273.15, 1)
-
-            self._T1_set_point.x = t/60
-            self._T1_set_point.y = SP_T1
-
-            self._T2_meas.x = t/60
-            self._T2_meas.y = T[:, 1] - 273.15
-            self._PT2.value = np.round(T[-1, 1]-273.15, 1)
-
-            self._T2_set_point.x = t/60
-            self._T2_set_point.y = SP_T2
-
-            self._u1.x = t/60
-            self._u1.y = Q1
-            self._wQ1.value = np.round(Q1[-1], 1)
-
-            self._u2.x = t/60
-            self._u2.y = Q2
-            self._wQ2.value = np.round(Q2[-1], 1)
-
-            time.sleep(self._sleep)
+    # Attributes mirrored to the engine running in the subprocess
+    _SHARED = ('_delta_t', '_maxtime', '_factor', '_T1_SP', '_T2_SP', '_Q10',
+               '_Q20', '_q1_dt_on_off', '_q2_dt_on_off', '_pid1_gain',
+               '_pid1_reset', '_pid1_rate', '_pid2_gain', '_pid2_reset',
+               '_pid2_rate', '_pid_schedule', '_pid_schedule_by', '_SOLVER',
+               '_CVTYPE', '_T1_dt', '_T1_tau', '_T2_dt', '_T2_tau',
+               '_Q1_DMAX', '_Q1_DCOST', '_Q2_DMAX', '_Q2_DCOST')
+
+    async def _work_process(self, mode):
+        # Run the loop of `mode` in a child process: here we only forward
+        # parameter changes and read its history from shared memory
+        sent = dict((name, getattr(self, name)) for name in self._SHARED)
+        sent['_Th0'] = self._Th0
+        sent['_Tc0'] = self._Tc0
+        sent['_replay'] = self._replay
+        engine = await self._runner.call(ProcessEngine, GUI, '_work', sent,
+                                         args=(mode,))
+        try:
+            while True:
+                if not engine.alive():
+                    raise RuntimeError('Engine subprocess exited')
+                for name in self._SHARED:
+                    value = getattr(self, name)
+                    if sent[name] != value:
+                        engine.send(name, value)
+                        sent[name] = value
+
+                rows = engine.history(self._maxtime)
+                if len(rows):
+                    if not CONTROLLERS[mode].setpoints:
+                        self._publish(rows[:, 0], rows[:, 1:3], rows[:, 3],
+                                      rows[:, 4])
+                    else:
+                        self._publish(rows[:, 0], rows[:, 1:3], rows[:, 3],
+                                      rows[:, 4], rows[:, 5], rows[:, 6])
+
+                await asyncio.sleep(self._render_period)
+        finally:
+            self._snapshot = None
+            await self._runner.call(engine.stop)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+TCLab firmware emulator on a pseudo-terminal, so control_arduino.py and
+the serial layer can run without a board
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import os
+import select
+import threading
+import time
+import tty
+import numpy as np
+import tclab.tclab
+from control_plant import Plant
+
+# Ports served by running emulators
+_ports = set()
+_find_arduino = tclab.tclab.find_arduino
+
+
+def _find_emulated(port=''):
+    # tclab only looks for USB serial devices; let it open emulator ports
+    if port in _ports:
+        return port, 'TCLab emulator'
+    return _find_arduino(port)
+
+
+class Emulator(object):
+    """
+    Pseudo-terminal speaking the TCLab firmware protocol, backed by the
+    heater/sensor model of control_plant.py
+
+    The plant advances in real time (scaled by `speed`) between commands.
+    `latency` (+ uniform `jitter`) is added once per chunk received, as
+    USB latency is, so pipelined commands share it.
+    """
+    version = 'TCLab Firmware 2.0.1 Emulator'
+
+    def __init__(self, latency=0., jitter=0., noise=0., resolution=0.,
+                 speed=1., T0=23., seed=None):
+        """
+        latency = delay before answering a chunk of commands (s)
+        jitter = width of the uniform random delay added to latency (s)
+        noise = width of the uniform noise added to readings (C)
+        resolution = quantization of readings (C), 0 for none
+        speed = plant seconds per wall clock second
+        T0 = initial temperature (C)
+        seed = seed of the noise and jitter generator
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.noise = noise
+        self.resolution = resolution
+        self.speed = speed
+        self.plant = Plant(T0)
+        self.Q1 = 0.
+        self.Q2 = 0.
+        self.P1 = 200.
+        self.P2 = 100.
+        self.LED = 0.
+        self.commands = 0
+        self._random = np.random.RandomState(seed)
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+        self._stop = threading.Event()
+        self._thread = None
+        self._last = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        """
+        Start answering on `port` and let tclab.TCLab(port) open it
+        """
+        _ports.add(self.port)
+        tclab.tclab.find_arduino = _find_emulated
+        self._last = time.monotonic()
+        self._thread = threading.Thread(target=self._serve,
+                                        name='tclab-emulator')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop answering and close the pseudo-terminal
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        _ports.discard(self.port)
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _serve(self):
+        pending = b''
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.1)
+            if not ready:
+                continue
+            pending += os.read(self._master, 4096)
+            *lines, pending = pending.split(b'\n')
+            if not lines:
+                continue
+            delay = self.latency + self.jitter*self._random.rand()
+            if delay > 0.:
+                time.sleep(delay)
+            replies = []
+            for line in lines:
+                command = line.decode('UTF-8', 'replace').strip()
+                if command:
+                    replies.extend(self._dispatch(command))
+            if replies:
+                os.write(self._master,
+                         ''.join(r + '\r\n' for r in replies).encode())
+
+    def _advance(self):
+        # Integrate the plant up to now with the current heater outputs
+        now = time.monotonic()
+        dt = (now - self._last)*self.speed
+        self._last = now
+        if dt > 0.:
+            self.plant.step(dt, self.Q1, self.Q2)
+
+    def _reading(self, i):
+        T = self.plant.Tc[i] - 273.15
+        T += self.noise*(self._random.rand() - 0.5)
+        if self.resolution > 0.:
+            T = self.resolution*np.round(T/self.resolution)
+        return '{:.2f}'.format(T)
+
+    def _dispatch(self, command):
+        # Reply lines of one firmware command
+        self.commands += 1
+        self._advance()
+        parts = command.split()
+        cmd = parts[0].upper()
+        value = 0.
+        if len(parts) > 1:
+            try:
+                value = float(parts[1])
+            except ValueError:
+                pass
+        if cmd == 'T1':
+            return [self._reading(0)]
+        if cmd == 'T2':
+            return [self._reading(1)]
+        if cmd in ('Q1', 'Q2'):
+            setattr(self, cmd, max(0., min(100., value)))
+            return [str(getattr(self, cmd))]
+        if cmd in ('R1', 'R2'):
+            return [str(self.Q1 if cmd == 'R1' else self.Q2)]
+        if cmd in ('P1', 'P2'):
+            setattr(self, cmd, max(0., min(255., value)))
+            return [str(getattr(self, cmd))]
+        if cmd == 'LED':
+            self.LED = max(0., min(100., value))
+            return [str(self.LED)]
+        if cmd == 'SCAN':
+            return [self._reading(0), self._reading(1),
+                    str(self.Q1), str(self.Q2)]
+        if cmd == 'VER':
+            return [self.version]
+        if cmd in ('X', 'A'):
+            self.Q1 = self.Q2 = 0.
+            return ['Stop' if cmd == 'X' else 'Start']
+        return [command]
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Asyncio runtime that executes the control loops of control_demo.py and
+control_arduino.py
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import asyncio
+import functools
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from control_clock import REAL
+
+
+class Run(object):
+    """
+    Handle to a group of tasks (controller/plant loop, rendering, ...)
+    """
+    def __init__(self, runner):
+        self._runner = runner
+        self.task = None       # asyncio.Task, set once it starts running
+        self.future = None     # concurrent.futures.Future of the task
+        self._stopped = False
+
+    @property
+    def stopped(self):
+        return self._stopped or self.done()
+
+    def stop(self):
+        """
+        Cancel the run; any pending sleep or await is interrupted at once
+        """
+        self._stopped = True
+        if self.future is not None:
+            self.future.cancel()
+
+    def done(self):
+        return self.future is None or self.future.done()
+
+    def add_done_callback(self, fn):
+        self.future.add_done_callback(lambda f: fn(self))
+
+
+class LoopRunner(object):
+    """
+    Runs control loop coroutines on an asyncio event loop
+
+    By default a single event loop thread is shared by every GUI in the
+    process, so concurrent runs do not each need an OS thread. Pass the
+    kernel's own loop (asyncio.get_event_loop() inside a notebook) to run
+    there instead. Blocking calls (solver, serial I/O) are awaited through
+    `call`, which hands them to a worker pool.
+    """
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, loop=None, workers=4):
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=loop.run_forever,
+                                      name='tclab-loop')
+            thread.daemon = True
+            thread.start()
+        self.loop = loop
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix='tclab-worker')
+
+    @classmethod
+    def default(cls):
+        """
+        Return the process wide runner (dedicated loop thread)
+        """
+        with cls._default_lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def start(self, *workers, **kwargs):
+        """
+        Start coroutine functions `workers` as one cancellable run
+
+        previous = Run that must have fully finished (including its
+                   cleanup) before these workers start
+        """
+        previous = kwargs.get('previous')
+        run = Run(self)
+        run.future = asyncio.run_coroutine_threadsafe(
+            self._supervise(run, previous, workers), self.loop)
+        run.add_done_callback(self._report)
+        return run
+
+    async def _supervise(self, run, previous, workers):
+        run.task = asyncio.current_task()
+        if previous is not None and previous.task is not None:
+            # Never let two generations of workers overlap
+            await asyncio.wait([previous.task])
+        tasks = [self.loop.create_task(w()) for w in workers]
+        try:
+            # Any worker finishing (normally or not) ends the whole run
+            done, _ = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.cancelled() and task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.wait(tasks)
+
+    @staticmethod
+    def _report(run):
+        if run.future.cancelled():
+            return
+        exc = run.future.exception()
+        if exc is not None:
+            traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+    async def call(self, fn, *args, **kwargs):
+        """
+        Await a blocking call executed on a worker thread
+
+        executor = executor to use instead of the shared worker pool
+        """
+        executor = kwargs.pop('executor', None) or self._executor
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, functools.partial(fn, *args, **kwargs))
+
+
+class Pacer(object):
+    """
+    Virtual clock pacing simulated time against wall time
+
+    Simulated time t is due at wall time origin + t/factor; wait(t) sleeps
+    until then. A step that is late runs at once, so the run catches up
+    after a stall (e.g. a slow solve), but by at most `max_lag` wall
+    seconds: beyond that the schedule slips instead of running a burst of
+    steps. Changing `factor` keeps the current time continuous, and a
+    factor of None runs as fast as possible, only yielding to other tasks.
+    """
+    def __init__(self, factor=1., max_lag=1., clock=REAL):
+        """
+        factor = real-time factor (simulated seconds per wall second)
+        max_lag = wall time (s) the run may fall behind and catch up
+        clock = control_clock clock standing for the wall time
+        """
+        self.factor = factor
+        self.max_lag = max_lag
+        self.clock = clock
+        self._origin = None
+        self._based = None
+        self._t = 0.
+
+    def reset(self):
+        """
+        Restart the schedule from t = 0 at the next wait()
+        """
+        self._origin = None
+        self._t = 0.
+
+    async def wait(self, t):
+        """
+        Sleep until the simulated time `t` (s) is due
+        """
+        factor = self.factor
+        now = self.clock.time()
+        if factor is None:
+            self._origin = None
+        elif self._origin is None or factor != self._based:
+            # (Re)start from the previous time at the new factor
+            self._origin = now - self._t/factor
+            self._based = factor
+        self._t = t
+        if self._origin is None:
+            await self.clock.sleep(0.)
+            return
+        delay = self._origin + t/factor - now
+        if delay < -self.max_lag:
+            self._origin -= delay + self.max_lag
+        await self.clock.sleep(max(delay, 0.))
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Drive several TCLab boards concurrently from one process
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+from ipywidgets import widgets as wi
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from control_perf import LoopMetrics, register_metrics, start_metrics_server
+from control_engine import LoopRunner
+from control_clock import REAL
+from control_io import Connection, Acquisition, PortTCLab, discover
+from control_process import HistoryRing
+
+
+class Board(object):
+    """
+    One TCLab of a fleet with its own connection, acquisition thread,
+    serial I/O thread, metrics and history
+    """
+    def __init__(self, port, delta_t, factory=PortTCLab, capacity=4096,
+                 clock=REAL):
+        self.port = port
+        self.name = os.path.basename(port)
+        self.Q1 = 0.
+        self.Q2 = 0.
+        self.SP_T1 = np.nan
+        self.SP_T2 = np.nan
+        self.T1 = np.nan
+        self.T2 = np.nan
+        self.metrics = LoopMetrics(self.name)
+        self.metrics.clock = clock
+        self.connection = Connection(port, factory=factory)
+        self.metrics.link = self.connection
+        self.acquisition = Acquisition(self.connection, delta_t,
+                                       on_read=self._read, clock=clock)
+        self.history = HistoryRing(bytearray(HistoryRing.nbytes(capacity)),
+                                   capacity)
+        self.io = ThreadPoolExecutor(max_workers=1,
+                                     thread_name_prefix='tclab-io')
+
+    def _read(self, t0, t1):
+        self.metrics.serial(t1 - t0)
+
+
+def _hold(board, T1, T2):
+    # Default controller: keep the heater values set by the user
+    return board.Q1, board.Q2
+
+
+class Fleet(object):
+    """
+    Device manager running one control loop per attached TCLab
+
+    Every board samples on its own acquisition thread and talks to its
+    port on its own I/O thread, so a slow or lost board does not delay
+    the others; the loops themselves are coroutines on a shared runner.
+    """
+    def __init__(self, ports=None, delta_t=1.0, runner=None,
+                 factory=PortTCLab, clock=REAL):
+        """
+        ports = serial ports to drive (default: every board discovered)
+        delta_t = sampling period of every board (s)
+        runner = control_engine.LoopRunner executing the loops
+        factory = class used to open each board, called as factory(port=)
+        clock = control_clock clock of the loops and acquisition schedules
+        """
+        if ports is None:
+            ports = discover()
+        self.delta_t = delta_t
+        self.boards = dict((port, Board(port, delta_t, factory,
+                                        clock=clock))
+                           for port in ports)
+        self._runner = runner or LoopRunner.default()
+        self._clock = clock
+        self._run = None
+        self._render_period = 1.0
+        self._table = wi.HTML(value=self._html())
+
+    def start(self, controller=None):
+        """
+        Start driving every board
+
+        controller = function(board, T1, T2) -> (Q1, Q2) called on each
+                     sample; defaults to holding board.Q1 and board.Q2
+        """
+        controller = controller or _hold
+        workers = [functools.partial(self._drive, board, controller)
+                   for board in self.boards.values()]
+        self._run = self._runner.start(*(workers + [self._render]),
+                                       previous=self._run)
+        return self._run
+
+    def stop(self):
+        """
+        Stop the loops (heaters are switched off, ports stay open)
+        """
+        if self._run is not None:
+            self._run.stop()
+
+    def close(self):
+        """
+        Stop the loops and release every port
+        """
+        self.stop()
+        for board in self.boards.values():
+            board.io.submit(board.connection.close)
+
+    def set(self, port, Q1=None, Q2=None, SP_T1=None, SP_T2=None):
+        """
+        Change heater values or setpoints of one board
+        """
+        board = self.boards[port]
+        for name, value in (('Q1', Q1), ('Q2', Q2),
+                            ('SP_T1', SP_T1), ('SP_T2', SP_T2)):
+            if value is not None:
+                setattr(board, name, value)
+
+    def history(self, port, n=None):
+        """
+        Return the last `n` rows (t, T1, T2, Q1, Q2, SP_T1, SP_T2) of a
+        board
+        """
+        ring = self.boards[port].history
+        return ring.last(len(ring) if n is None else n)
+
+    def serve_metrics(self, port=9100):
+        """
+        Expose the metrics of every board (labelled by device name)
+        """
+        for board in self.boards.values():
+            register_metrics(board.metrics)
+        start_metrics_server(port)
+        return 'http://127.0.0.1:{}/metrics'.format(port)
+
+    def dashboard(self):
+        """
+        Return the fleet status table, refreshed while the loops run
+        """
+        return self._table
+
+    ###########################################################################
+    #                                                         LOOP COROUTINES
+    ###########################################################################
+    async def _io_call(self, board, fn, *args):
+        return await self._runner.call(fn, *args, executor=board.io)
+
+    async def _drive(self, board, controller):
+        # Open the board, retrying until it answers
+        while True:
+            try:
+                await self._io_call(board, board.connection.open)
+                break
+            except Exception:
+                await self._clock.sleep(5.)
+
+        acq = board.acquisition.start()
+        board.metrics.new_run()
+        stamp0 = None
+        try:
+            while True:
+                acq.period = self.delta_t
+                stamp, board.T1, board.T2 = await acq.next()
+                board.metrics.tick(self.delta_t, len(board.history))
+                if stamp0 is None:
+                    stamp0 = stamp
+                board.Q1, board.Q2 = controller(board, board.T1, board.T2)
+                try:
+                    await self._io_call(board, board.connection.write,
+                                        board.Q1, board.Q2, False)
+                except IOError:
+                    # The connection monitor reopens the board
+                    pass
+                board.history.append(((stamp - stamp0)*1e-9,
+                                      board.T1, board.T2, board.Q1, board.Q2,
+                                      board.SP_T1, board.SP_T2))
+        finally:
+            acq.stop()
+            if board.connection.status == 'connected':
+                await self._io_call(board, board.connection.write, 0, 0)
+
+    async def _render(self):
+        while True:
+            self._table.value = self._html()
+            await asyncio.sleep(self._render_period)
+
+    def _html(self):
+        cols = ['board', 'status', 'T1', 'T2', 'Q1', 'Q2', 'rtt (ms)',
+                'mean rtt (ms)', 'tick (s)', 'late', 'missed', 'slow',
+                'timeouts', 'reconnects']
+        head = ''.join('<th style="padding: 0 10px;">{}</th>'.format(c)
+                       for c in cols)
+        rows = []
+        for board in self.boards.values():
+            m = board.metrics
+            mean = m.serial_seconds/max(m.serial_transactions, 1)
+            cells = [board.name, board.connection.status,
+                     '{:.2f}'.format(board.T1), '{:.2f}'.format(board.T2),
+                     '{:.1f}'.format(board.Q1), '{:.1f}'.format(board.Q2),
+                     '{:.1f}'.format(m.serial_last*1e3),
+                     '{:.1f}'.format(mean*1e3),
+                     '{:.3f}'.format(m.tick_period), str(m.late_ticks),
+                     str(board.acquisition.missed), str(m.serial_slow),
+                     str(m.serial_timeouts), str(m.reconnects)]
+            rows.append('<tr>{}</tr>'.format(''.join(
+                '<td style="padding: 0 10px;">{}</td>'.format(c)
+                for c in cells)))
+        if not rows:
+            return '<p><i>No TCLab board found.</i></p>'
+        return '<table><tr>{}</tr>{}</table>'.format(head, ''.join(rows))
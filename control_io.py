@@ -0,0 +1,602 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Serial I/O layer between control_arduino.py and the TCLab board
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import asyncio
+import bisect
+import collections
+import sys
+import threading
+import time
+import numpy as np
+import serial
+from serial.tools import list_ports
+from tclab import TCLab
+from tclab.tclab import arduinos, AlreadyConnectedError
+from control_clock import REAL
+
+# Hardware id prefixes of the boards tclab knows; its table ends with a
+# bare 'USB VID:PID' entry matching any USB serial adapter, left out
+BOARDS = tuple(hwid for hwid, name in arduinos if '=' in hwid)
+
+
+def discover():
+    """
+    Return the serial ports of all attached TCLab boards
+    """
+    return sorted(port for port, desc, hwid in list_ports.comports()
+                  if hwid.startswith(BOARDS))
+
+
+class SerialTimeout(IOError):
+    """
+    The board did not answer within the serial timeout
+    """
+
+
+class LinkStats(object):
+    """
+    Rolling latency histogram, counters and event log of a serial link
+    """
+    # Upper bounds (s) of the latency buckets; the last one is open
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2.)
+
+    def __init__(self, size=1024, slow=0.1, events=50):
+        """
+        size = number of round trips kept in the rolling window
+        slow = round trips longer than this (s) are counted as slow
+        events = number of link events kept
+        """
+        self.slow_threshold = slow
+        self.transactions = 0
+        self.slow = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.events = collections.deque(maxlen=events)
+        self._size = size
+        self._latency = np.zeros(size)
+
+    def record(self, seconds):
+        self._latency[self.transactions % self._size] = seconds
+        self.transactions += 1
+        if seconds > self.slow_threshold:
+            self.slow += 1
+
+    def event(self, name, detail=''):
+        self.events.append((time.time(), name, detail))
+
+    def histogram(self):
+        """
+        Return [(upper bound in s, count)] over the rolling window
+        """
+        edges = (0.,) + self.BUCKETS + (np.inf,)
+        n = min(self.transactions, self._size)
+        counts, _ = np.histogram(self._latency[:n], edges)
+        return list(zip(edges[1:], counts.tolist()))
+
+    def summary(self):
+        """
+        Return counters and rolling latency percentiles (ms)
+        """
+        stats = {'transactions': self.transactions, 'slow': self.slow,
+                 'timeouts': self.timeouts, 'errors': self.errors}
+        n = min(self.transactions, self._size)
+        if n:
+            x = self._latency[:n] * 1e3
+            p50, p95, p99 = np.percentile(x, [50, 95, 99])
+            stats.update(p50=float(p50), p95=float(p95), p99=float(p99),
+                         max=float(x.max()))
+        return stats
+
+    def html(self):
+        """
+        Render the histogram, counters and recent events as HTML
+        """
+        s = self.summary()
+        head = ('<p><b>Serial link:</b> {transactions} round trips, '
+                '{slow} slow (&gt; {ms:.0f} ms), {timeouts} timeouts, '
+                '{errors} errors</p>').format(
+                    ms=self.slow_threshold*1e3, **s)
+        if 'p50' in s:
+            head += ('<p>p50 {p50:.2f} ms, p95 {p95:.2f} ms, '
+                     'p99 {p99:.2f} ms, max {max:.2f} ms</p>').format(**s)
+        hist = self.histogram()
+        top = max(max(c for b, c in hist), 1)
+        rows = []
+        for bound, count in hist:
+            label = ('&gt; {:g} ms'.format(self.BUCKETS[-1]*1e3)
+                     if np.isinf(bound) else '&le; {:g} ms'.format(bound*1e3))
+            rows.append('<tr><td style="padding: 0 10px;">{}</td>'
+                        '<td style="padding: 0 10px;">{:d}</td>'
+                        '<td>{}</td></tr>'.format(
+                            label, count, '&#9608;'*int(round(30*count/top))))
+        events = ''.join('<li>{} {}{}</li>'.format(
+            time.strftime('%H:%M:%S', time.localtime(t)), name,
+            ': ' + detail if detail else '')
+            for t, name, detail in list(self.events)[-5:])
+        return head + '<table>{}</table><ul>{}</ul>'.format(
+            ''.join(rows), events)
+
+
+class PortTCLab(TCLab):
+    """
+    TCLab bound to an explicit port
+
+    tclab allows a single open board per process through a module flag;
+    boards opened on their own port skip that flag so a process can
+    drive several of them, each guarded by its own Connection.
+    """
+    def connect(self, baud):
+        self.sp = serial.Serial(port=self.port, baudrate=baud, timeout=2)
+        time.sleep(2)
+        self.Q1(0)  # fails if not connected
+        self.baud = baud
+
+
+class Connection(object):
+    """
+    TCLab connection opened once (lazily) and reused across runs
+
+    Every transaction goes through the connection lock, so the loop and
+    the background health check never interleave on the serial port. A
+    monitor thread checks idle links and reconnects lost ones with a
+    backoff, without blocking the caller.
+
+    Reads and writes are pipelined: all requests of a transaction are
+    written at once and the replies read afterwards, so a transaction
+    costs one serial round trip instead of one per command.
+    """
+    def __init__(self, port='', factory=TCLab, check_period=5.,
+                 on_status=None):
+        """
+        port = serial port (empty string lets tclab find the Arduino)
+        factory = class used to open the board, called as factory(port=)
+        check_period = seconds between health checks of an idle link
+        on_status = callback(status) called on every status change
+        """
+        self.port = port
+        self.status = 'closed'    # closed, connecting, connected, lost
+        self.reconnects = 0
+        self._factory = factory
+        self._check_period = check_period
+        self._on_status = on_status
+        self._lab = None
+        self._lock = threading.RLock()
+        self._wake = threading.Event()
+        self._monitor = None
+        self._closing = False
+        self._last_ok = 0.
+        self._pending = 0       # replies of deferred writes not read yet
+        self.rtt = 0.           # last measured round trip (s)
+        self.stats = LinkStats()
+
+    def _set_status(self, status):
+        if status != self.status:
+            self.status = status
+            self.stats.event(status)
+            if self._on_status is not None:
+                self._on_status(status)
+
+    def _reopen(self):
+        # Open a new board handle; caller holds the lock
+        self._set_status('connecting')
+        # A flag already set belongs to another live handle of the board
+        module = sys.modules.get(self._factory.__module__)
+        owned = getattr(module, '_connected', False)
+        try:
+            self._lab = self._factory(port=self.port)
+        except AlreadyConnectedError:
+            self._lab = None
+            self._set_status('lost')
+            raise
+        except Exception:
+            self._lab = None
+            if not owned:
+                # Left set by our own attempt failing half way
+                self._release_flag(self._factory)
+            self._set_status('lost')
+            raise
+        self._last_ok = time.monotonic()
+        self._set_status('connected')
+
+    def open(self):
+        """
+        Open the board if needed (blocking) and start the health monitor
+        """
+        with self._lock:
+            self._closing = False
+            if self._lab is None:
+                self._reopen()
+        if self._monitor is None or not self._monitor.is_alive():
+            self._monitor = threading.Thread(target=self._watch,
+                                             name='tclab-monitor')
+            self._monitor.daemon = True
+            self._monitor.start()
+        return self
+
+    def close(self):
+        """
+        Switch the heaters off and release the serial port
+        """
+        self._closing = True
+        self._wake.set()
+        with self._lock:
+            if self._lab is not None:
+                try:
+                    if self._pending:
+                        self._drain(self._lab)
+                    self._lab.close()
+                except Exception:
+                    self._drop()
+                self._lab = None
+            self._set_status('closed')
+
+    def _drop(self):
+        # Best effort release of a dead link so it can be opened again
+        lab, self._lab = self._lab, None
+        self._pending = 0
+        if lab is None:
+            return
+        try:
+            lab.sp.close()
+        except Exception:
+            pass
+        self._release_flag(type(lab))
+
+    @staticmethod
+    def _release_flag(cls):
+        # tclab refuses a second TCLab() until its module flag is cleared,
+        # which never happens if close() or __init__ failed half way
+        module = sys.modules.get(cls.__module__)
+        if getattr(module, '_connected', False):
+            module._connected = False
+
+    def transaction(self, fn, *args):
+        """
+        Run fn(lab, *args) under the connection lock
+        """
+        with self._lock:
+            if self._lab is None:
+                raise IOError('TCLab connection is {}'.format(self.status))
+            try:
+                if self._pending:
+                    self._drain(self._lab)
+                result = fn(self._lab, *args)
+            except Exception as exc:
+                if isinstance(exc, SerialTimeout):
+                    self.stats.timeouts += 1
+                else:
+                    self.stats.errors += 1
+                self.stats.event(type(exc).__name__, str(exc))
+                self._drop()
+                self._set_status('lost')
+                self._wake.set()
+                raise
+            self._last_ok = time.monotonic()
+            return result
+
+    def _pipeline(self, lab, commands, wait=True):
+        # Write all commands at once, then read one reply per command.
+        # With wait=False the replies are left for the next transaction.
+        sp = lab.sp
+        start = time.perf_counter()
+        sp.write(''.join(c + '\r\n' for c in commands).encode())
+        sp.flush()
+        if not wait:
+            self._pending += len(commands)
+            return None
+        replies = [sp.readline() for c in commands]
+        self.rtt = time.perf_counter() - start
+        self.stats.record(self.rtt)
+        if not all(replies):
+            raise SerialTimeout('TCLab did not reply within the serial '
+                                'timeout')
+        return [r.decode('UTF-8').strip() for r in replies]
+
+    def _drain(self, lab):
+        # Consume the replies of deferred writes
+        while self._pending:
+            if not lab.sp.readline():
+                raise SerialTimeout('TCLab did not reply within the serial '
+                                    'timeout')
+            self._pending -= 1
+
+    @staticmethod
+    def _heater(name, value):
+        return '{} {}'.format(name, max(0., min(100., float(value))))
+
+    def read(self):
+        """
+        Return the temperatures (T1, T2) in Celsius
+        """
+        return self.transaction(self._read)
+
+    def _read(self, lab):
+        if not hasattr(lab, 'sp'):
+            return lab.T1, lab.T2
+        T1, T2 = self._pipeline(lab, ['T1', 'T2'])
+        return float(T1), float(T2)
+
+    def write(self, Q1, Q2, wait=True):
+        """
+        Set the heater outputs (0-100)
+
+        wait = False returns as soon as the commands are sent; their
+               acknowledgements are read by the next transaction
+        """
+        return self.transaction(self._write, Q1, Q2, wait)
+
+    def _write(self, lab, Q1, Q2, wait):
+        if not hasattr(lab, 'sp'):
+            return lab.Q1(Q1), lab.Q2(Q2)
+        replies = self._pipeline(lab, [self._heater('Q1', Q1),
+                                       self._heater('Q2', Q2)], wait)
+        if replies is not None:
+            return float(replies[0]), float(replies[1])
+
+    def exchange(self, Q1, Q2):
+        """
+        Write Q1/Q2 and read back (T1, T2) in a single round trip
+        """
+        return self.transaction(self._exchange, Q1, Q2)
+
+    def _exchange(self, lab, Q1, Q2):
+        if not hasattr(lab, 'sp'):
+            lab.Q1(Q1)
+            lab.Q2(Q2)
+            return lab.T1, lab.T2
+        replies = self._pipeline(lab, [self._heater('Q1', Q1),
+                                       self._heater('Q2', Q2), 'T1', 'T2'])
+        return float(replies[2]), float(replies[3])
+
+    def _watch(self):
+        backoff = 1.
+        while True:
+            self._wake.wait(self._check_period)
+            self._wake.clear()
+            if self._closing:
+                return
+            if self._lab is not None:
+                if time.monotonic() - self._last_ok < self._check_period:
+                    continue
+                try:
+                    self.transaction(self._read)
+                    continue
+                except Exception:
+                    pass
+            # Link lost: reopen it, retrying with an increasing backoff
+            with self._lock:
+                try:
+                    if not self._closing and self._lab is None:
+                        self._reopen()
+                        self.reconnects += 1
+                        self.stats.event('reconnected')
+                    backoff = 1.
+                    continue
+                except Exception:
+                    pass
+            self._wake.wait(backoff)
+            backoff = min(2*backoff, 30.)
+            self._wake.set()
+
+
+class MovingAverage(object):
+    """
+    Mean of the last `n` samples of each channel, O(1) per sample
+    """
+    def __init__(self, n, channels=2):
+        self.n = n
+        self._buf = np.zeros((n, channels))
+        self._sum = np.zeros(channels)
+        self._count = 0
+
+    def __call__(self, x):
+        i = self._count % self.n
+        if self._count >= self.n:
+            self._sum -= self._buf[i]
+        self._buf[i] = x
+        self._sum += self._buf[i]
+        self._count += 1
+        if i == self.n - 1:
+            # Re-sum once per window so rounding errors never accumulate
+            self._sum = self._buf.sum(axis=0)
+        return tuple(self._sum / min(self._count, self.n))
+
+
+class MovingMedian(object):
+    """
+    Median of the last `n` samples of each channel, kept in sorted windows
+
+    Each sample is found by binary search but inserted into and removed
+    from a list, O(n) per sample: robust to spikes, but not the default.
+    """
+    def __init__(self, n, channels=2):
+        self.n = n
+        self._raw = collections.deque()
+        self._sorted = [[] for c in range(channels)]
+
+    def __call__(self, x):
+        x = tuple(float(v) for v in x)
+        if len(self._raw) == self.n:
+            old = self._raw.popleft()
+            for window, v in zip(self._sorted, old):
+                del window[bisect.bisect_left(window, v)]
+        self._raw.append(x)
+        out = []
+        for window, v in zip(self._sorted, x):
+            bisect.insort(window, v)
+            k = len(window)
+            out.append(window[k//2] if k % 2 else
+                       0.5*(window[k//2 - 1] + window[k//2]))
+        return tuple(out)
+
+
+class Exponential(object):
+    """
+    Exponential moving average with smoothing factor `alpha`
+    """
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self._y = None
+
+    def __call__(self, x):
+        if self._y is None:
+            self._y = [float(v) for v in x]
+        else:
+            self._y = [y + self.alpha*(v - y) for y, v in zip(self._y, x)]
+        return tuple(self._y)
+
+
+# Filters selectable by name, built for a window of n samples; the
+# streaming moving average is the default of the apps
+FILTERS = ('None', 'Moving average', 'Median', 'Exponential')
+
+
+def make_filter(name, n):
+    """
+    Return the filter `name` (see FILTERS) sized for `n` samples per tick
+    """
+    if name == 'Moving average':
+        return MovingAverage(n)
+    if name == 'Median':
+        return MovingMedian(n)
+    if name == 'Exponential':
+        return Exponential(2./(n + 1))   # same center of mass as n samples
+    return None
+
+
+class Acquisition(object):
+    """
+    Thread sampling (T1, T2) at a fixed rate into a timestamped queue
+
+    Sampling instants follow their own schedule, so the jitter of the
+    control loop and of the widgets does not move them. Each sample is
+    stamped with the time_ns() of the clock (time.monotonic_ns() by
+    default) at the middle of its serial round trip.
+
+    Every sample is queued in `samples`, a bounded deque whose
+    append/popleft are atomic, so its consumer never takes a lock shared
+    with the sampling thread: a recorder drain()s it in order and loses
+    nothing while it keeps up. The controller only wants the newest
+    sample and awaits next(), which reads it apart from the queue.
+
+    With oversampling, the sensors are read `oversample` times per period
+    and every reading goes through `filter`; only the filtered value at
+    the end of each period is queued, so the tick is not extended.
+    """
+    def __init__(self, connection, period, maxlen=1024, on_read=None,
+                 oversample=1, filter=None, clock=REAL):
+        """
+        connection = Connection used for the reads
+        period = sampling period (s); may be changed while running
+        maxlen = samples queued when the recorder falls behind
+        on_read = callback(t0, t1) with the perf_counter stamps of each read
+        oversample = readings per period
+        filter = callable((T1, T2)) -> (T1, T2) applied to every reading,
+                 e.g. one of make_filter(); may be replaced while running
+        clock = control_clock clock of the schedule and time stamps
+        """
+        self.connection = connection
+        self.clock = clock
+        self.period = period
+        self.oversample = oversample
+        self.filter = filter
+        self.samples = collections.deque(maxlen=maxlen)
+        self.missed = 0         # sampling instants skipped (link busy/late)
+        self.stale = 0          # samples superseded before next() saw them
+        self.dropped = 0        # samples pushed out of a full queue
+        self._latest = (0, None)  # (samples taken, newest sample)
+        self._seen = 0          # samples taken when next() last returned
+        self._on_read = on_read
+        self._stop = threading.Event()
+        self._loop = None
+        self._ready = None
+
+    def start(self, loop=None):
+        """
+        Start sampling; `loop` is the asyncio loop awaiting `next()`
+        """
+        self._loop = loop or asyncio.get_event_loop()
+        self._ready = asyncio.Event()
+        # A fresh event per start, so a thread still finishing its last
+        # read after stop() is never revived by a restart
+        self._stop = threading.Event()
+        thread = threading.Thread(target=self._sample, args=(self._stop,),
+                                  name='tclab-acquisition')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop sampling (the thread exits after its current read)
+        """
+        self._stop.set()
+
+    def _sample(self, stop):
+        clock = self.clock
+        deadline = clock.time()
+        readings = 0
+        while not clock.wait(stop, max(0., deadline - clock.time())):
+            t0 = time.perf_counter()
+            ns0 = clock.time_ns()
+            try:
+                T = self.connection.read()
+            except Exception:
+                # Link lost; the connection monitor reopens it
+                T = None
+            ns1 = clock.time_ns()
+            if T is not None:
+                if self._on_read is not None:
+                    self._on_read(t0, time.perf_counter())
+                flt = self.filter
+                if flt is not None:
+                    T = flt(T)
+                readings += 1
+                if readings >= self.oversample:
+                    readings = 0
+                    sample = ((ns0 + ns1)//2, T[0], T[1])
+                    if len(self.samples) == self.samples.maxlen:
+                        self.dropped += 1
+                    self.samples.append(sample)
+                    # One assignment, so next() never pairs a count with
+                    # another sample
+                    self._latest = (self._latest[0] + 1, sample)
+                    self._loop.call_soon_threadsafe(self._ready.set)
+            step = self.period/self.oversample
+            deadline += step
+            late = clock.time() - deadline
+            if late > 0.:
+                skipped = int(late // step) + 1
+                self.missed += skipped
+                deadline += skipped*step
+
+    async def next(self):
+        """
+        Wait for a sample newer than the last one returned and return the
+        latest (stamp_ns, T1, T2); the queue is left to drain()
+        """
+        while self._latest[0] == self._seen:
+            self._ready.clear()
+            if self._latest[0] != self._seen:
+                break
+            await self._ready.wait()
+        count, sample = self._latest
+        self.stale += count - self._seen - 1
+        self._seen = count
+        return sample
+
+    def drain(self):
+        """
+        Remove and return every queued sample (stamp_ns, T1, T2), oldest
+        first
+        """
+        samples = []
+        while self.samples:
+            samples.append(self.samples.popleft())
+        return samples
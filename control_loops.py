@@ -0,0 +1,324 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Control loops shared by control_demo.py and control_arduino.py; they drive
+any plant backend of control_backend.py
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import functools
+import time
+import numpy as np
+from control_backend import ReplayBackend
+from control_clock import REAL
+from control_engine import Pacer
+from control_controllers import CONTROLLERS
+from control_study import Comparison, MonteCarlo, check_modes
+from control_tuning import Tuner, gain_schedule
+
+
+class ControlLoops(object):
+    """
+    Mixin with the control loop coroutines of the GUIs
+
+    The GUI provides the parameters (`_delta_t`, setpoints, tuning read
+    by the controllers of control_controllers.py), `_profiler`,
+    `_metrics`, `_runner` and `_new_backend()`, which returns the plant
+    backend of a new run; the backend of the current run is kept in
+    `_backend`. Real time backends are paced by their sampling alone; the
+    others are paced by `_pacer` at the real-time factor `_factor` (None:
+    as fast as possible). Every wait goes through the clock `_clock`
+    (control_clock).
+    """
+    _factor = None
+    _pacer = None
+    _clock = REAL
+
+    def history(self):
+        """
+        Return the rows (t, T1, T2, Q1, Q2, SP_T1, SP_T2) currently shown,
+        temperatures in Celsius (SP columns are nan in Manual mode)
+        """
+        if self._snapshot is None:
+            return np.zeros((0, 7))
+        t, T, Q1, Q2, SP_T1, SP_T2 = self._snapshot
+        if SP_T1 is None:
+            SP_T1 = SP_T2 = np.full(len(t), np.nan)
+        return np.column_stack((t, T - 273.15, Q1, Q2, SP_T1, SP_T2))
+
+    def replay(self, rows=None):
+        """
+        Make the next runs play back recorded rows (t, T1, T2, ...) instead
+        of the plant, e.g. to try a controller on a saved history; None
+        goes back to the plant
+        """
+        self._replay = rows
+
+    def set_pid(self, pid1=None, pid2=None):
+        """
+        Load the tuning (Kc, tauI, tauD) of PID 1 and/or PID 2 into the
+        configuration; a running PID picks it up on its next tick. Returns
+        the tuning of each PID as loaded (None if not given): the sliders
+        clip it to their ranges.
+        """
+        loaded = []
+        for gains, names, boxes in (
+                (pid1, ('_pid1_gain', '_pid1_reset', '_pid1_rate'),
+                 ('_conf31', '_conf32', '_conf33')),
+                (pid2, ('_pid2_gain', '_pid2_reset', '_pid2_rate'),
+                 ('_conf35', '_conf36', '_conf37'))):
+            if gains is None:
+                loaded.append(None)
+                continue
+            for value, name, box in zip(gains, names, boxes):
+                if hasattr(self, box):
+                    # The slider clips the value to its range
+                    slider = getattr(self, box).children[1]
+                    slider.value = float(value)
+                    value = slider.value
+                setattr(self, name, float(value))
+            loaded.append(tuple(getattr(self, name) for name in names))
+        return tuple(loaded)
+
+    def tune_pid(self, refine=False, **options):
+        """
+        Tune both PIDs offline on the simulated plant and load the best
+        gains with set_pid(); a grid search, refined with Nelder-Mead if
+        `refine`. `options` are those of control_tuning.Tuner (test
+        profile, criterion, move penalty, workers).
+        """
+        tuner = Tuner(**options)
+        try:
+            result = tuner.grid()
+            if refine:
+                result = tuner.nelder_mead()
+        finally:
+            tuner.close()
+        self.set_pid(*result['gains'])
+        return result
+
+    def schedule_pid(self, schedule=None, by='PV', **options):
+        """
+        Make the PIDs look their gains up in a gain schedule, indexed by
+        the measurement (by='PV') or the setpoint ('Setpoint'); without
+        `schedule`, one is generated by batch simulation (`options` of
+        control_tuning.gain_schedule)
+        """
+        if schedule is None:
+            schedule = self._make_schedule(**options)
+        self._schedule = schedule
+        self._pid_schedule = schedule
+        self._pid_schedule_by = by
+        if hasattr(self, '_conf39'):
+            self._conf39.children[0].value = True
+            self._conf39.children[1].value = by
+            self._conf39.children[3].value = self._schedule_html()
+        return schedule
+
+    def monte_carlo(self, modes=('On-Off', 'PID'), progress=None,
+                    **options):
+        """
+        Monte Carlo study of `modes` with the tuning of the configuration
+        on randomized simulated plants; `options` are those of
+        control_study.MonteCarlo (runs, noise, spread, workers...).
+        Returns the study, whose summary() gives the KPI statistics.
+        """
+        check_modes(modes)
+        controllers = {mode: CONTROLLERS[mode]().tune(self) for mode in modes}
+        study = MonteCarlo(modes, controllers=controllers, **options)
+        study.run(progress)
+        return study
+
+    def run_scenario(self, scenario, mode='PID', factor=None):
+        """
+        Play a control_scenario.Scenario in `mode` (stopping the current
+        run); it ends with the scenario. A simulated plant runs `factor`
+        times faster than real time (None: as fast as possible), a board
+        in real time. scenario.history() returns every row of the run.
+        """
+        if self._run is not None and not self._run.stopped:
+            self._run.stop()
+        workers = [functools.partial(self._work, mode, scenario, factor)]
+        if hasattr(self, '_mode'):
+            self._mode.value = mode
+            self._mode.disabled = True
+            workers.append(self._render)
+        self._snapshot = None
+        self._run = self._runner.start(*workers, previous=self._run)
+        return self._run
+
+    def _make_schedule(self, **options):
+        return gain_schedule(**options)
+
+    def _schedule_html(self, text=None):
+        if text is None:
+            if self._schedule is None:
+                text = 'No table'
+            else:
+                points = self._schedule.points
+                text = '{} points, {:.0f}-{:.0f} C'.format(
+                    len(points), points[0], points[-1])
+        return '<p style="margin-top: 5px;"><i>{}</i></p>'.format(text)
+
+    def _generate_schedule(self, b):
+        self._runner.start(self._work_schedule)
+
+    async def _work_schedule(self):
+        # Generate a schedule in the background; Apply enables it
+        status = self._conf39.children[3]
+        self._conf39.children[2].disabled = True
+        status.value = self._schedule_html('Generating...')
+        try:
+            self._schedule = await self._runner.call(self._make_schedule)
+        finally:
+            self._conf39.children[2].disabled = False
+            status.value = self._schedule_html()
+
+    def _make_backend(self):
+        # Backend of a new run
+        if getattr(self, '_replay', None) is not None:
+            return ReplayBackend(self._replay)
+        return self._new_backend()
+
+    def _publish(self, t, T, Q1, Q2, SP_T1=None, SP_T2=None):
+        # Hand the latest history to the render task
+        self._snapshot = (t, T, Q1, Q2, SP_T1, SP_T2)
+
+    def _solve(self, controller, measurement, setpoint, state):
+        # Blocking controller step on a solver worker, traced there so its
+        # events land under the worker thread
+        with self._profiler.span('solve'):
+            return controller.step(measurement, setpoint, state)
+
+    def _tick_target(self, backend):
+        # Nominal tick period: real time plants sample every delta_t,
+        # simulated ones advance delta_t at the real-time factor
+        if backend.realtime:
+            return self._delta_t
+        factor = self._pacer.factor
+        return self._delta_t/factor if factor else float('inf')
+
+    ###########################################################################
+    #                                                           LOOP COROUTINE
+    ###########################################################################
+    async def _work(self, mode='Manual', scenario=None, factor=None):
+        # One loop for every mode: the controller of `mode` computes the
+        # heater values from each sample of the plant backend, optionally
+        # following the events of a scenario
+        controller = self._controller = CONTROLLERS[mode]()
+        backend = self._backend = self._make_backend()
+        try:
+            # Inside the try: a Stop while the board opens (acquisition
+            # already sampling) must still close the backend
+            T1, T2 = await backend.open(self._delta_t)
+            pacer = self._pacer = Pacer(self._factor if scenario is None
+                                        else factor, clock=self._clock)
+            if scenario is not None:
+                scenario.reset()
+                scenario.advance(0., self, getattr(backend, 'plant', None))
+
+            # Heater values applied since the last sample
+            Q10 = self._Q10
+            Q20 = self._Q20
+            await backend.write(Q10, Q20)
+
+            # history rows: t, T1, T2 (K), Q1, Q2, SP_T1, SP_T2
+            H = np.array([[0., T1 + 273.15, T2 + 273.15, Q10, Q20,
+                           self._T1_SP, self._T2_SP]])
+            state = {'t': 0., 'dt': self._delta_t, 'Q': (Q10, Q20),
+                     'last': (T1, T2)}
+            if scenario is not None:
+                scenario.record((0., T1, T2, Q10, Q20, self._T1_SP,
+                                 self._T2_SP))
+
+            prof = self._profiler
+            metrics = self._metrics
+            prof.new_run()
+            metrics.new_run()
+            while True:
+                prof.start()
+                if scenario is None:
+                    pacer.factor = self._factor
+                metrics.tick(self._tick_target(backend), len(H))
+
+                # Next sample of the plant
+                try:
+                    tm, T1, T2 = await backend.read(self._delta_t)
+                except EOFError:
+                    return
+                if scenario is not None:
+                    if tm > scenario.end:
+                        return
+                    scenario.advance(tm, self,
+                                     getattr(backend, 'plant', None))
+                prof.lap('read')
+
+                if len(H) >= self._maxtime:
+                    H = H[1:]
+                H = np.append(H, [[tm, T1 + 273.15, T2 + 273.15, Q10, Q20,
+                                   self._T1_SP, self._T2_SP]], axis=0)
+                if scenario is not None:
+                    scenario.record((tm, T1, T2, Q10, Q20, self._T1_SP,
+                                     self._T2_SP))
+                prof.lap('bookkeeping')
+
+                # Heater values of the controller
+                controller.tune(self)
+                state['t'] = tm
+                state['dt'] = self._delta_t
+                measurement = (T1, T2)
+                setpoint = (self._T1_SP, self._T2_SP)
+                if controller.blocking:
+                    solve_start = time.perf_counter()
+                    Q10, Q20 = await self._runner.call(
+                        self._solve, controller, measurement, setpoint,
+                        state)
+                    metrics.solve(time.perf_counter() - solve_start,
+                                  controller.solved)
+                else:
+                    Q10, Q20 = controller.step(measurement, setpoint, state)
+                state['Q'] = (Q10, Q20)
+                state['last'] = measurement
+                prof.lap('control')
+
+                await backend.write(Q10, Q20)
+                prof.lap('write')
+
+                if controller.setpoints:
+                    self._publish(H[:, 0], H[:, 1:3], H[:, 3], H[:, 4],
+                                  H[:, 5], H[:, 6])
+                else:
+                    self._publish(H[:, 0], H[:, 1:3], H[:, 3], H[:, 4])
+
+                # A board is paced by its acquisition thread: the next read
+                # waits for the next sample
+                if not backend.realtime:
+                    await pacer.wait(tm)
+                prof.lap('sleep')
+        finally:
+            await backend.close()
+
+    async def _work_compare(self, modes, seed=0):
+        # The controllers of `modes` on clones of the simulated plant, with
+        # the setpoints, heater values and tuning of the GUI
+        controllers = [CONTROLLERS[mode]() for mode in modes]
+        comparison = self._comparison = Comparison(
+            controllers, self._Tc0 - 273.15, seed=seed, keep=self._maxtime)
+        blocking = any(controller.blocking for controller in controllers)
+        pacer = self._pacer = Pacer(self._factor, clock=self._clock)
+        while True:
+            pacer.factor = self._factor
+            # Only the plotted window is kept (it follows delta_t)
+            comparison.keep(self._maxtime)
+            for controller in controllers:
+                controller.tune(self)
+            setpoint = (self._T1_SP, self._T2_SP)
+            if blocking:
+                await self._runner.call(comparison.step, self._delta_t,
+                                        setpoint)
+            else:
+                comparison.step(self._delta_t, setpoint)
+            self._compare_snapshot = comparison.history(self._maxtime)
+            await pacer.wait(comparison.t)
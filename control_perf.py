@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Performance instrumentation shared by control_demo.py and control_arduino.py
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+from contextlib import contextmanager
+import itertools
+import json
+import os
+import threading
+import time
+import weakref
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from control_clock import REAL
+
+
+class PhaseProfiler(object):
+    """
+    Rolling timers for each phase of a control loop tick
+    """
+    def __init__(self, phases, size=512):
+        """
+        phases = names of the phases timed inside a tick
+        size = number of samples kept per phase (rolling window)
+        """
+        self.enabled = True
+        self.tracer = None
+        self.phases = ['tick'] + list(phases)
+        self._index = dict((name, i) for i, name in enumerate(self.phases))
+        self._size = size
+        self._data = np.zeros((len(self.phases), size))
+        self._count = [0] * len(self.phases)
+        self._start = None
+        self._last = 0.
+
+    def reset(self):
+        self._data[:] = 0.
+        self._count = [0] * len(self.phases)
+        self._start = None
+
+    def new_run(self):
+        # The idle time between two runs is not a tick period
+        self._start = None
+
+    def start(self):
+        """
+        Mark the beginning of a tick (records the full tick period)
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._start is not None:
+            self._record(0, now - self._start)
+            if self.tracer is not None:
+                self.tracer.complete('tick', self._start, now)
+        self._start = now
+        self._last = now
+
+    def lap(self, phase):
+        """
+        Record the time elapsed since the last mark as `phase`
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        self._record(self._index[phase], now - self._last)
+        if self.tracer is not None:
+            self.tracer.complete(phase, self._last, now)
+        self._last = now
+
+    @contextmanager
+    def span(self, name):
+        """
+        Time a block running outside the tick sequence (other tasks or
+        threads); it is recorded as a phase if `name` is one, and traced
+        """
+        if not self.enabled:
+            yield
+            return
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, t0, time.perf_counter())
+
+    def record(self, name, t0, t1):
+        """
+        Record a block timed elsewhere from its perf_counter stamps
+        """
+        if not self.enabled:
+            return
+        if name in self._index:
+            self._record(self._index[name], t1 - t0)
+        if self.tracer is not None:
+            self.tracer.complete(name, t0, t1)
+
+    def _record(self, i, value):
+        n = self._count[i]
+        self._data[i, n % self._size] = value
+        self._count[i] = n + 1
+
+    def summary(self):
+        """
+        Return {phase: {count, mean, p50, p95, p99, max}} in milliseconds
+        """
+        stats = {}
+        for i, name in enumerate(self.phases):
+            n = min(self._count[i], self._size)
+            if n == 0:
+                continue
+            x = self._data[i, :n] * 1e3
+            p50, p95, p99 = np.percentile(x, [50, 95, 99])
+            stats[name] = {'count': self._count[i], 'mean': float(x.mean()),
+                           'p50': float(p50), 'p95': float(p95),
+                           'p99': float(p99), 'max': float(x.max())}
+        return stats
+
+    def html(self):
+        """
+        Render the summary as an HTML table for the configurator panel
+        """
+        stats = self.summary()
+        if not stats:
+            return '<p><i>No samples recorded yet.</i></p>'
+        cols = ['count', 'mean', 'p50', 'p95', 'p99', 'max']
+        head = ''.join('<th style="padding: 0 10px;">{}</th>'.format(c)
+                       for c in ['phase (ms)'] + cols)
+        rows = []
+        for name in self.phases:
+            if name not in stats:
+                continue
+            s = stats[name]
+            cells = ['<td style="padding: 0 10px;">{:d}</td>'.format(
+                s['count'])]
+            cells += ['<td style="padding: 0 10px;">{:.2f}</td>'.format(s[c])
+                      for c in cols[1:]]
+            rows.append('<tr><td><b>{}</b></td>{}</tr>'.format(
+                name, ''.join(cells)))
+        return '<table><tr>{}</tr>{}</table>'.format(head, ''.join(rows))
+
+
+class TraceRecorder(object):
+    """
+    Preallocated ring buffer of Chrome Trace Event records
+    """
+    def __init__(self, capacity=200000):
+        """
+        capacity = maximum number of events kept (oldest are overwritten)
+        """
+        self.capacity = capacity
+        self._name = np.zeros(capacity, dtype=np.int32)
+        self._tid = np.zeros(capacity, dtype=np.int64)
+        self._ts = np.zeros(capacity)
+        self._dur = np.zeros(capacity)
+        self._names = {}
+        self._threads = {}
+        self._counter = itertools.count()  # atomic slot allocation
+        self._n = 0
+        self._t0 = time.perf_counter()
+
+    def __len__(self):
+        return min(self._n, self.capacity)
+
+    def complete(self, name, t0, t1):
+        """
+        Record a complete (begin + end) event from perf_counter stamps
+        """
+        idx = self._names.get(name)
+        if idx is None:
+            idx = self._names.setdefault(name, len(self._names))
+        tid = threading.get_ident()
+        if tid not in self._threads:
+            self._threads[tid] = threading.current_thread().name
+        n = next(self._counter)
+        i = n % self.capacity
+        self._name[i] = idx
+        self._tid[i] = tid
+        self._ts[i] = t0
+        self._dur[i] = t1 - t0
+        self._n = n + 1
+
+    def events(self):
+        """
+        Return the recorded events as a list of Trace Event dicts
+        """
+        n = self._n
+        if n > self.capacity:
+            order = np.roll(np.arange(self.capacity), -(n % self.capacity))
+        else:
+            order = np.arange(n)
+        names = dict((v, k) for k, v in self._names.items())
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': 'tclab_jupyter'}}]
+        for tid, thread in self._threads.items():
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                           'tid': tid, 'args': {'name': thread}})
+        for i in order:
+            events.append({'name': names[int(self._name[i])], 'ph': 'X',
+                           'cat': 'loop', 'pid': pid,
+                           'tid': int(self._tid[i]),
+                           'ts': (self._ts[i] - self._t0) * 1e6,
+                           'dur': self._dur[i] * 1e6})
+        return events
+
+    def dump(self, path):
+        """
+        Write the trace as JSON loadable in Perfetto or chrome://tracing
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(),
+                       'displayTimeUnit': 'ms'}, f)
+        return path
+
+
+_metrics_ids = itertools.count(1)
+
+
+class LoopMetrics(object):
+    """
+    Plain counters and gauges written by the control loop thread
+
+    Each instance has a single writer (its loop), so updates are simple
+    attribute stores without locks; scrapes read whatever is current.
+    """
+    def __init__(self, name=None):
+        if name is None:
+            name = 'gui{}'.format(next(_metrics_ids))
+        self.name = name
+        self.ticks = 0
+        self.tick_seconds = 0.
+        self.tick_period = 0.
+        self.lateness = 0.
+        self.late_ticks = 0
+        self.last_tick = 0.
+        self.solves = 0
+        self.solve_seconds = 0.
+        self.solve_last = 0.
+        self.solve_failures = 0
+        self.serial_transactions = 0
+        self.serial_seconds = 0.
+        self.serial_last = 0.
+        self.buffer_samples = 0
+        self.link = None        # control_io.Connection, if any
+        self.clock = REAL       # clock of the tick periods
+        self._prev = None
+
+    def tick(self, target, samples):
+        """
+        Mark the start of a tick with its nominal period `target` (s)
+        """
+        now = self.clock.time()
+        if self._prev is not None:
+            period = now - self._prev
+            self.tick_period = period
+            self.tick_seconds += period
+            self.lateness = max(0., period - target)
+            if period > 1.1*target:
+                self.late_ticks += 1
+        self._prev = now
+        self.ticks += 1
+        self.last_tick = time.time()
+        self.buffer_samples = samples
+
+    def new_run(self):
+        # The idle time between two runs is not a tick period
+        self._prev = None
+
+    def solve(self, seconds, ok):
+        self.solves += 1
+        self.solve_seconds += seconds
+        self.solve_last = seconds
+        if not ok:
+            self.solve_failures += 1
+
+    def serial(self, seconds, transactions=1):
+        self.serial_transactions += transactions
+        self.serial_seconds += seconds
+        self.serial_last = seconds/transactions
+
+    # Link health, read from the connection's own counters
+    @property
+    def serial_slow(self):
+        return self.link.stats.slow if self.link is not None else 0
+
+    @property
+    def serial_timeouts(self):
+        return self.link.stats.timeouts if self.link is not None else 0
+
+    @property
+    def reconnects(self):
+        return self.link.reconnects if self.link is not None else 0
+
+
+# (name, type, help, LoopMetrics attribute)
+_METRICS = [
+    ('tclab_ticks_total', 'counter', 'Control loop ticks executed.',
+     'ticks'),
+    ('tclab_tick_seconds_total', 'counter',
+     'Sum of measured tick periods.', 'tick_seconds'),
+    ('tclab_tick_period_seconds', 'gauge', 'Last measured tick period.',
+     'tick_period'),
+    ('tclab_tick_lateness_seconds', 'gauge',
+     'Last tick period in excess of the nominal period.', 'lateness'),
+    ('tclab_late_ticks_total', 'counter',
+     'Ticks more than 10% longer than the nominal period.', 'late_ticks'),
+    ('tclab_last_tick_timestamp_seconds', 'gauge',
+     'Unix time of the last tick.', 'last_tick'),
+    ('tclab_solves_total', 'counter', 'MPC solves attempted.', 'solves'),
+    ('tclab_solve_seconds_total', 'counter', 'Time spent in MPC solves.',
+     'solve_seconds'),
+    ('tclab_solve_last_seconds', 'gauge', 'Latency of the last MPC solve.',
+     'solve_last'),
+    ('tclab_solve_failures_total', 'counter',
+     'MPC solves that raised or ended with APPSTATUS != 1.',
+     'solve_failures'),
+    ('tclab_serial_transactions_total', 'counter',
+     'Serial request/response transactions with the TCLab.',
+     'serial_transactions'),
+    ('tclab_serial_seconds_total', 'counter',
+     'Time spent in serial transactions.', 'serial_seconds'),
+    ('tclab_serial_last_seconds', 'gauge',
+     'Round-trip time of the last serial transaction.', 'serial_last'),
+    ('tclab_serial_slow_total', 'counter',
+     'Serial round trips slower than the slow threshold.', 'serial_slow'),
+    ('tclab_serial_timeouts_total', 'counter',
+     'Serial requests left unanswered within the serial timeout.',
+     'serial_timeouts'),
+    ('tclab_reconnects_total', 'counter',
+     'Reconnections of a lost TCLab link.', 'reconnects'),
+    ('tclab_buffer_samples', 'gauge', 'Samples held in the history arrays.',
+     'buffer_samples'),
+]
+
+_registry = weakref.WeakValueDictionary()
+_servers = {}
+
+
+def register_metrics(metrics):
+    """
+    Publish a LoopMetrics instance on every metrics endpoint
+    """
+    for name, other in list(_registry.items()):
+        if other is metrics:
+            del _registry[name]
+    _registry[metrics.name] = metrics
+
+
+def exposition():
+    """
+    Render all registered metrics in the Prometheus text format
+    """
+    items = sorted(_registry.items())
+    lines = []
+    for name, kind, doc, attr in _METRICS:
+        lines.append('# HELP {} {}'.format(name, doc))
+        lines.append('# TYPE {} {}'.format(name, kind))
+        for label, metrics in items:
+            lines.append('{}{{gui="{}"}} {!r}'.format(
+                name, label, float(getattr(metrics, attr))))
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep scrapes out of the notebook output
+        pass
+
+
+def start_metrics_server(port=9100, host='127.0.0.1'):
+    """
+    Start (once per port) a background HTTP server exposing /metrics
+    """
+    if port not in _servers:
+        server = ThreadingHTTPServer((host, port), _MetricsHandler)
+        thread = threading.Thread(target=server.serve_forever,
+                                  name='metrics:{}'.format(port))
+        thread.daemon = True
+        thread.start()
+        _servers[port] = server
+    return _servers[port]
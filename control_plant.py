@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Physical model of the TCLab (heaters and sensors) shared by the simulated
+app and the firmware emulator
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.integrate import odeint, solve_ivp
+
+
+def heater(x, t, Q1, Q2, U=4.87519009, Ta=23 + 273.15):
+    # Parameters
+    U = U + (np.random.rand()-0.5)  # variable convection
+    alpha1 = 0.00640897365
+    alpha2 = 0.00310952441
+
+    m = 4.0/1000.0       # kg
+    Cp = 0.5 * 1000.0    # J/kg-K
+    A = 10.0 / 100.0**2  # Area in m^2
+    As = 2.0 / 100.0**2  # Area in m^2
+    eps = 0.9            # Emissivity
+    sigma = 5.67e-8      # Stefan-Boltzman
+
+    # Temperature States
+    Th1 = x[0]
+    Th2 = x[1]
+
+    # Heat Transfer Exchange Between 1 and 2
+    conv12 = U*As*(Th2-Th1)
+    rad12 = eps*sigma*As * (Th2**4 - Th1**4)
+
+    # Nonlinear Energy Balances
+    dTh1dt = (1.0/(m*Cp)) * \
+             (U*A*(Ta-Th1) +
+              eps * sigma * A * (Ta**4 - Th1**4) +
+              conv12 + rad12 + alpha1*Q1)
+    dTh2dt = (1.0/(m*Cp)) * \
+             (U*A*(Ta-Th2) +
+              eps * sigma * A * (Ta**4 - Th2**4) -
+              conv12 - rad12 + alpha2*Q2)
+
+    return [dTh1dt, dTh2dt]
+
+
+def sensor(x, t, Th1, Th2):
+    # Parameter
+    tau = 17.7176964
+
+    # Temperature States
+    Tc1 = x[0]
+    Tc2 = x[1]
+
+    # lag equations to emulate conduction
+    dTc1dt = (-Tc1 + Th1)/tau
+    dTc2dt = (-Tc2 + Th2)/tau
+
+    return [dTc1dt, dTc2dt]
+
+
+class Plant(object):
+    """
+    Heater/sensor state of one TCLab advanced with odeint
+    """
+    def __init__(self, T0=23.):
+        """
+        T0 = initial temperature of heaters and sensors (C), either one
+             value or (T1, T2)
+        """
+        self.Th = np.zeros(2) + T0 + 273.15
+        self.Tc = self.Th.copy()
+        self.U = 4.87519009   # W/m^2-K
+        self.Ta = 23 + 273.15  # K
+
+    def step(self, dt, Q1, Q2):
+        """
+        Advance `dt` seconds with constant heater outputs; returns the
+        sensor temperatures in Celsius
+        """
+        ts = [0., dt]
+        self.Th = odeint(heater, self.Th, ts,
+                         args=(Q1, Q2, self.U, self.Ta))[-1]
+        self.Tc = odeint(sensor, self.Tc, ts,
+                         args=(self.Th[0], self.Th[1]))[-1]
+        return self.Tc - 273.15
+
+
+def heater_batch(x, t, Q, U, alpha, Ta):
+    # heater() of n plants: x holds (Th1, Th2) of each plant, Q is (n, 2),
+    # U (n,) and Ta (n,) per plant, alpha (n, 2)
+    m = 4.0/1000.0       # kg
+    Cp = 0.5 * 1000.0    # J/kg-K
+    A = 10.0 / 100.0**2  # Area in m^2
+    As = 2.0 / 100.0**2  # Area in m^2
+    eps = 0.9            # Emissivity
+    sigma = 5.67e-8      # Stefan-Boltzman
+
+    Th = x.reshape(-1, 2)
+    Th4 = Th**4
+    exchange = U*As*(Th[:, 1] - Th[:, 0]) + \
+        eps*sigma*As*(Th4[:, 1] - Th4[:, 0])
+    dThdt = U[:, None]*A*(Ta[:, None] - Th) + \
+        eps*sigma*A*(Ta[:, None]**4 - Th4) + alpha*Q
+    dThdt[:, 0] += exchange
+    dThdt[:, 1] -= exchange
+    return (dThdt/(m*Cp)).ravel()
+
+
+def sensor_batch(x, t, Th, tau):
+    # sensor() of n plants: lag of every sensor behind its heater
+    return (Th - x)/tau
+
+
+class PlantBatch(object):
+    """
+    n independent TCLabs advanced together: one odeint call integrates the
+    heaters of every plant and another one their sensors
+
+    Unlike heater(), which draws a new convection coefficient at every
+    evaluation, U is drawn once per plant and step from a seeded
+    generator, so runs are reproducible. Plant parameters are arrays that
+    can be spread or changed between steps (e.g. the ambient Ta).
+    """
+    def __init__(self, n, T0=23., convection=1., seed=None, common=False):
+        """
+        n = number of plants
+        T0 = initial temperature of heaters and sensors (C), broadcast to
+             (n, 2)
+        convection = width of the uniform random variation of U (W/m^2-K)
+        seed = seed of the convection variation
+        common = draw one variation per step for all the plants, so they
+                 face the same disturbance
+        """
+        self.n = n
+        self.Th = np.zeros((n, 2)) + np.asarray(T0) + 273.15
+        self.Tc = self.Th.copy()
+        self.U = np.full(n, 4.87519009)
+        self.alpha = np.tile([0.00640897365, 0.00310952441], (n, 1))
+        self.tau = np.full((n, 2), 17.7176964)
+        self.Ta = np.full(n, 23 + 273.15)
+        self.convection = convection
+        self.common = common
+        self.random = np.random.RandomState(seed)
+
+    def step(self, dt, Q):
+        """
+        Advance `dt` seconds with constant heater outputs Q (n, 2); returns
+        the sensor temperatures (n, 2) in Celsius
+        """
+        Q = np.broadcast_to(Q, (self.n, 2))
+        U = self.U + self.convection*(
+            self.random.rand(1 if self.common else self.n) - 0.5)
+        ts = [0., dt]
+        self.Th = odeint(heater_batch, self.Th.ravel(), ts,
+                         args=(Q, U, self.alpha, self.Ta))[-1].reshape(-1, 2)
+        self.Tc = odeint(sensor_batch, self.Tc.ravel(), ts,
+                         args=(self.Th.ravel(), self.tau.ravel()))[-1]
+        self.Tc = self.Tc.reshape(-1, 2)
+        return self.Tc - 273.15
+
+    def steady(self, T):
+        """
+        Heater outputs (n, 2) holding both heaters of every plant at T (C,
+        broadcast to (n, 2)) with the nominal U; may be outside 0-100 %
+        """
+        x = (np.zeros((self.n, 2)) + np.asarray(T) + 273.15).ravel()
+        zero = np.zeros((self.n, 2))
+        # The heater balance is affine in Q
+        f0 = heater_batch(x, 0., zero, self.U, self.alpha, self.Ta)
+        f1 = heater_batch(x, 0., zero + 1., self.U, self.alpha, self.Ta)
+        return (-f0/(f1 - f0)).reshape(-1, 2)
+
+
+def simulate_on_off(setpoints, deadband=(0.1, 0.1), duration=1800., T0=23.,
+                    Q=(0., 100.), dt=None, output=1., rtol=1e-6, atol=1e-6):
+    """
+    On-Off control of one TCLab model (nominal U) in continuous time
+
+    With dt=None a heater switches exactly when its sensor crosses the
+    setpoint -/+ deadband: solve_ivp stops on these events and restarts
+    from the switching state, so integration only works from switch to
+    switch. With dt the deadband is checked every dt seconds, as the
+    sampled controller of the GUIs does, for comparison.
+
+    setpoints = (SP_T1, SP_T2) (C)
+    deadband = (dT1, dT2) (C)
+    Q = heater output when off and when on (%)
+    output = period of the returned trajectory (s)
+    rtol, atol = tolerances of solve_ivp
+
+    Returns a dict with t, T (len(t), 2) sensor temperatures (C), Q
+    (len(t), 2), switches [(t, heater, Q), ...], period (mean of the last
+    three on-to-on intervals of each heater, nan before) and nfev, the
+    number of right-hand side evaluations.
+    """
+    plant = PlantBatch(1, T0, convection=0.)
+    sp = np.asarray(setpoints, dtype=float) + 273.15
+    db = np.asarray(deadband, dtype=float)
+    x = np.concatenate((plant.Th[0], plant.Tc[0]))
+    on = x[2:] < sp
+
+    def rhs(t, x, Qs):
+        dTh = heater_batch(x[:2], t, Qs[None, :], plant.U, plant.alpha,
+                           plant.Ta)
+        return np.concatenate((dTh, sensor_batch(x[2:], t, x[:2],
+                                                 plant.tau[0])))
+
+    def crossing(i, on):
+        # The sensor leaving the deadband on the side that switches it
+        level = sp[i] + db[i] if on else sp[i] - db[i]
+
+        def event(t, x, Qs):
+            return x[2 + i] - level
+        event.terminal = True
+        event.direction = 1 if on else -1
+        return event
+
+    grid = np.arange(0., duration + output/2., output)
+    T = np.zeros((len(grid), 2))
+    Qout = np.zeros((len(grid), 2))
+    switches = []
+    nfev = 0
+    t = 0.
+    while t < duration:
+        Qs = np.where(on, Q[1], Q[0])
+        if dt is None:
+            end = duration
+            events = [crossing(0, on[0]), crossing(1, on[1])]
+        else:
+            end = min(duration, t + dt)
+            events = None
+        sol = solve_ivp(rhs, (t, end), x, args=(Qs,), events=events,
+                        dense_output=True, rtol=rtol, atol=atol)
+        nfev += sol.nfev
+        inside = (grid >= t) & (grid <= sol.t[-1])
+        if inside.any():
+            T[inside] = sol.sol(grid[inside])[2:].T - 273.15
+            Qout[inside] = Qs
+        t = sol.t[-1]
+        x = sol.y[:, -1]
+
+        if dt is None:
+            switched = [i for i in (0, 1) if len(sol.t_events[i])]
+            new = on.copy()
+            new[switched] = ~on[switched]
+        else:
+            new = np.where(x[2:] < sp - db, True,
+                           np.where(x[2:] > sp + db, False, on))
+        for i in np.flatnonzero(new != on):
+            switches.append((float(t), int(i), Q[int(new[i])]))
+        on = new
+
+    period = []
+    for i in (0, 1):
+        starts = [s[0] for s in switches if s[1] == i and s[2] == Q[1]]
+        period.append(float(np.mean(np.diff(starts[-4:])))
+                      if len(starts) > 1 else np.nan)
+    return {'t': grid, 'T': T, 'Q': Qout, 'switches': switches,
+            'period': tuple(period), 'nfev': nfev}
+
+
+class Shadow(object):
+    """
+    Plant model run in lockstep with a real board, fed with the heater
+    outputs actually applied, reporting the rolling prediction residual
+
+    The model runs free (it is never corrected by the measurements), so a
+    growing residual reveals a mismatch: a detached sensor, a degraded
+    heater, a different ambient. Steps run on a background thread, so
+    `update` only queues work and costs the control loop next to nothing.
+    """
+    def __init__(self, window=60, limit=3.):
+        """
+        window = number of samples in the rolling residual statistics
+        limit = mean absolute residual (C) above which `alarm` is raised;
+                a residual changing sign (loose sensor, relay-driven loop)
+                raises it too, although its mean is near zero
+        """
+        self.limit = limit
+        self.plant = None
+        self._window = window
+        self._residual = np.zeros((window, 2))
+        self._count = 0
+        self._last = None
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='tclab-shadow')
+
+    def reset(self):
+        """
+        Restart the model from the next measurement
+        """
+        self._executor.submit(self._reset)
+
+    def _reset(self):
+        self.plant = None
+        self._count = 0
+        self._last = None
+
+    def update(self, stamp, T1, T2, Q1, Q2):
+        """
+        Feed a measurement (stamp in ns, temperatures in C) and the heater
+        outputs applied from now on
+        """
+        self._executor.submit(self._step, stamp, T1, T2, Q1, Q2)
+
+    def _step(self, stamp, T1, T2, Q1, Q2):
+        if self.plant is None:
+            # Start from the measured temperatures, assumed at rest
+            self.plant = Plant((T1, T2))
+        else:
+            last_stamp, last_Q1, last_Q2 = self._last
+            dt = (stamp - last_stamp)*1e-9
+            if dt > 0.:
+                T = self.plant.step(dt, last_Q1, last_Q2)
+                self._residual[self._count % self._window] = (T1 - T[0],
+                                                              T2 - T[1])
+                self._count += 1
+        self._last = (stamp, Q1, Q2)
+
+    def summary(self):
+        """
+        Return the rolling residual (measured - model) statistics in C
+        """
+        n = min(self._count, self._window)
+        if n == 0:
+            return {'samples': 0, 'alarm': False}
+        r = self._residual[:n]
+        mean = r.mean(axis=0)
+        mae = np.abs(r).mean(axis=0)
+        rms = np.sqrt((r**2).mean(axis=0))
+        last = self._residual[(self._count - 1) % self._window]
+        return {'samples': self._count,
+                'last': tuple(last.tolist()),
+                'mean': tuple(mean.tolist()),
+                'mae': tuple(mae.tolist()),
+                'rms': tuple(rms.tolist()),
+                'alarm': bool(mae.max() > self.limit)}
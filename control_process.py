@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Run a control engine in a separate process, sharing its history with the
+notebook through a multiprocessing.shared_memory ring buffer
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import asyncio
+import functools
+import multiprocessing as mp
+import queue
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+# Columns of each history row
+COLUMNS = ('t', 'T1', 'T2', 'Q1', 'Q2', 'SP_T1', 'SP_T2')
+
+
+class HistoryRing(object):
+    """
+    Ring buffer of history rows laid over a (shared) memory buffer
+
+    The first 8 bytes hold the number of rows ever written; the writer
+    stores the row before bumping the count so readers never see a row
+    that is only half written.
+    """
+    def __init__(self, buf, capacity, columns=len(COLUMNS)):
+        self.capacity = capacity
+        self._count = np.ndarray((1,), dtype=np.int64, buffer=buf)
+        self.data = np.ndarray((capacity, columns), dtype=np.float64,
+                               buffer=buf, offset=8)
+
+    @staticmethod
+    def nbytes(capacity, columns=len(COLUMNS)):
+        return 8 + 8*capacity*columns
+
+    def __len__(self):
+        return min(int(self._count[0]), self.capacity)
+
+    def append(self, row):
+        n = int(self._count[0])
+        self.data[n % self.capacity] = row
+        self._count[0] = n + 1
+
+    def last(self, n):
+        """
+        Return the last `n` rows in order, as a view unless they wrap
+        """
+        count = int(self._count[0])
+        n = min(n, count, self.capacity)
+        start = (count - n) % self.capacity
+        if start + n <= self.capacity:
+            return self.data[start:start+n]
+        return np.concatenate((self.data[start:],
+                               self.data[:start+n-self.capacity]))
+
+
+class ProcessEngine(object):
+    """
+    Control engine running one `work` loop of a headless GUI in a child
+    process; setpoints and parameters are sent over a command queue
+    """
+    def __init__(self, factory, work, params, capacity=4096, args=()):
+        """
+        factory = importable class building a headless engine, called as
+                  factory(headless=True) in the child
+        work = name of the loop coroutine to run (e.g. '_work')
+        params = {attribute: value} applied before the loop starts
+        capacity = number of history rows kept in shared memory
+        args = positional arguments of the loop coroutine (e.g. the mode)
+        """
+        ctx = mp.get_context('spawn')
+        self._shm = SharedMemory(create=True,
+                                 size=HistoryRing.nbytes(capacity))
+        self.ring = HistoryRing(self._shm.buf, capacity)
+        self.ring._count[0] = 0
+        self._commands = ctx.Queue()
+        self._process = ctx.Process(
+            target=_child_main, name='tclab-engine',
+            args=(factory, work, args, params, self._shm.name, capacity,
+                  self._commands))
+        self._process.daemon = True
+        self._process.start()
+
+    def alive(self):
+        return self._process.is_alive()
+
+    def send(self, name, value):
+        """
+        Set attribute `name` of the engine in the child process
+        """
+        self._commands.put(('set', name, value))
+
+    def history(self, n):
+        return self.ring.last(n)
+
+    def stop(self, timeout=5.):
+        """
+        Stop the child (terminating it if it does not exit in time) and
+        release the shared memory
+        """
+        if self._process.is_alive():
+            self._commands.put(('stop',))
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+                self._process.join()
+        self._shm.unlink()
+        try:
+            self._shm.close()
+        except BufferError:
+            # Views still handed out; the mapping goes away with them
+            pass
+
+
+###############################################################################
+#                                                                CHILD PROCESS
+###############################################################################
+def _child_main(factory, work, args, params, shm_name, capacity, commands):
+    shm = SharedMemory(name=shm_name)
+    ring = HistoryRing(shm.buf, capacity)
+    engine = factory(headless=True)
+    for name, value in params.items():
+        setattr(engine, name, value)
+    engine._publish = functools.partial(_publish, ring)
+    loop = functools.partial(getattr(engine, work), *args)
+    run = engine._runner.start(loop,
+                               functools.partial(_commands, engine, commands))
+    try:
+        run.future.result()
+    finally:
+        del ring, engine
+        shm.close()
+
+
+def _publish(ring, t, T, Q1, Q2, SP_T1=None, SP_T2=None):
+    ring.append((t[-1], T[-1, 0], T[-1, 1], Q1[-1], Q2[-1],
+                 np.nan if SP_T1 is None else SP_T1[-1],
+                 np.nan if SP_T2 is None else SP_T2[-1]))
+
+
+async def _commands(engine, commands):
+    # Apply commands from the notebook; returning ends the run
+    while True:
+        try:
+            cmd = commands.get_nowait()
+        except queue.Empty:
+            await asyncio.sleep(0.05)
+            continue
+        if cmd[0] == 'stop':
+            return
+        if cmd[0] == 'set':
+            setattr(engine, cmd[1], cmd[2])
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Test scenarios: timed setpoint changes, manual heater moves, ambient
+changes and disturbances played by the control loop of control_loops.py
+
+A scenario is built with the Python API
+
+    Scenario().at(0, SP1=40, SP2=35).at(600, Ta=30).at(900, U=10, hold=120)
+
+or read from a text file with one event per line, time first (s):
+
+    # t    actions
+    0      SP1=40 SP2=35
+    300    Q1=50
+    600    Ta=30
+    900    U=10 hold=120
+    1800   end
+
+`hold` reverts the values of an event after that many seconds and `end`
+stops the run (by default, the run ends with the last event).
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import bisect
+import numpy as np
+
+# Event keys set on the GUI: setpoints (C) and manual heater values (%)
+ACTIONS = {'SP1': '_T1_SP', 'SP2': '_T2_SP', 'Q1': '_Q10', 'Q2': '_Q20'}
+
+# Event keys set on the simulated plant: ambient temperature (C) and
+# convection coefficient (W/m^2-K, e.g. a fan blowing on the board)
+PLANT = ('Ta', 'U')
+
+
+class Scenario(object):
+    """
+    Timed events of a test run
+    """
+    def __init__(self, end=None):
+        """
+        end = time at which the run stops (s), default the last event
+        """
+        self.events = []
+        self._end = end
+        self.log = []
+        self._rows = []
+        self._pending = []
+
+    def at(self, t, hold=None, **values):
+        """
+        Add an event at `t` s setting `values` (keys of ACTIONS and
+        PLANT), reverted after `hold` s if given; returns the scenario
+        """
+        for key in values:
+            if key not in ACTIONS and key not in PLANT:
+                raise ValueError('Unknown scenario key: {}'.format(key))
+        self.events.append((float(t), dict(values), hold))
+        self.events.sort(key=lambda event: event[0])
+        return self
+
+    def until(self, t):
+        """
+        Stop the run at `t` s; returns the scenario
+        """
+        self._end = float(t)
+        return self
+
+    @property
+    def end(self):
+        if self._end is not None:
+            return self._end
+        return max([t + (hold or 0.) for t, values, hold in self.events] +
+                   [0.])
+
+    @classmethod
+    def parse(cls, text):
+        """
+        Scenario of the text format described in the module docstring
+        """
+        scenario = cls()
+        for number, line in enumerate(text.splitlines(), 1):
+            words = line.split('#')[0].split()
+            if not words:
+                continue
+            try:
+                t = float(words[0])
+                if words[1:] == ['end']:
+                    scenario.until(t)
+                    continue
+                values = dict((key, float(value)) for key, value in
+                              (word.split('=') for word in words[1:]))
+                hold = values.pop('hold', None)
+                scenario.at(t, hold, **values)
+            except ValueError as error:
+                raise ValueError('Line {}: {} ({})'.format(
+                    number, line.strip(), error))
+        return scenario
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.parse(f.read())
+
+    def save(self, path):
+        lines = ['# t    actions']
+        for t, values, hold in self.events:
+            words = ['{}={:g}'.format(k, v) for k, v in values.items()]
+            if hold is not None:
+                words.append('hold={:g}'.format(hold))
+            lines.append('{:<8g} {}'.format(t, ' '.join(words)))
+        if self._end is not None:
+            lines.append('{:<8g} end'.format(self._end))
+        with open(path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    ###########################################################################
+    #                                                                 PLAYBACK
+    ###########################################################################
+    def reset(self):
+        """
+        Rewind the scenario before a run
+        """
+        self.log = []
+        self._rows = []
+        self._pending = [(t, i, values, hold)
+                         for i, (t, values, hold) in enumerate(self.events)]
+
+    def advance(self, t, target, plant=None):
+        """
+        Apply the events due at `t` s: ACTIONS on the GUI `target`, PLANT
+        keys on the simulated `plant` (control_plant.Plant), skipped with
+        other backends. Every applied event is logged as (t, key, value).
+        """
+        while self._pending and self._pending[0][0] <= t:
+            when, i, values, hold = self._pending.pop(0)
+            previous = {}
+            for key, value in values.items():
+                if key in ACTIONS:
+                    previous[key] = getattr(target, ACTIONS[key])
+                    setattr(target, ACTIONS[key], value)
+                elif plant is None:
+                    self.log.append((t, key, 'skipped'))
+                    continue
+                elif key == 'Ta':
+                    previous[key] = plant.Ta - 273.15
+                    plant.Ta = value + 273.15
+                else:
+                    previous[key] = plant.U
+                    plant.U = value
+                self.log.append((t, key, value))
+            if hold is not None and previous:
+                bisect.insort(self._pending,
+                              (when + hold, i, previous, None))
+
+    def record(self, row):
+        # Row (t, T1, T2, Q1, Q2, SP_T1, SP_T2) of the run
+        self._rows.append(row)
+
+    def history(self):
+        """
+        Every row (t, T1, T2, Q1, Q2, SP_T1, SP_T2) of the last run,
+        temperatures in Celsius
+        """
+        return np.array(self._rows, dtype=float).reshape(-1, 7)
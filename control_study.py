@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo studies of the control modes on the simulated TCLab
+
+Each run is a headless closed-loop simulation of one plant with random
+convection (U) disturbances, measurement noise and plant parameters spread
+around their nominal values. Runs are grouped in batches of plants
+(control_plant.PlantBatch) stepped by the step_batch() of the controllers
+of control_controllers.py, and the batches are spread over a process pool.
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import collections
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from control_controllers import CONTROLLERS
+from control_plant import PlantBatch
+from control_tuning import PROFILE
+
+# Key performance indicators of kpis()
+KPIS = ('IAE', 'overshoot', 'energy')
+
+
+def run_batch(controller, n, profile=PROFILE, duration=1000., dt=1.,
+              noise=0., convection=1., spread=0., seed=0, T0=23.):
+    """
+    Closed-loop runs of `controller` on n simulated TCLabs at once
+
+    profile = setpoint steps ((t, SP_T1, SP_T2), ...) from t = 0
+    duration = simulated time (s)
+    dt = sampling period of the controller (s)
+    noise = width of the uniform measurement noise (C)
+    convection = width of the uniform random variation of U (W/m^2-K)
+    spread = relative spread of U, alpha and tau between plants (uniform,
+             0.1 for +/-10 %)
+    seed = seed of the spread, disturbances and noise
+
+    Returns t (k,), T (k, n, 2) measurements, Q (k, n, 2) heater outputs,
+    SP (k, 2) setpoints and the plants.
+    """
+    random = np.random.RandomState(seed)
+    plant = PlantBatch(n, T0, convection=convection,
+                       seed=random.randint(2**31))
+    plant.U *= 1. + spread*(2.*random.rand(n) - 1.)
+    plant.alpha *= 1. + spread*(2.*random.rand(n, 2) - 1.)
+    plant.tau *= 1. + spread*(2.*random.rand(n, 2) - 1.)
+
+    t = np.arange(int(round(duration/dt)) + 1)*dt
+    steps = np.array(profile, dtype=float)
+    SP = steps[np.searchsorted(steps[:, 0], t, side='right') - 1, 1:]
+    T = np.zeros((len(t), n, 2))
+    Q = np.zeros((len(t), n, 2))
+
+    Tm = plant.Tc - 273.15
+    state = {'t': 0., 'dt': dt, 'Q': np.zeros((n, 2)), 'last': Tm}
+    for k in range(len(t)):
+        Tm = Tm + noise*(random.rand(n, 2) - 0.5)
+        T[k] = Tm
+        state['t'] = t[k]
+        Q[k] = controller.step_batch(Tm, SP[k], state)
+        state['Q'] = Q[k]
+        state['last'] = Tm
+        if k < len(t) - 1:
+            Tm = plant.step(dt, Q[k])
+    return t, T, Q, SP, plant
+
+
+def kpis(t, T, Q, SP, plant):
+    """
+    Key performance indicators (n, 2) of each heater of each run of
+    run_batch():
+
+    IAE = integral of the absolute error (K s)
+    overshoot = largest excursion past a setpoint in the direction of its
+                step (K)
+    energy = heater energy (J)
+    """
+    dt = t[1] - t[0]
+    error = T - SP[:, None, :]
+
+    # Direction of the step that led to each setpoint (the first one from
+    # the initial temperature)
+    change = np.concatenate(([True], (np.diff(SP, axis=0) != 0.).any(1)))
+    levels = SP[change][:, None, :]
+    before = np.concatenate((T[:1], np.broadcast_to(
+        levels[:-1], (len(levels) - 1,) + T.shape[1:])))
+    direction = np.sign(levels - before)[np.cumsum(change) - 1]
+
+    return {'IAE': np.abs(error).sum(axis=0)*dt,
+            'overshoot': np.maximum((direction*error).max(axis=0), 0.),
+            'energy': (Q*plant.alpha).sum(axis=0)*dt}
+
+
+def check_modes(modes, controllers=None):
+    """
+    Raise ValueError unless every mode is a key of CONTROLLERS (or of
+    `controllers`, {mode: controller}) that can run on several plants
+    """
+    controllers = controllers or {}
+    for mode in modes:
+        if mode in controllers:
+            controller = controllers[mode]
+        elif mode in CONTROLLERS:
+            controller = CONTROLLERS[mode]
+        else:
+            raise ValueError('Unknown mode: {}'.format(mode))
+        if controller.single:
+            raise ValueError('{} runs on a single plant'.format(mode))
+
+
+def _study(controller, n, scenario, seed):
+    return kpis(*run_batch(controller, n, seed=seed, **scenario))
+
+
+class MonteCarlo(object):
+    """
+    Monte Carlo comparison of control modes on the simulated plant
+
+    Every mode runs on the same `runs` random plants: the batches are
+    seeded from `seed` independently of the mode and of the number of
+    workers, so the results are reproducible and the modes face the same
+    disturbances and noise.
+    """
+    def __init__(self, modes=('On-Off', 'PID'), runs=100, profile=PROFILE,
+                 duration=1000., dt=1., noise=0.5, convection=1.,
+                 spread=0.1, seed=0, batch=25, workers=None,
+                 controllers=None):
+        """
+        modes = keys of control_controllers.CONTROLLERS
+        runs = number of runs of each mode
+        profile, duration, dt, noise, convection, spread = see run_batch()
+        batch = number of plants simulated together
+        workers = number of worker processes (default: one per CPU)
+        controllers = {mode: controller} replacing the default ones, e.g.
+                      with a tuning of the GUI
+        """
+        self.modes = tuple(modes)
+        check_modes(self.modes, controllers)
+        self.runs = runs
+        self.scenario = dict(profile=profile, duration=duration, dt=dt,
+                             noise=noise, convection=convection,
+                             spread=spread)
+        self.seed = seed
+        self.batch = batch
+        self.workers = workers or os.cpu_count() or 1
+        self.controllers = dict(controllers or {})
+        self.result = None
+        self.seconds = None
+
+    def controller(self, mode):
+        if mode in self.controllers:
+            return self.controllers[mode]
+        return CONTROLLERS[mode]()
+
+    def run(self, progress=None):
+        """
+        Simulate every run of every mode and return {mode: {kpi: array
+        (runs, 2)}}; progress(done, total) is called as batches complete
+        """
+        start = time.perf_counter()
+        sizes = [min(self.batch, self.runs - i)
+                 for i in range(0, self.runs, self.batch)]
+        seeds = [int(s.generate_state(1)[0]) for s in
+                 np.random.SeedSequence(self.seed).spawn(len(sizes))]
+        result = {mode: {kpi: np.zeros((self.runs, 2)) for kpi in KPIS}
+                  for mode in self.modes}
+        total = len(self.modes)*len(sizes)
+        with ProcessPoolExecutor(self.workers,
+                                 mp_context=mp.get_context('spawn')) as pool:
+            futures = {}
+            for mode in self.modes:
+                controller = self.controller(mode)
+                for j, (size, seed) in enumerate(zip(sizes, seeds)):
+                    future = pool.submit(_study, controller, size,
+                                         self.scenario, seed)
+                    futures[future] = (mode, j*self.batch, size)
+            for done, future in enumerate(as_completed(futures), 1):
+                mode, first, size = futures[future]
+                for kpi, values in future.result().items():
+                    result[mode][kpi][first:first + size] = values
+                if progress is not None:
+                    progress(done, total)
+        self.result = result
+        self.seconds = time.perf_counter() - start
+        return result
+
+    def summary(self):
+        """
+        Mean, 5th, 50th and 95th percentiles of every KPI of each mode, per
+        heater: {mode: {kpi: {'mean': (h1, h2), 'p5': ..., ...}}}
+        """
+        if self.result is None:
+            self.run()
+        summary = {}
+        for mode, values in self.result.items():
+            summary[mode] = {}
+            for kpi, x in values.items():
+                stats = {'mean': x.mean(axis=0)}
+                for p in (5, 50, 95):
+                    stats['p{}'.format(p)] = np.percentile(x, p, axis=0)
+                summary[mode][kpi] = {k: tuple(v.tolist())
+                                      for k, v in stats.items()}
+        return summary
+
+
+class Comparison(object):
+    """
+    Controllers side by side on clones of one simulated TCLab
+
+    The clones are the rows of one PlantBatch advanced together; on every
+    step they share the same convection disturbance and measurement noise,
+    drawn from one seeded generator, so the traces only differ by the
+    control.
+    """
+    def __init__(self, controllers, T0=23., noise=1.0, convection=1.,
+                 seed=0, keep=None):
+        """
+        controllers = one controller of control_controllers.py per clone
+        T0 = initial temperatures (C)
+        noise = width of the uniform measurement noise (C)
+        convection = width of the uniform random variation of U (W/m^2-K)
+        seed = seed of the disturbance and noise
+        keep = number of steps kept in the history (None: all)
+        """
+        self.controllers = list(controllers)
+        for controller in self.controllers:
+            if controller.single:
+                raise ValueError('{} runs on a single plant'.format(
+                    type(controller).__name__))
+        n = len(self.controllers)
+        self.plant = PlantBatch(n, T0, convection=0.)
+        self.noise = noise
+        self.convection = convection
+        self.random = np.random.RandomState(seed)
+        self._U = self.plant.U.copy()
+        self.t = 0.
+        self.T = self.plant.Tc - 273.15
+        self.Q = np.zeros((n, 2))
+        self.states = [{'t': 0., 'dt': 0., 'Q': (0., 0.),
+                        'last': tuple(T)} for T in self.T]
+        self._rows = collections.deque(maxlen=keep)
+
+    def keep(self, n):
+        """
+        Keep only the last `n` steps in the history (None: all)
+        """
+        if n != self._rows.maxlen:
+            self._rows = collections.deque(self._rows, maxlen=n)
+
+    def step(self, dt, setpoint):
+        """
+        Heater moves of every controller on the current measurements, then
+        dt seconds of the clones with them; returns the new measurements
+        (n, 2)
+        """
+        for i, (controller, state) in enumerate(zip(self.controllers,
+                                                    self.states)):
+            state['t'] = self.t
+            state['dt'] = dt
+            measurement = tuple(self.T[i])
+            state['Q'] = controller.step(measurement, setpoint, state)
+            state['last'] = measurement
+        self.Q = np.array([state['Q'] for state in self.states], dtype=float)
+        self._rows.append((self.t, self.T, self.Q, setpoint))
+
+        self.plant.U[:] = self._U + self.convection*(self.random.rand() - 0.5)
+        T = self.plant.step(dt, self.Q)
+        self.T = T + self.noise*(self.random.rand(2) - 0.5)
+        self.t += dt
+        return self.T
+
+    def history(self, n=None):
+        """
+        Last `n` steps: t (k,), T (k, clones, 2) measurements, Q (k, clones,
+        2) heater outputs and SP (k, 2) setpoints
+        """
+        rows = list(self._rows)[-n:] if n else list(self._rows)
+        if not rows:
+            return (np.zeros(0), np.zeros((0, len(self.controllers), 2)),
+                    np.zeros((0, len(self.controllers), 2)), np.zeros((0, 2)))
+        t, T, Q, SP = zip(*rows)
+        return (np.array(t), np.array(T), np.array(Q),
+                np.array(SP, dtype=float))
+
+    def run(self, profile=PROFILE, duration=1000., dt=1.):
+        """
+        Follow the setpoint steps of `profile` for `duration` s; returns
+        the history and the plants, as run_batch() (for kpis())
+        """
+        steps = np.array(profile, dtype=float)
+        for k in range(int(round(duration/dt)) + 1):
+            t = k*dt
+            i = np.searchsorted(steps[:, 0], t, side='right') - 1
+            self.step(dt, tuple(steps[i, 1:]))
+        return self.history() + (self.plant,)
@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline PID tuning on the simulated TCLab
+
+Candidate gains are scored on headless closed-loop runs of the plant model
+(control_plant.PlantBatch) with the PID of control_controllers.PIDBank.
+Each worker of a process pool simulates a whole chunk of candidates as one
+batch of plants. gain_schedule() builds a gain schedule from open-loop step
+tests of the model.
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from scipy.optimize import minimize
+from control_controllers import PIDBank, Schedule
+from control_plant import PlantBatch
+
+# Range of the PID sliders of the GUIs: Kc (%/K), tauI (s), tauD (s)
+BOUNDS = np.array([[0., 20.], [0., 200.], [0., 10.]])
+
+# Default test: setpoint steps (t, SP_T1, SP_T2) across the usual range
+PROFILE = ((0., 40., 35.), (400., 30., 30.), (700., 50., 40.))
+
+
+def simulate(gains, profile=PROFILE, duration=1000., dt=1., noise=0.,
+             seed=0, T0=23.):
+    """
+    Closed-loop PID runs of the simulated TCLab, one plant per candidate
+
+    gains = array (n, 6) of Kc1, tauI1, tauD1, Kc2, tauI2, tauD2
+    profile = setpoint steps ((t, SP_T1, SP_T2), ...) from t = 0
+    duration = simulated time (s)
+    dt = sampling period of the controllers (s)
+    noise = width of the uniform measurement noise (C)
+    seed = seed of the convection variation and measurement noise
+
+    Every candidate faces the same disturbance and noise sequences, so
+    scores do not depend on how candidates are split into batches.
+
+    Returns t (k,), T (k, n, 2) measurements, Q (k, n, 2) heater outputs
+    and SP (k, 2) setpoints.
+    """
+    gains = np.atleast_2d(gains)
+    n = len(gains)
+    plant = PlantBatch(n, T0, seed=seed, common=True)
+    bank = PIDBank(2*n, Kc=gains[:, [0, 3]].ravel(),
+                   tauI=gains[:, [1, 4]].ravel(),
+                   tauD=gains[:, [2, 5]].ravel())
+    random = np.random.RandomState(seed)
+
+    t = np.arange(int(round(duration/dt)) + 1)*dt
+    steps = np.array(profile, dtype=float)
+    SP = steps[np.searchsorted(steps[:, 0], t, side='right') - 1, 1:]
+    T = np.zeros((len(t), n, 2))
+    Q = np.zeros((len(t), n, 2))
+
+    Tm = plant.Tc - 273.15
+    bank.reset()
+    for k in range(len(t)):
+        Tm = Tm + noise*(random.rand(2) - 0.5)
+        T[k] = Tm
+        Q[k] = bank.step(np.tile(SP[k], n), Tm.ravel(), dt).reshape(n, 2)
+        if k < len(t) - 1:
+            Tm = plant.step(dt, Q[k])
+    return t, T, Q, SP
+
+
+def score(t, T, Q, SP, criterion='IAE', move_penalty=0.):
+    """
+    Cost (n, 2) of each heater of each run of simulate(): the integral of
+    the absolute (IAE) or squared (ISE) error plus `move_penalty` times
+    the total heater movement
+    """
+    dt = t[1] - t[0]
+    error = SP[:, None, :] - T
+    if criterion == 'IAE':
+        cost = np.abs(error).sum(axis=0)*dt
+    elif criterion == 'ISE':
+        cost = (error**2).sum(axis=0)*dt
+    else:
+        raise ValueError('Unknown criterion: {}'.format(criterion))
+    return cost + move_penalty*np.abs(np.diff(Q, axis=0)).sum(axis=0)
+
+
+def gain_schedule(points=np.arange(25., 51., 5.), step=10.,
+                  duration=1500., lam=None):
+    """
+    Gain schedule of both heaters from open-loop step tests of the model
+
+    At every operating point, each heater of a plant at rest (both heaters
+    held at the point) gets a heater step; all tests run as one batch. The
+    responses are fitted to first order plus dead time models (gain K,
+    time constant tau and dead time theta, two point method) and tuned
+    with the IMC rules:
+
+        Kc = (2 tau + theta)/(K (2 lam + theta))
+        tauI = tau + theta/2
+        tauD = tau theta/(2 tau + theta)
+
+    Points where either heater cannot be held within 0-100 % are dropped:
+    with the nominal model both heaters can be held from about 24 C to
+    51 C (heater 2 is the weaker one), so the default table covers 25-50 C
+    and the lookup holds its end values beyond.
+
+    points = evenly spaced operating temperatures (C)
+    step = heater step (%), downwards where it would exceed 100 %
+    duration = length of the tests (s), long enough to settle
+    lam = closed-loop time constant (s); default max(0.1 tau, 0.8 theta)
+    """
+    points = np.asarray(points, dtype=float)
+    Q = PlantBatch(len(points), points[:, None], convection=0.).steady(
+        points[:, None])
+    points = points[((Q >= 0.) & (Q <= 100.)).all(axis=1)]
+    if len(points) < 2:
+        raise ValueError('Fewer than two operating points can be held '
+                         'within 0-100 %')
+    P = len(points)
+    T0 = np.tile(points, 2)
+    plant = PlantBatch(2*P, T0[:, None], convection=0.)
+
+    # Plants 0..P-1 step heater 1, plants P..2P-1 heater 2
+    run = np.arange(2*P)
+    heater = run//P
+    Q = plant.steady(T0[:, None])
+    sign = np.where(Q[run, heater] + step <= 100., 1., -1.)
+    Q[run, heater] += sign*step
+
+    dT = np.zeros((int(duration) + 1, 2*P))
+    for k in range(1, len(dT)):
+        dT[k] = (plant.step(1., Q)[run, heater] - T0)*sign
+    K = dT[-1]/step
+    t28, t63 = [np.array([np.interp(f*dT[-1, j], dT[:, j], np.arange(len(dT)))
+                          for j in run]) for f in (0.283, 0.632)]
+    tau = 1.5*(t63 - t28)
+    theta = np.maximum(t63 - tau, 0.)
+    if lam is None:
+        lam = np.maximum(0.1*tau, 0.8*theta)
+
+    gains = np.column_stack(((2*tau + theta)/(K*(2*lam + theta)),
+                             tau + theta/2., tau*theta/(2*tau + theta)))
+    return Schedule(points, gains.reshape(2, P, 3).transpose(1, 0, 2))
+
+
+def _evaluate(gains, scenario, criterion, move_penalty):
+    return score(*simulate(gains, **scenario), criterion=criterion,
+                 move_penalty=move_penalty)
+
+
+def _nelder_mead(heater, x0, other, scenario, criterion, move_penalty,
+                 maxiter):
+    # Refine the gains of one heater, the other one keeping `other`
+    def cost(x):
+        clipped = np.clip(x, BOUNDS[:, 0], BOUNDS[:, 1])
+        gains = np.concatenate((clipped, other) if heater == 0
+                               else (other, clipped))
+        outside = np.abs(x - clipped).sum()
+        return _evaluate(gains, scenario, criterion,
+                         move_penalty)[0, heater] + 1e3*outside
+    res = minimize(cost, x0, method='Nelder-Mead',
+                   options={'maxiter': maxiter, 'xatol': 0.05,
+                            'fatol': 0.01})
+    return (np.clip(res.x, BOUNDS[:, 0], BOUNDS[:, 1]), res.fun, res.nfev)
+
+
+class Tuner(object):
+    """
+    PID tuner evaluating candidate gains in parallel on the simulated
+    plant; grid() searches a grid of gains, nelder_mead() refines the best
+    ones. Both heaters are tuned, each on its own cost.
+    """
+    def __init__(self, profile=PROFILE, duration=1000., dt=1.,
+                 criterion='IAE', move_penalty=0.05, noise=0., seed=0,
+                 workers=None):
+        """
+        profile, duration, dt, noise, seed = test run, see simulate()
+        criterion = 'IAE' or 'ISE'
+        move_penalty = cost per % of heater movement
+        workers = number of worker processes (default: one per CPU)
+        """
+        self.scenario = dict(profile=profile, duration=duration, dt=dt,
+                             noise=noise, seed=seed)
+        self.criterion = criterion
+        self.move_penalty = move_penalty
+        self.workers = workers or os.cpu_count() or 1
+        self.result = None
+        self._candidates = None
+        self._pool = None
+
+    def _executor(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.workers, mp_context=mp.get_context('spawn'))
+        return self._pool
+
+    def close(self):
+        """
+        Shut the worker processes down
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+    def evaluate(self, gains):
+        """
+        Return the costs (n, 2) of candidate gains (n, 6), split in one
+        batch per worker
+        """
+        gains = np.atleast_2d(gains)
+        chunks = np.array_split(gains, min(self.workers, len(gains)))
+        futures = [self._executor().submit(_evaluate, chunk, self.scenario,
+                                           self.criterion, self.move_penalty)
+                   for chunk in chunks]
+        return np.concatenate([f.result() for f in futures])
+
+    def grid(self, Kc=np.linspace(2., 20., 10),
+             tauI=np.linspace(20., 200., 10), tauD=np.linspace(0., 4., 5)):
+        """
+        Evaluate every combination of the given values (the same gains on
+        both heaters) and keep the best one of each heater
+        """
+        start = time.perf_counter()
+        axes = np.meshgrid(Kc, tauI, tauD, indexing='ij')
+        pid = np.column_stack([a.ravel() for a in axes])
+        cost = self.evaluate(np.hstack((pid, pid)))
+        self._candidates = (pid, cost)
+        best = cost.argmin(axis=0)
+        self.result = {'gains': (tuple(pid[best[0]].tolist()),
+                                 tuple(pid[best[1]].tolist())),
+                       'cost': (float(cost[best[0], 0]),
+                                float(cost[best[1], 1])),
+                       'evaluations': len(pid),
+                       'seconds': time.perf_counter() - start}
+        return self.result
+
+    def nelder_mead(self, starts=2, maxiter=40):
+        """
+        Refine the gains of each heater with Nelder-Mead searches run in
+        parallel from the `starts` best grid points (a coarse grid is
+        evaluated first if grid() was not run)
+
+        Every evaluation simulates a single plant, so this costs much more
+        per candidate than grid().
+        """
+        if self._candidates is None:
+            self.grid(Kc=np.linspace(2., 20., 4),
+                      tauI=np.linspace(20., 200., 4),
+                      tauD=np.linspace(0., 4., 3))
+        start = time.perf_counter()
+        pid, cost = self._candidates
+        best = self.result['gains']
+        futures = []
+        for heater in (0, 1):
+            other = np.array(best[1 - heater])
+            for i in np.argsort(cost[:, heater])[:starts]:
+                futures.append((heater, self._executor().submit(
+                    _nelder_mead, heater, pid[i], other, self.scenario,
+                    self.criterion, self.move_penalty, maxiter)))
+        gains = list(best)
+        costs = list(self.result['cost'])
+        evaluations = 0
+        for heater, future in futures:
+            x, fun, nfev = future.result()
+            evaluations += nfev
+            if fun < costs[heater]:
+                gains[heater] = tuple(x.tolist())
+                costs[heater] = float(fun)
+        self.result = {'gains': tuple(gains), 'cost': tuple(costs),
+                       'evaluations': self.result['evaluations'] + evaluations,
+                       'seconds': (self.result['seconds'] +
+                                   time.perf_counter() - start)}
+        return self.result
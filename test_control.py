@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Tests of the vectorized PID, of a scenario run in simulated time and of
+the serial layer against the firmware emulator (python -m pytest)
+
+@licence: MIT
+"""
+
+from __future__ import print_function, division
+import asyncio
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from control_backend import BoardBackend
+from control_clock import SimulatedClock
+from control_controllers import Autotune, OnOff, PID, PIDBank
+from control_demo import GUI
+from control_io import Acquisition, Connection, make_filter
+from control_perf import PhaseProfiler, TraceRecorder
+from control_plant import Plant, Shadow
+from control_scenario import Scenario
+from control_study import Comparison, MonteCarlo
+from control_tuning import BOUNDS, Tuner, gain_schedule, score, simulate
+
+
+def test_phase_profiler_times_each_phase():
+    profiler = PhaseProfiler(['read', 'control'], size=8)
+    for k in range(12):
+        profiler.start()
+        time.sleep(0.002)
+        profiler.lap('read')
+        profiler.lap('control')
+    with profiler.span('control'):
+        time.sleep(0.002)
+    stats = profiler.summary()
+    # The first start() opens a tick, it does not close one
+    assert stats['tick']['count'] == 11
+    assert stats['read']['count'] == 12
+    assert stats['control']['count'] == 13
+    assert stats['read']['p50'] >= 2.
+    assert stats['read']['p50'] > stats['control']['p50']
+    profiler.reset()
+    assert profiler.summary() == {}
+
+
+def test_trace_events_carry_their_thread():
+    profiler = PhaseProfiler(['read'])
+    profiler.tracer = TraceRecorder(capacity=4)
+
+    def solve():
+        with profiler.span('solve'):
+            pass
+    worker = threading.Thread(target=solve, name='tclab-worker_0')
+    worker.start()
+    worker.join()
+    for k in range(5):
+        profiler.start()
+        profiler.lap('read')
+    events = profiler.tracer.events()
+    threads = dict((e['tid'], e['args']['name']) for e in events
+                   if e['ph'] == 'M' and e['name'] == 'thread_name')
+    complete = [e for e in events if e['ph'] == 'X']
+    # The ring buffer keeps the last 4 events, oldest first
+    assert len(complete) == 4
+    assert [e['ts'] for e in complete] == sorted(e['ts'] for e in complete)
+    assert 'tclab-worker_0' in threads.values()
+    assert all(threads[e['tid']] == threading.current_thread().name
+               for e in complete)
+
+
+def pid(sp, pv, pv_last, ierr, dt, Kc=10.0, tauI=50.0, tauD=1.0):
+    # Scalar PID the controllers were written with, as a reference
+    KI = 1e5 if tauI == 0 else Kc/tauI
+    KD = Kc*tauD
+    error = sp - pv
+    ierr = ierr + KI*error*dt
+    op = Kc*error + ierr - KD*(pv - pv_last)/dt
+    if op < 0 or op > 100:
+        ierr = ierr - KI*error*dt
+        op = max(0, min(100, op))
+    return op, ierr
+
+
+@pytest.mark.parametrize('gains', [(10., 50., 1.), (3., 0., 0.),
+                                   (25., 120., 4.)])
+def test_pid_bank_matches_scalar_pid(gains):
+    random = np.random.RandomState(0)
+    n, dt = 5, 2.
+    sp = random.uniform(25., 60., n)
+    pv = np.full(n, 23.)
+    bank = PIDBank(n, *gains)
+    bank.reset(pv)
+    pv_last = pv.copy()
+    ierr = np.zeros(n)
+    for k in range(200):
+        op = bank.step(sp, pv, dt)
+        for i in range(n):
+            expected, ierr[i] = pid(sp[i], pv[i], pv_last[i], ierr[i], dt,
+                                    *gains)
+            assert op[i] == pytest.approx(expected, abs=1e-9)
+        np.testing.assert_allclose(bank.ierr, ierr, atol=1e-9)
+        pv_last = pv
+        pv = pv + 0.02*op - 0.05*(pv - 23.) + random.uniform(-.2, .2, n)
+
+
+def test_autotune_runs_pid_with_its_gains():
+    # The widget GUI: its sliders cannot show the gains found here
+    gui = GUI()
+    controller = Autotune()
+    plant = Plant(23.)
+    T = (23., 23.)
+    state = {'t': 0., 'dt': 4., 'Q': (0., 0.), 'last': T}
+    for k in range(1000):
+        state['t'] = k*4.
+        controller.tune(gui)
+        Q = controller.step(T, (40., 35.), state)
+        state['Q'] = Q
+        state['last'] = T
+        if controller.result is not None and 'loaded' in controller.result:
+            break
+        T = tuple(plant.step(4., *Q))
+    result = controller.result
+    assert result is not None, 'no relay cycles measured'
+    assert result['clipped']
+    assert result['loaded'][0][0] == 20.
+
+    # A few PID ticks after the handoff, with the GUI tuning clipped
+    for k in range(k + 1, k + 5):
+        state['t'] = k*4.
+        controller.tune(gui)
+        Q = controller.step(T, (40., 35.), state)
+        T = tuple(plant.step(4., *Q))
+    bank = state['pid']
+    np.testing.assert_allclose(np.column_stack((bank.Kc, bank.tauI,
+                                                bank.tauD)),
+                               result['gains'])
+
+
+def test_monte_carlo_is_reproducible():
+    options = dict(modes=('On-Off', 'PID'), runs=6, batch=4, duration=200.,
+                   seed=5)
+    one = MonteCarlo(workers=1, **options).run()
+    two = MonteCarlo(workers=2, **options).run()
+    for mode in options['modes']:
+        for kpi, values in one[mode].items():
+            assert values.shape == (6, 2)
+            np.testing.assert_allclose(values, two[mode][kpi], rtol=1e-5)
+    assert not np.allclose(one['PID']['IAE'], one['On-Off']['IAE'])
+
+
+def test_monte_carlo_rejects_unsupported_modes():
+    with pytest.raises(ValueError):
+        MonteCarlo(modes=('PID', 'Autotune'))
+    with pytest.raises(ValueError):
+        MonteCarlo(modes=('PID', 'Fuzzy'))
+    with pytest.raises(ValueError):
+        Comparison([PID(), Autotune()])
+
+
+def test_comparison_clones_differ_only_by_control():
+    comparison = Comparison([PID(), OnOff(), PID()], seed=1)
+    t, T, Q, SP, plant = comparison.run(duration=300.)
+    assert T.shape == (301, 3, 2)
+    # Same disturbance and noise: identical controllers, identical traces
+    np.testing.assert_array_equal(T[:, 0], T[:, 2])
+    np.testing.assert_array_equal(Q[:, 0], Q[:, 2])
+    assert not np.array_equal(Q[:, 0], Q[:, 1])
+
+
+def test_comparison_keeps_a_bounded_history():
+    comparison = Comparison([PID(), OnOff()], keep=50)
+    for k in range(200):
+        comparison.step(1., (40., 35.))
+    t, T, Q, SP = comparison.history()
+    assert len(t) == 50
+    assert t[-1] == 199.
+    comparison.keep(20)
+    assert len(comparison.history()[0]) == 20
+    assert len(comparison.history(10)[0]) == 10
+
+
+def _shadow_summary(measure, n=40):
+    # Shadow fed with measure(k) at 1 s intervals, heaters off
+    shadow = Shadow(window=30, limit=3.)
+    for k in range(n):
+        shadow.update(k*10**9, *(measure(k) + (0., 0.)))
+    shadow._executor.submit(lambda: None).result()
+    return shadow.summary()
+
+
+def test_shadow_alarm():
+    # Measurements matching the model at rest
+    assert not _shadow_summary(lambda k: (23., 23.))['alarm']
+    # A steady offset
+    assert _shadow_summary(lambda k: (23., 23. + 5.*(k > 0)))['alarm']
+    # A residual changing sign every sample averages to zero
+    summary = _shadow_summary(lambda k: (23. + 5.*(-1)**k*(k > 0), 23.))
+    assert abs(summary['mean'][0]) < 1.
+    assert summary['mae'][0] == pytest.approx(5., abs=0.1)
+    assert summary['alarm']
+
+
+class _Counter(object):
+    # Connection stand-in whose readings count the reads
+    def __init__(self):
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        return float(self.reads), -float(self.reads)
+
+
+def test_acquisition_queues_every_sample_for_the_recorder():
+    async def session(acquisition):
+        acquisition.start()
+        first = await acquisition.next()
+        await asyncio.sleep(0.3)        # a late tick
+        latest = await acquisition.next()
+        acquisition.stop()
+        return first, latest, acquisition.drain()
+
+    acquisition = Acquisition(_Counter(), 0.02)
+    first, latest, recorded = asyncio.run(session(acquisition))
+    # The controller gets the newest sample, skipping the ones in between
+    assert latest[1] > first[1] + 5
+    assert acquisition.stale == latest[1] - first[1] - 1
+    # The recorder gets all of them, in order
+    values = [sample[1] for sample in recorded]
+    assert values == list(np.arange(1., len(values) + 1.))
+    assert values[-1] >= latest[1]
+    stamps = [sample[0] for sample in recorded]
+    assert all(b > a for a, b in zip(stamps, stamps[1:]))
+
+
+@pytest.mark.parametrize('name, reference', [
+    ('Moving average', lambda window: window.mean(axis=0)),
+    ('Median', lambda window: np.median(window, axis=0))])
+def test_window_filters(name, reference):
+    random = np.random.RandomState(0)
+    x = random.uniform(20., 30., (100, 2))
+    flt = make_filter(name, 7)
+    for k in range(len(x)):
+        np.testing.assert_allclose(flt(x[k]),
+                                   reference(x[max(0, k - 6):k + 1]))
+
+
+def test_exponential_filter():
+    flt = make_filter('Exponential', 3)
+    assert flt((1., 2.)) == (1., 2.)
+    assert flt((3., 2.)) == pytest.approx((2., 2.))
+
+
+def test_board_app_filters_with_a_moving_average():
+    from control_arduino import GUI as BoardGUI
+    gui = BoardGUI(port='/dev/null')
+    assert gui._filter == 'Moving average'
+    gui._reset_general(None)
+    assert gui._filter == 'Moving average'
+
+
+def test_discover_only_returns_known_boards(monkeypatch):
+    import control_io
+    ports = [('/dev/ttyACM0', 'Arduino Uno',
+              'USB VID:PID=16D0:0613 SER=1 LOCATION=1-1:1.0'),
+             ('/dev/ttyUSB0', 'FT232R USB UART',
+              'USB VID:PID=0403:6001 SER=A1 LOCATION=1-2'),
+             ('/dev/ttyS0', 'ttyS0', 'n/a')]
+    monkeypatch.setattr(control_io.list_ports, 'comports', lambda: ports)
+    assert control_io.discover() == ['/dev/ttyACM0']
+
+
+def test_simulate_scores_candidates_alike():
+    # Candidates share the disturbance and noise: a batch scores the same
+    # gains the same, and alone up to the ODE solver tolerance
+    gains = np.array([[10., 50., 1.]*2, [5., 100., 0.]*2, [10., 50., 1.]*2])
+    options = dict(duration=300., noise=0.5, seed=3)
+    cost = score(*simulate(gains, **options))
+    np.testing.assert_array_equal(cost[0], cost[2])
+    np.testing.assert_allclose(cost[1],
+                               score(*simulate(gains[1], **options))[0],
+                               rtol=1e-5)
+
+
+def test_tuner_grid_is_independent_of_workers():
+    grid = dict(Kc=[2., 10., 20.], tauI=[20., 100.], tauD=[0., 2.])
+    results = []
+    for workers in (1, 2):
+        tuner = Tuner(duration=300., noise=0.5, workers=workers)
+        try:
+            results.append(tuner.grid(**grid))
+        finally:
+            tuner.close()
+    assert results[0]['gains'] == results[1]['gains']
+    np.testing.assert_allclose(results[0]['cost'], results[1]['cost'],
+                               rtol=1e-5)
+    for gains in results[0]['gains']:
+        assert ((BOUNDS[:, 0] <= gains) & (gains <= BOUNDS[:, 1])).all()
+
+
+def test_gain_schedule_covers_the_holdable_range():
+    schedule = gain_schedule()
+    np.testing.assert_array_equal(schedule.points, np.arange(25., 51., 5.))
+    assert schedule.gains.shape == (6, 2, 3)
+    assert (schedule.gains > 0.).all()
+    # 55 C needs more than 100 % on heater 2: dropped
+    np.testing.assert_array_equal(
+        gain_schedule(points=np.arange(40., 61., 5.)).points, [40., 45., 50.])
+    with pytest.raises(ValueError):
+        gain_schedule(points=[60., 70., 80.])
+
+
+def _wait(run, timeout):
+    finished = threading.Event()
+    run.add_done_callback(lambda run: finished.set())
+    assert finished.wait(timeout), 'run did not end'
+
+
+def test_scenario_in_simulated_time():
+    clock = SimulatedClock()
+    gui = GUI(headless=True, clock=clock)
+    scenario = Scenario().at(0, SP1=40).until(1800)
+    _wait(gui.run_scenario(scenario, 'PID', factor=1.), 120.)
+
+    history = scenario.history()
+    assert len(history) == 1800/gui._delta_t + 1
+    assert history[-1, 0] == 1800.
+    assert clock.now == pytest.approx(1800., abs=gui._delta_t)
+    assert history[-1, 1] == pytest.approx(40., abs=2.)
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the emulator needs a pty')
+def test_emulator_round_trip():
+    from control_emulator import Emulator
+
+    async def call(fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, fn,
+                                                              *args)
+
+    async def session(backend, emulator):
+        T = await backend.open(0.1)
+        await backend.write(40., 20.)
+        samples = [await backend.read(0.1) for i in range(3)]
+        assert (emulator.Q1, emulator.Q2) == (40., 20.)
+        await backend.close()
+        return T, samples
+
+    with Emulator(T0=23.) as emulator:
+        connection = Connection(emulator.port)
+        try:
+            T, samples = asyncio.run(session(
+                BoardBackend(connection, call), emulator))
+            assert connection.status == 'connected'
+            assert np.allclose(T, 23., atol=1.)
+            times = [sample[0] for sample in samples]
+            assert all(t1 > t0 for t0, t1 in zip(times, times[1:]))
+            # close() switched the heaters off after the write
+            assert (emulator.Q1, emulator.Q2) == (0., 0.)
+            assert emulator.commands > 0
+        finally:
+            connection.close()
+
+
+@pytest.mark.skipif(os.name != 'posix', reason='the emulator needs a pty')
+def test_board_loop_paced_by_acquisition():
+    from control_arduino import GUI as BoardGUI
+    from control_emulator import Emulator
+
+    with Emulator() as emulator:
+        gui = BoardGUI(port=emulator.port)
+        try:
+            gui._delta_t = 0.25
+            scenario = Scenario().at(0, SP1=30).until(2)
+            _wait(gui.run_scenario(scenario, 'PID'), 30.)
+        finally:
+            gui._lab.close()
+    # One tick per sample: nothing waits on top of the acquisition
+    t = scenario.history()[:, 0]
+    assert len(t) >= 8
+    assert np.diff(t).max() < 0.4